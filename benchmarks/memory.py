@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Per-object memory footprint of the OnionOO record classes.
+
+Builds the same records with the slotted classes from onion_py.objects and
+with otherwise identical __dict__-based copies and reports the bytes
+allocated per object as measured by tracemalloc.
+
+Usage: PYTHONPATH=. python benchmarks/memory.py [count]
+"""
+import sys
+import gc
+import tracemalloc
+import onion_py.objects as o
+
+HISTORY = {'first': '2015-01-01 00:00:00', 'last': '2015-01-04 00:00:00',
+    'interval': 900, 'factor': 1.5, 'count': 3, 'values': [1, 2, None]}
+
+RECORDS = [
+    (o.RelaySummary, {'n': 'relay', 'f': 'A' * 40, 'a': ['10.0.0.1'],
+      'r': True}),
+    (o.BridgeSummary, {'n': 'bridge', 'h': 'B' * 40, 'r': True}),
+    (o.RelayDetails, {'nickname': 'relay', 'fingerprint': 'A' * 40,
+      'or_addresses': ['10.0.0.1:9001'], 'running': True,
+      'flags': ['Fast', 'Running'], 'country': 'de', 'as_number': 'AS1',
+      'consensus_weight': 100, 'bandwidth_rate': 1, 'bandwidth_burst': 2,
+      'observed_bandwidth': 3, 'advertised_bandwidth': 3,
+      'exit_policy_summary': {'reject': ['1-65535']},
+      'exit_probability': 0.0}),
+    (o.BridgeDetails, {'nickname': 'bridge', 'hashed_fingerprint': 'B' * 40,
+      'running': True, 'flags': ['Running']}),
+    (o.GraphHistory, HISTORY),
+    (o.BandwidthDetail, {'fingerprint': 'A' * 40}),
+    (o.RelayWeight, {'fingerprint': 'A' * 40}),
+    (o.BridgeClient, {'fingerprint': 'B' * 40}),
+    (o.RelayUptime, {'fingerprint': 'A' * 40}),
+    (o.BridgeUptime, {'fingerprint': 'B' * 40}),
+    ]
+
+
+def dict_based(record_class):
+  """ Copy of record_class storing its attributes in a per-instance dict """
+  namespace = dict((k, v) for k, v in vars(record_class).items()
+      if k not in ('__slots__', '__dict__', '__weakref__') and
+      k not in record_class.__slots__)
+  return type(record_class.__name__, (object,), namespace)
+
+
+def allocated(record_class, raw, count):
+  gc.collect()
+  tracemalloc.start()
+  before = tracemalloc.take_snapshot()
+  objects = [record_class(raw) for i in range(count)]
+  after = tracemalloc.take_snapshot()
+  tracemalloc.stop()
+  stats = after.compare_to(before, 'filename')
+  size = sum(stat.size_diff for stat in stats)
+  # the list holding the objects is not part of their footprint
+  size -= sys.getsizeof(objects)
+  del objects
+  return size / float(count)
+
+
+def main(argv):
+  count = int(argv[1]) if len(argv) > 1 else 10000
+  print("{:<18}{:>10}{:>10}{:>10}".format('class', 'dict', 'slots', 'saved'))
+  for record_class, raw in RECORDS:
+    slotted = allocated(record_class, raw, count)
+    plain = allocated(dict_based(record_class), raw, count)
+    print("{:<18}{:>10.0f}{:>10.0f}{:>9.0f}%".format(record_class.__name__,
+      plain, slotted, 100 * (plain - slotted) / plain))
+
+if __name__ == "__main__":
+  main(sys.argv)
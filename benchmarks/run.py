@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite
+
+Generates synthetic documents (onion_py.synthetic) of every document type at
+the requested scales and measures:
+  - decode: JSON decoding of the response body
+  - build: document construction including every relay and bridge object
+  - cache_set, cache_get: storing and loading the cache entry, per backend
+    (simple, disk, django with an in-memory backend if django is installed,
+    memcached with --memcached; memcached_encode/memcached_decode measure
+    the memcached serialisation without a server)
+  - query_miss, query_hit, query_304: end-to-end Manager.query latency with
+    the responses served in-process instead of over the network
+  - query_hit_throughput: cache hits per second with --threads threads
+
+The results are written as JSON (--output, default stdout) together with the
+commit, interpreter and platform; --compare prints the median change against
+the results of an earlier run.
+
+Usage: PYTHONPATH=. python benchmarks/run.py [--relays 1000 10000]
+    [--queries details bandwidth] [--repeat 5] [--output results.json]
+    [--compare baseline.json] [--memcached localhost:11211]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from onion_py.manager import Manager
+from onion_py.caching import OnionSimpleCache, OnionDiskCache, \
+    OnionMemcached, DependencyError, hashed_key
+from onion_py.instrumentation import clock
+from onion_py.synthetic import SyntheticNetwork
+
+
+class CannedResponse(object):
+  def __init__(self, status_code, content):
+    self.status_code = status_code
+    self.content = content
+    self.headers = {'Last-Modified': 'Thu, 01 Jan 2015 12:00:00 GMT'}
+    self.reason = ''
+    self.url = ''
+
+
+class CannedManager(Manager):
+  """ Manager answering requests from prepared bodies instead of OnionOO """
+  def __init__(self, bodies, **kwargs):
+    Manager.__init__(self, **kwargs)
+    self.bodies = bodies
+
+  def _get(self, url, params, headers = None, stream = False):
+    if headers and 'If-Modified-Since' in headers:
+      return CannedResponse(304, b'')
+    return CannedResponse(200, self.bodies[url[len(self.onionoo_host):]])
+
+
+def measure(func, repeat):
+  times = []
+  for i in range(repeat):
+    start = clock()
+    func()
+    times.append(clock() - start)
+  return times
+
+
+def result(name, times, **labels):
+  ordered = sorted(times)
+  entry = dict(labels)
+  entry.update({'name': name, 'times': times, 'min': ordered[0],
+      'median': ordered[len(ordered) // 2],
+      'mean': sum(ordered) / len(ordered), 'max': ordered[-1]})
+  return entry
+
+
+def django_cache():
+  """ OnionDjangoCache over django's in-memory backend, or None """
+  try:
+    from django.conf import settings
+    if not settings.configured and 'DJANGO_SETTINGS_MODULE' not in os.environ:
+      settings.configure(CACHES={'default': {
+          'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    from onion_py.caching import OnionDjangoCache
+    return OnionDjangoCache()
+  except (ImportError, DependencyError):
+    return None
+
+
+def cache_backends(directory, memcached):
+  backends = [('simple', OnionSimpleCache(max_bytes=1 << 40)),
+      ('disk', OnionDiskCache(directory, max_bytes=1 << 40))]
+  django = django_cache()
+  if django is not None:
+    backends.append(('django', django))
+  if memcached is not None:
+    host, port = memcached.rsplit(':', 1)
+    backends.append(('memcached', OnionMemcached((host, int(port)))))
+  return backends
+
+
+def bench_documents(network, queries, args):
+  labels = {'relays': network.relays, 'bridges': network.bridges}
+  results = []
+  bodies = {}
+  directory = tempfile.mkdtemp(prefix='onionpy-bench-')
+  try:
+    backends = cache_backends(directory, args.memcached)
+    try:
+      encoder = OnionMemcached()
+    except DependencyError:
+      encoder = None
+    for query in queries:
+      body = bodies[query] = network.body(query)
+      size = {'bytes': len(body), 'query': query}
+      size.update(labels)
+      record = Manager._decode(body)
+
+      results.append(result('decode', measure(lambda: Manager._decode(body),
+          args.repeat), **size))
+
+      document_class = Manager.OOO_QUERIES[query]
+      def build():
+        document = document_class(record)
+        list(document.relays or [])
+        list(document.bridges or [])
+      results.append(result('build', measure(build, args.repeat), **size))
+
+      entry = {'timestamp': 'Thu, 01 Jan 2015 12:00:00 GMT', 'etag': None,
+          'expires': time.time() + 3600, 'size': len(body), 'record': record}
+      for backend, cache in backends:
+        results.append(result('cache_set', measure(
+            lambda: cache.set(query, {}, entry), args.repeat),
+            backend=backend, **size))
+        results.append(result('cache_get', measure(
+            lambda: cache.get(query, {}), args.repeat),
+            backend=backend, **size))
+      if encoder is not None:
+        key = hashed_key(query, {})
+        value, chunks = encoder._encode(key, entry)
+        results.append(result('memcached_encode', measure(
+            lambda: encoder._encode(key, entry), args.repeat), **size))
+        results.append(result('memcached_decode', measure(
+            lambda: encoder._decode(key, value, chunks), args.repeat), **size))
+
+      manager = CannedManager(bodies, reuse_supersets=False)
+      results.append(result('query_miss', measure(
+          lambda: manager.query(query), args.repeat), **size))
+      manager = CannedManager(bodies, cache=OnionSimpleCache(max_bytes=1 << 40))
+      manager.query(query)
+      results.append(result('query_hit', measure(
+          lambda: manager.query(query), args.repeat), **size))
+      manager = CannedManager(bodies, cache=OnionSimpleCache(max_bytes=1 << 40),
+          publication_interval=0, min_fresh=0)
+      manager.query(query)
+      results.append(result('query_304', measure(
+          lambda: manager.query(query), args.repeat), **size))
+      results.append(throughput(manager, query, args.threads,
+          args.throughput_queries, size))
+      del bodies[query]
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+  return results
+
+
+def throughput(manager, query, threads, queries, labels):
+  manager.publication_interval, manager.min_fresh = 3600, 3600
+  manager.refresh(query)
+  per_thread = max(queries // threads, 1)
+
+  def run():
+    for i in range(per_thread):
+      manager.query(query)
+  workers = [threading.Thread(target=run) for i in range(threads)]
+  start = clock()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  seconds = clock() - start
+  entry = dict(labels)
+  entry.update({'name': 'query_hit_throughput', 'threads': threads,
+      'queries': per_thread * threads, 'seconds': seconds,
+      'qps': per_thread * threads / seconds})
+  return entry
+
+
+def commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=subprocess.STDOUT).decode('ascii').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def result_key(entry):
+  return (entry['name'], entry.get('query'), entry.get('relays'),
+      entry.get('backend'))
+
+
+def compare(baseline, results, out):
+  """ Print the median (or qps) change of every benchmark in both runs """
+  old = dict((result_key(entry), entry) for entry in baseline['results'])
+  out.write("{:<22}{:<10}{:>8}{:<10}{:>12}{:>12}{:>9}\n".format('benchmark',
+      'query', 'relays', ' backend', 'old', 'new', 'change'))
+  for entry in results:
+    previous = old.get(result_key(entry))
+    if previous is None:
+      continue
+    field = 'qps' if 'qps' in entry else 'median'
+    change = 100.0 * (entry[field] - previous[field]) / previous[field]
+    out.write("{:<22}{:<10}{:>8} {:<9}{:>12.6g}{:>12.6g}{:>8.1f}%\n".format(
+        entry['name'], entry.get('query') or '', entry.get('relays') or '',
+        entry.get('backend') or '', previous[field], entry[field], change))
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Onion-Py benchmarks')
+  parser.add_argument('--relays', type=int, nargs='+', default=[1000],
+      help='network sizes to benchmark')
+  parser.add_argument('--bridges', type=int, default=None,
+      help='number of bridges (default: a quarter of the relays)')
+  parser.add_argument('--queries', nargs='+',
+      default=sorted(Manager.OOO_QUERIES), choices=sorted(Manager.OOO_QUERIES))
+  parser.add_argument('--histories', nargs='+', default=None,
+      help='history periods to generate (default: all)')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--threads', type=int, default=4)
+  parser.add_argument('--throughput-queries', type=int, default=10000)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--memcached', default=None, metavar='HOST:PORT',
+      help='also benchmark a memcached server')
+  parser.add_argument('--output', default=None, help='result file')
+  parser.add_argument('--compare', default=None, metavar='RESULTS',
+      help='result file of an earlier run to compare against')
+  args = parser.parse_args(argv[1:])
+
+  results = []
+  for relays in args.relays:
+    network = SyntheticNetwork(relays, args.bridges, seed=args.seed,
+        published=1420113600, histories=args.histories)
+    sys.stderr.write("benchmarking %s\n" % (network,))
+    results.extend(bench_documents(network, args.queries, args))
+
+  report = {'meta': {'commit': commit(), 'time': time.time(),
+      'python': platform.python_version(),
+      'implementation': platform.python_implementation(),
+      'platform': platform.platform(), 'arguments': vars(args)},
+      'results': results}
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=1, sort_keys=True)
+  else:
+    json.dump(report, sys.stdout, indent=1, sort_keys=True)
+    sys.stdout.write("\n")
+  if args.compare:
+    with open(args.compare) as f:
+      compare(json.load(f), results, sys.stderr)
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -5,6 +5,7 @@ import time
 import onion_py.manager as om
 from onion_py.objects import *
 from onion_py.caching import OnionMemcached, OnionSimpleCache
+from onion_py.family import FamilyGraph
 import random
 from functools import *
 import fileinput
@@ -47,52 +48,45 @@ def main(argv):
 def atlas(m, n):
   fields = 'nickname,fingerprint,last_seen,running,flags,advertised_bandwidth,or_addresses'
   print(fields)
+  fingerprints = []
   for line in sys.stdin.readlines():
     l = line.strip().split(",")
-    fp = l[2] if len(l) >= 3 else l[0]
-    d = m.query('details',lookup=fp, limit=1, type='relay', field=fields)
-    if len(d.relays) < 1:
+    fingerprints.append(l[2] if len(l) >= 3 else l[0])
+  relays = m.lookup_many(fingerprints, 'details', fields=fields, type='relay')
+  for fp in fingerprints:
+    r = relays.get(m._normalize_fingerprint(fp))
+    if r is None:
       print('not_found,{},...'.format(fp))
     else:
-      r = d.relays[0]
       print(",".join([str(x) for x in [r.nickname,r.fingerprint,r.last_seen,r.running,r.flags,r.bandwidth[3],r.or_addresses[0]]]))
     
 def family_members(m, n):
-  fields = 'nickname,fingerprint,family,exit_probability'
+  fields = 'nickname,fingerprint,family,effective_family,alleged_family,' + \
+      'consensus_weight_fraction,guard_probability,middle_probability,exit_probability'
+  graph = FamilyGraph(m.query('details', type='relay', fields=fields))
   for s in n:
-    d = m.query('details', search=s, limit=1, type='relay', fields=fields)
-    if len(d.relays) < 1:
+    i = graph.resolve(s)
+    if i is None:
+      d = m.query('details', search=s, limit=1, type='relay', fields='fingerprint')
+      i = graph.resolve(d.relays[0].fingerprint) if len(d.relays) > 0 else None
+    if i is None:
       print("No relay found for search term '{}'".format(s))
       continue
 
-    check_relay = d.relays[0]
-    valid_relays = [check_relay]
-    invalid_relays = []
-    for f in check_relay.family:
-      d = m.query('details', search=f, limit=1, type='relay', fields=fields)
-      if len(d.relays) > 0:
-        if family_check(d.relays[0].family, check_relay):
-          valid_relays.append(d.relays[0])
-        else:
-          invalid_relays.append(d.relays[0])
-      else:
-        invalid_relays.append(RelayDetails({'nickname': f}))
+    fp = graph.fingerprints[i]
+    valid_relays = [fp] + graph.mutual_members(fp)
+    invalid_relays = graph.one_sided(fp) + graph.unresolved_members(fp)
     print("Finished aggregation for {}".format(s))
-    print("Valid family members  : {}".format(", ".join([x.nickname or x.fingerprint for x in valid_relays])))
+    print("Valid family members  : {}".format(", ".join([graph.relays[graph.resolve(x)].get('nickname') or x for x in valid_relays])))
     if len(invalid_relays) > 0:
-      print("Invalid family members: {}".format(", ".join([str(x) for x in invalid_relays])))
+      print("Invalid family members: {}".format(", ".join(invalid_relays)))
     p = 0.0
-    for r in valid_relays:
-      p = p + r.exit_probability or 0.0
+    for x in valid_relays:
+      p = p + (graph.relays[graph.resolve(x)].get('exit_probability') or 0.0)
     print("Aggregate exit probability: {}".format(p))
-
-
-
-def family_check(family_strings, relay):
-  for f in family_strings:
-   if (relay.nickname == f or '$'+relay.fingerprint == f):
-     return True
-  return False
+    family = graph.family(fp)
+    if len(family) > len(valid_relays):
+      print("Extended family ({} relays) exit probability: {}".format(len(family), family.aggregates['exit_probability']))
 
 def test(m,n):
   d = m.query('summary', limit=4)
@@ -1 +1 @@
-__all__ = ["manager","objects","caching"]
+__all__ = ["manager","objects","caching","streaming","table","local","exitpolicy","family","refresh","diff","archive","instrumentation","synthetic","server","endpoints"]
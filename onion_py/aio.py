@@ -0,0 +1,170 @@
+"""
+Onion-Py asyncio support
+
+AsyncManager answers the same queries as onion_py.manager.Manager without
+blocking the event loop. Requires Python 3 and aiohttp.
+"""
+import asyncio
+import functools
+import time
+from onion_py.manager import BaseManager
+from onion_py.caching import DependencyError
+
+"""
+Async cache adapter
+
+Wraps an OnionCache so it can be awaited. Caches that block (memcached,
+django) are run in an executor, in-process caches are called directly.
+"""
+class AsyncCacheAdapter:
+  def __init__(self, cache, executor = None):
+    self.cache = cache
+    self.executor = executor
+
+  async def _call(self, method, *args):
+    if not getattr(self.cache, 'blocking', True):
+      return method(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.executor,
+        functools.partial(method, *args))
+
+  async def get(self, query, params):
+    return await self._call(self.cache.get, query, params)
+
+  async def set(self, query, params, document):
+    return await self._call(self.cache.set, query, params, document)
+
+
+"""
+The asyncio OnionOO api wrapper class.
+
+Args:
+  cache: OnionCache instance, or an object with awaitable get/set methods - if set to None, caching will be disabled.
+  onionoo_host: hostname for the onionoo api endpoint - defaults to canonical onionoo.torproject.org
+  pool_maxsize: maximum number of connections kept open per host
+  timeout: (connect, read) timeout in seconds passed to every request
+  keep_alive: reuse connections between queries
+  compression: ask onionoo for gzip/deflate encoded responses
+  publication_interval, min_fresh, max_fresh, instrumentation: see Manager
+"""
+class AsyncManager(BaseManager):
+  def __init__(self, cache = None, onionoo_host = None, pool_maxsize = 10,
+      timeout = (10, 60), keep_alive = True, compression = True,
+      publication_interval = 3600, min_fresh = 60, max_fresh = None,
+      instrumentation = None):
+    try:
+      import aiohttp
+      self._aiohttp = aiohttp
+    except ImportError:
+      raise DependencyError("Error importing aiohttp library for AsyncManager")
+
+    if cache is not None and not asyncio.iscoroutinefunction(cache.get):
+      cache = AsyncCacheAdapter(cache)
+    BaseManager.__init__(self, cache, onionoo_host, timeout,
+        publication_interval, min_fresh, max_fresh, instrumentation)
+    self.pool_maxsize = pool_maxsize
+    self.keep_alive = keep_alive
+    self.compression = compression
+    self.session = None
+
+  def _session(self):
+    # aiohttp sessions have to be created inside the running event loop
+    if self.session is None:
+      aiohttp = self._aiohttp
+      connector = aiohttp.TCPConnector(limit_per_host=self.pool_maxsize,
+          force_close=not self.keep_alive)
+      timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0],
+          sock_read=self.timeout[1])
+      headers = {'Accept-Encoding':
+          'gzip, deflate' if self.compression else 'identity'}
+      self.session = aiohttp.ClientSession(connector=connector,
+          timeout=timeout, headers=headers)
+    return self.session
+
+  async def close(self):
+    """ Close all pooled connections """
+    if self.session is not None:
+      await self.session.close()
+      self.session = None
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc):
+    await self.close()
+
+  async def query(self, query, **kwargs):
+    params = self._prepare(query, kwargs)
+
+    # build request
+    url = self.onionoo_host + query
+
+    # check for cache entry
+    cache_entry = None
+    if self.cache_client is not None:
+      with self._phase(query, 'cache_get'):
+        cache_entry = await self.cache_client.get(query, params)
+
+    now = time.time()
+    result = self._fresh_record(cache_entry, now)
+    if result is not None:
+      self._outcome(query, 'hit')
+
+    if result is None:
+      # Make (conditional) request
+      try:
+        with self._phase(query, 'download'):
+          async with self._session().get(url, params=params,
+              headers=self._conditional_headers(cache_entry)) as r:
+            content = await r.read()
+        self._transferred(query, len(content))
+        with self._phase(query, 'decode'):
+          result, cache_entry = self._process_response(cache_entry, now,
+              r.status, r.headers, content, r.reason, str(r.url))
+      except Exception:
+        self._outcome(query, 'error')
+        raise
+      self._outcome(query, 'not_modified' if r.status == 304 else 'miss')
+      # Save to cache
+      if cache_entry is not None and self.cache_client is not None:
+        with self._phase(query, 'cache_set'):
+          await self.cache_client.set(query, params, cache_entry)
+
+    return self._build_document(query, result)
+
+  async def gather(self, queries, limit = 10, return_exceptions = False):
+    """
+    Run many queries concurrently, at most limit of them at a time.
+
+    @type queries: iterable
+    @param queries: (query, params) tuples, or plain query names.
+    @rtype: list
+    @return: The documents, in the order of the queries. With
+    return_exceptions set, failed queries yield their exception instead of
+    cancelling the others.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(query, params):
+      async with semaphore:
+        return await self.query(query, **params)
+
+    tasks = []
+    for q in queries:
+      if isinstance(q, tuple):
+        query, params = q
+      else:
+        query, params = q, {}
+      tasks.append(run(query, dict(params)))
+    return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+
+
+async def refresh_forever(refresher, executor = None):
+  """
+  Run an onion_py.refresh.Refresher as an asyncio task; its (blocking)
+  revalidations run in executor. Cancel the task to stop it.
+  """
+  loop = asyncio.get_running_loop()
+  while True:
+    delay = await loop.run_in_executor(executor, refresher.run_pending)
+    await asyncio.sleep(delay)
@@ -0,0 +1,445 @@
+"""
+Onion-Py snapshot archive
+
+Keeps every ingested Summary or Details publication in an append-only,
+columnar on-disk format. The history of a single relay or the network totals
+per publication can then be read back without decoding unrelated snapshots
+or columns: the data file is memory-mapped and every column of every
+publication is a contiguous fixed-width array.
+
+    >>> archive = Archive('/var/lib/onionoo-archive')
+    >>> archive.append(manager.query('details'))
+    >>> archive.relay_history(fingerprint, start=time.time() - 90 * 86400)
+    >>> archive.totals()
+
+Layout of an archive directory:
+  - strings: dictionary of the fingerprints, nicknames, countries and
+    addresses, each stored as a 4 byte length followed by its UTF-8 bytes.
+    A string's id is its position; id 0 is the empty string.
+  - flags: the relay flags seen so far, one per line. Bit i of the flags
+    column stands for the flag on line i.
+  - data: one block per publication, holding the COLUMNS of its rows (sorted
+    by fingerprint id) one after the other.
+  - catalog: one entry per publication, in publication order: the
+    publication time, the offset of its block in data and its row count.
+
+Numbers are stored in native byte order. The catalog entry is written last,
+so a publication becomes visible only once it is complete. There must only
+be one writer at a time.
+"""
+import array
+import bisect
+import mmap
+import os
+import struct
+import onion_py.objects as o
+
+# (name, array typecode), in the order they are stored in a block
+COLUMNS = [
+    ('as_number', 'q'),
+    ('consensus_weight', 'q'),
+    ('advertised_bandwidth', 'q'),
+    ('flags', 'Q'),
+    ('consensus_weight_fraction', 'd'),
+    ('guard_probability', 'd'),
+    ('middle_probability', 'd'),
+    ('exit_probability', 'd'),
+    ('fingerprint', 'I'),
+    ('nickname', 'I'),
+    ('country', 'I'),
+    ('address', 'I'),
+    ('kind', 'B'),
+    ('running', 'B'),
+    ]
+STRING_COLUMNS = ['fingerprint', 'nickname', 'country', 'address']
+INT_COLUMNS = ['as_number', 'consensus_weight', 'advertised_bandwidth']
+FLOAT_COLUMNS = ['consensus_weight_fraction', 'guard_probability',
+    'middle_probability', 'exit_probability']
+RELAY, BRIDGE = 0, 1
+
+_CATALOG_ENTRY = struct.Struct('=qQQ')
+_LENGTH = struct.Struct('=I')
+_NAN = float('nan')
+
+
+def _to_bytes(values):
+  try:
+    return values.tobytes()
+  except AttributeError:
+    return values.tostring()
+
+
+def _from_bytes(typecode, data):
+  values = array.array(typecode)
+  try:
+    values.frombytes(data)
+  except AttributeError:
+    values.fromstring(data)
+  return values
+
+
+def _timestamp(value):
+  if value is None or isinstance(value, (int, float)):
+    return value
+  return o.parse_timestamp(value)
+
+
+def _as_number(value):
+  if value is None or value == '':
+    return -1
+  value = str(value).upper()
+  return int(value[2:] if value.startswith('AS') else value)
+
+
+def _address(addresses):
+  if not addresses:
+    return ''
+  address = addresses[0]
+  if address.startswith('['):
+    return address[1:address.index(']')]
+  return address.rsplit(':', 1)[0] if address.count(':') == 1 else address
+
+
+"""
+One archived publication
+
+Column values are read straight from the memory-mapped data file.
+"""
+class Block(object):
+  def __init__(self, archive, published, offset, rows):
+    self.archive = archive
+    self.published = published
+    self.offset = offset
+    self.rows = rows
+
+  def column(self, name):
+    """
+    The values of a column, one per row.
+
+    @rtype: memoryview
+    @return: A typed view into the mapped file (an array on Python 2).
+    """
+    offset = self.offset
+    for column, typecode in COLUMNS:
+      size = array.array(typecode).itemsize * self.rows
+      if column == name:
+        view = memoryview(self.archive._data())[offset:offset + size]
+        try:
+          return view.cast(typecode)
+        except AttributeError:
+          return _from_bytes(typecode, view.tobytes())
+      offset += size
+    raise KeyError(name)
+
+  def find(self, key):
+    """ Row of the record with a fingerprint (None if absent) """
+    string_id = self.archive._ids.get(key.upper())
+    if string_id is None:
+      return None
+    fingerprints = self.column('fingerprint')
+    i = bisect.bisect_left(fingerprints, string_id)
+    if i < self.rows and fingerprints[i] == string_id:
+      return i
+    return None
+
+  def record(self, row, fields = None):
+    """ Decode a row into a dict (missing values are None) """
+    result = {'published': self.published}
+    for name, typecode in COLUMNS:
+      if fields is not None and name not in fields:
+        continue
+      value = self.column(name)[row]
+      if name in STRING_COLUMNS:
+        value = self.archive.strings[value] or None
+      elif name in INT_COLUMNS:
+        value = None if value == -1 else value
+      elif name in FLOAT_COLUMNS:
+        value = None if value != value else value
+      elif name == 'flags':
+        value = [flag for i, flag in enumerate(self.archive.flags)
+            if value >> i & 1]
+      elif name == 'kind':
+        value = 'relay' if value == RELAY else 'bridge'
+      elif name == 'running':
+        value = bool(value)
+      result[name] = value
+    return result
+
+  def __len__(self):
+    return self.rows
+
+
+"""
+Append-only snapshot archive
+
+Args:
+  directory: archive directory (created if missing)
+"""
+class Archive(object):
+  def __init__(self, directory):
+    self.directory = directory
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.strings = []
+    self._ids = {}
+    self.flags = []
+    self.published = []
+    self.blocks = []
+    self._map = None
+    self.reload()
+
+  def _path(self, name):
+    return os.path.join(self.directory, name)
+
+  def _read(self, name):
+    try:
+      with open(self._path(name), 'rb') as f:
+        return f.read()
+    except (IOError, OSError):
+      return b''
+
+  def reload(self):
+    """ Pick up publications appended since the archive was opened """
+    data = self._read('strings')
+    strings, pos = [], 0
+    while pos + _LENGTH.size <= len(data):
+      length = _LENGTH.unpack_from(data, pos)[0]
+      if pos + _LENGTH.size + length > len(data):
+        # an interrupted append; overwritten by the next one
+        break
+      strings.append(data[pos + _LENGTH.size:pos + _LENGTH.size + length]
+          .decode('utf-8'))
+      pos += _LENGTH.size + length
+    self._strings_size = pos
+    if not strings:
+      strings = ['']
+    self.strings = strings
+    self._ids = dict((s, i) for i, s in enumerate(strings))
+
+    self.flags = [f for f in self._read('flags').decode('utf-8').split('\n')
+        if f]
+
+    data = self._read('catalog')
+    self.published, self.blocks = [], []
+    for i in range(len(data) // _CATALOG_ENTRY.size):
+      published, offset, rows = _CATALOG_ENTRY.unpack_from(data,
+          i * _CATALOG_ENTRY.size)
+      self.published.append(published)
+      self.blocks.append(Block(self, published, offset, rows))
+    self._map = None
+
+  def _data(self):
+    if self._map is None:
+      if os.path.getsize(self._path('data')) == 0:
+        return b''
+      with open(self._path('data'), 'rb') as f:
+        # views handed out earlier keep the previous mapping alive
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return self._map
+
+  def _string_id(self, value, new_strings):
+    value = value or ''
+    string_id = self._ids.get(value)
+    if string_id is None:
+      string_id = self._ids[value] = len(self.strings)
+      self.strings.append(value)
+      new_strings.append(value)
+    return string_id
+
+  def _flag_mask(self, flags, new_flags):
+    mask = 0
+    for flag in flags or ():
+      if flag not in self.flags:
+        if len(self.flags) == 64:
+          raise ValueError("More than 64 distinct relay flags")
+        self.flags.append(flag)
+        new_flags.append(flag)
+      mask |= 1 << self.flags.index(flag)
+    return mask
+
+  def _row(self, kind, record, new_strings, new_flags):
+    g = record.get
+    summary = 'f' in record or 'h' in record
+    if kind == RELAY:
+      key = g('f') if summary else g('fingerprint')
+      address = _address(g('a') if summary else g('or_addresses'))
+    else:
+      key = g('h') if summary else g('hashed_fingerprint')
+      address = ''
+    as_number = g('as_number') or g('as')
+    return {
+        'fingerprint': self._string_id((key or '').upper(), new_strings),
+        'nickname': self._string_id(g('n') if summary else g('nickname'),
+          new_strings),
+        'country': self._string_id(g('country'), new_strings),
+        'address': self._string_id(address, new_strings),
+        'as_number': _as_number(as_number),
+        'consensus_weight': -1 if g('consensus_weight') is None else
+          g('consensus_weight'),
+        'advertised_bandwidth': -1 if g('advertised_bandwidth') is None else
+          g('advertised_bandwidth'),
+        'flags': self._flag_mask(g('flags'), new_flags),
+        'consensus_weight_fraction': g('consensus_weight_fraction'),
+        'guard_probability': g('guard_probability'),
+        'middle_probability': g('middle_probability'),
+        'exit_probability': g('exit_probability'),
+        'kind': kind,
+        'running': 1 if (g('r') if summary else g('running')) else 0,
+        }
+
+  def append(self, document):
+    """
+    Archive a Summary or Details publication (document object or raw dict).
+
+    @rtype: bool
+    @return: False if the publication is archived already.
+    @raise ValueError: if the document is older than the last archived one.
+    """
+    if isinstance(document, dict):
+      header, relays, bridges = document.get, document.get('relays'), \
+          document.get('bridges')
+    else:
+      header = lambda field: getattr(document, field, None)
+      relays = getattr(document.relays, 'raw', document.relays)
+      bridges = getattr(document.bridges, 'raw', document.bridges)
+    published = o.parse_timestamp(header('relays_published') or
+        header('bridges_published'))
+    if published is None:
+      raise ValueError("Document has no publication time")
+    if self.published and published <= self.published[-1]:
+      if published == self.published[-1]:
+        return False
+      raise ValueError("Archive is append-only, last publication is newer")
+
+    new_strings, new_flags = [], []
+    strings_before, flags_before = len(self.strings), len(self.flags)
+    try:
+      rows = [self._row(RELAY, r, new_strings, new_flags)
+          for r in relays or []]
+      rows += [self._row(BRIDGE, b, new_strings, new_flags)
+          for b in bridges or []]
+    except Exception:
+      for value in new_strings:
+        del self._ids[value]
+      del self.strings[strings_before:]
+      del self.flags[flags_before:]
+      raise
+    rows.sort(key=lambda row: row['fingerprint'])
+
+    if new_strings:
+      with open(self._path('strings'), 'r+b' if os.path.exists(
+          self._path('strings')) else 'wb') as f:
+        f.seek(self._strings_size)
+        if self._strings_size == 0:
+          # id 0 is the empty string
+          f.write(_LENGTH.pack(0))
+          self._strings_size = _LENGTH.size
+        for value in new_strings:
+          data = value.encode('utf-8')
+          f.write(_LENGTH.pack(len(data)) + data)
+          self._strings_size += _LENGTH.size + len(data)
+        f.truncate()
+    if new_flags:
+      with open(self._path('flags'), 'ab') as f:
+        f.write(''.join(flag + '\n' for flag in new_flags).encode('utf-8'))
+
+    with open(self._path('data'), 'ab') as f:
+      offset = f.tell()
+      for name, typecode in COLUMNS:
+        values = [row[name] for row in rows]
+        if typecode == 'd':
+          values = [_NAN if v is None else v for v in values]
+        f.write(_to_bytes(array.array(typecode, values)))
+      f.flush()
+      os.fsync(f.fileno())
+    with open(self._path('catalog'), 'ab') as f:
+      f.write(_CATALOG_ENTRY.pack(published, offset, len(rows)))
+
+    self.published.append(published)
+    self.blocks.append(Block(self, published, offset, len(rows)))
+    self._map = None
+    return True
+
+  def _range(self, start, end):
+    start, end = _timestamp(start), _timestamp(end)
+    first = 0 if start is None else bisect.bisect_left(self.published, start)
+    last = len(self.published) if end is None else \
+        bisect.bisect_right(self.published, end)
+    return self.blocks[first:last]
+
+  def block(self, published):
+    """ The block of a publication (timestamp string or epoch seconds) """
+    published = _timestamp(published)
+    i = bisect.bisect_left(self.published, published)
+    if i == len(self.published) or self.published[i] != published:
+      raise KeyError(published)
+    return self.blocks[i]
+
+  def relay_history(self, fingerprint, start = None, end = None,
+      fields = None):
+    """
+    The archived values of one relay (or bridge, by hashed fingerprint).
+
+    @param start, end: publication time range (inclusive), as timestamp
+    strings or epoch seconds; None for no bound.
+    @param fields: columns to decode (all by default).
+    @rtype: list
+    @return: One dict per publication the relay appears in, with its
+    publication time in 'published'.
+    """
+    history = []
+    for block in self._range(start, end):
+      row = block.find(fingerprint)
+      if row is not None:
+        history.append(block.record(row, fields))
+    return history
+
+  def totals(self, start = None, end = None):
+    """
+    Network totals per publication: numbers of relays, running relays and
+    bridges, and the consensus weight and advertised bandwidth of the
+    running relays.
+
+    @rtype: list
+    @return: One dict per publication.
+    """
+    try:
+      np = o._numpy()
+    except Exception:
+      np = None
+    result = []
+    for block in self._range(start, end):
+      kind = block.column('kind')
+      running = block.column('running')
+      weight = block.column('consensus_weight')
+      bandwidth = block.column('advertised_bandwidth')
+      if np is not None:
+        relay = np.asarray(kind) == RELAY
+        up = relay & (np.asarray(running) == 1)
+        weight, bandwidth = np.asarray(weight), np.asarray(bandwidth)
+        totals = {'relays': int(relay.sum()), 'running_relays': int(up.sum()),
+            'bridges': int(len(relay) - relay.sum()),
+            'consensus_weight': int(weight[up & (weight >= 0)].sum()),
+            'advertised_bandwidth':
+              int(bandwidth[up & (bandwidth >= 0)].sum())}
+      else:
+        totals = {'relays': 0, 'running_relays': 0, 'bridges': 0,
+            'consensus_weight': 0, 'advertised_bandwidth': 0}
+        for k, r, w, b in zip(kind, running, weight, bandwidth):
+          if k != RELAY:
+            totals['bridges'] += 1
+            continue
+          totals['relays'] += 1
+          if r:
+            totals['running_relays'] += 1
+            totals['consensus_weight'] += max(w, 0)
+            totals['advertised_bandwidth'] += max(b, 0)
+      totals['published'] = block.published
+      result.append(totals)
+    return result
+
+  def __len__(self):
+    return len(self.blocks)
+
+  def __str__(self):
+    return "Snapshot archive (%d publications)" % (len(self.blocks),)
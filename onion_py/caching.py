@@ -3,8 +3,23 @@ Onion-Py caching backends
 """
 
 from onion_py.manager import Manager
+from onion_py.objects import parse_timestamp
+from collections import OrderedDict
 import json
 import abc
+import contextlib
+import time
+import threading
+import hashlib
+import binascii
+import os
+import mmap
+import tempfile
+import zlib
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 
 class DependencyError(Exception):
@@ -19,6 +34,9 @@ class OnionCache(object):
 
   __metaclass__ = abc.ABCMeta
 
+  # whether get/set block on I/O (used by onion_py.aio to pick an executor)
+  blocking = True
+
   @abc.abstractmethod
   def __init__(self, **kwargs):
       pass
@@ -31,48 +49,565 @@ class OnionCache(object):
   def set(self, query, params, document):
       pass
 
+  def get_many(self, requests):
+    """
+    Look up several (query, params) pairs at once.
+
+    @rtype: list
+    @return: The cached documents (or None) in the order of requests.
+    """
+    return [self.get(query, params) for query, params in requests]
+
+  def set_many(self, items):
+    """ Store several (query, params, document) tuples at once """
+    for query, params, document in items:
+      self.set(query, params, document)
+
+  def lock(self, query, params, timeout = 30):
+    """
+    Per-key lock, held by the Manager while it fetches a missing or stale
+    document so that concurrent misses lead to a single request. This
+    default only excludes threads sharing the cache object; backends shared
+    between processes override it.
+
+    @rtype: context manager
+    @return: A context manager yielding whether the lock was acquired.
+    """
+    return _key_locks(self).hold(key_serializer(query, params))
+
 def json_serializer(key, value):
   if type(value) == str:
     return value, 1
+  if isinstance(value, bytes):
+    return value, 3
   return json.dumps(value).encode('utf-8'), 2
 
 def json_deserializer(key, value, flags):
-  if flags == 1:
+  if flags == 1 or flags == 3:
     return value
   if flags == 2:
     return json.loads(value.decode('utf-8'))
   raise Exception("Unknown serialization format")
 
 def key_serializer(query, params):
+  params = Manager.canonical_params(params)
   s = query + ';';
   for key in Manager.OOO_QUERYPARAMS:
     s = s + str(params.get(key))+';'
   return s
 
-class OnionSimpleCache(OnionCache):
+def hashed_key(query, params, prefix = 'onionpy:'):
+  """ Fixed-length cache key, for stores with key length limits """
+  return prefix + hashlib.sha1(
+      key_serializer(query, params).encode('utf-8')).hexdigest()
+
+"""
+Per-key locks for the threads of one process. A key's lock is dropped once
+nobody holds or waits for it.
+"""
+class _KeyLocks(object):
   def __init__(self):
-    self.dict = {}
+    self._guard = threading.Lock()
+    self._locks = {}
+
+  @contextlib.contextmanager
+  def hold(self, key):
+    with self._guard:
+      entry = self._locks.get(key)
+      if entry is None:
+        entry = self._locks[key] = [threading.Lock(), 0]
+      entry[1] += 1
+    entry[0].acquire()
+    try:
+      yield True
+    finally:
+      with self._guard:
+        entry[1] -= 1
+        if entry[1] == 0:
+          del self._locks[key]
+      entry[0].release()
+
+_key_locks_guard = threading.Lock()
+
+def _key_locks(cache):
+  with _key_locks_guard:
+    locks = getattr(cache, '_key_locks', None)
+    if locks is None:
+      locks = cache._key_locks = _KeyLocks()
+  return locks
+
+@contextlib.contextmanager
+def _poll_lock(try_acquire, release, timeout, interval = 0.05):
+  """
+  Hold a lock that can only be tried (a shared cache's add, a non-blocking
+  flock). Gives up waiting after timeout seconds and runs unlocked rather
+  than failing the query.
+  """
+  deadline = time.time() + timeout
+  acquired = try_acquire()
+  while not acquired and time.time() < deadline:
+    time.sleep(interval)
+    acquired = try_acquire()
+  try:
+    yield acquired
+  finally:
+    if acquired:
+      release()
+
+def _add_lock(add, get, delete, key, timeout):
+  """
+  Distributed lock held by adding a random token under key to a shared
+  cache; the entry expires after timeout seconds so that a crashed holder
+  does not block the others for good.
+  """
+  token = binascii.hexlify(os.urandom(8))
+
+  def release():
+    # only drop the lock if it has not expired and been taken over
+    if get(key) == token:
+      delete(key)
+  return _poll_lock(lambda: add(key, token), release, timeout)
+
+"""
+OnionSimpleCache class
+
+Bounded in-process cache. Entries are evicted in least recently used order
+once max_entries or max_bytes is exceeded, and expire ttl seconds after
+the publication (relays_published) of the document they hold, but no
+earlier than min_ttl seconds after they were (re)stored so that documents
+of a late publication can still be revalidated.
+
+Args:
+  max_entries: maximum number of entries (None for no limit)
+  max_bytes: maximum estimated total size of the entries (None for no limit)
+  ttl: entry lifetime in seconds after publication (None for no expiry)
+  min_ttl: minimum entry lifetime in seconds after storing it
+"""
+class OnionSimpleCache(OnionCache):
+  blocking = False
+
+  def __init__(self, max_entries = 1024, max_bytes = 512 * 1024 * 1024,
+      ttl = 2 * 3600, min_ttl = 600):
+    self.dict = OrderedDict()
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.min_ttl = min_ttl
+    self.total_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+    self._meta = {}
+    self._lock = threading.RLock()
+
+  @staticmethod
+  def _size(document):
+    # the manager records the response size; anything else is measured
+    size = document.get('size') if isinstance(document, dict) else None
+    if size is None:
+      size = len(json.dumps(document))
+    return size
+
+  def _deadline(self, document, now):
+    if self.ttl is None:
+      return None
+    published = None
+    if isinstance(document, dict) and isinstance(document.get('record'), dict):
+      published = parse_timestamp(document['record'].get('relays_published'))
+    if published is None:
+      return now + self.ttl
+    return max(published + self.ttl, now + self.min_ttl)
+
+  def _remove(self, key):
+    del self.dict[key]
+    size, deadline = self._meta.pop(key)
+    self.total_bytes -= size
+
+  def get(self, query, params):
+    key = key_serializer(query, params)
+    with self._lock:
+      document = self.dict.get(key)
+      if document is not None:
+        deadline = self._meta[key][1]
+        if deadline is not None and deadline <= time.time():
+          self._remove(key)
+          self.expirations += 1
+          document = None
+        else:
+          # mark as most recently used
+          self.dict[key] = self.dict.pop(key)
+      if document is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+      return document
+
+  def set(self, query, params, document):
+    key = key_serializer(query, params)
+    size = self._size(document)
+    now = time.time()
+    with self._lock:
+      if key in self.dict:
+        self._remove(key)
+      if self.max_bytes is not None and size > self.max_bytes:
+        return
+      self.dict[key] = document
+      self._meta[key] = (size, self._deadline(document, now))
+      self.total_bytes += size
+      while (self.max_entries is not None and
+          len(self.dict) > self.max_entries) or \
+          (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+        self._remove(next(iter(self.dict)))
+        self.evictions += 1
+
+  def stats(self):
+    """ Hit, miss, eviction and expiration counters and current usage """
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses,
+          'evictions': self.evictions, 'expirations': self.expirations,
+          'entries': len(self.dict), 'bytes': self.total_bytes}
+
+
+"""
+OnionDiskCache class
+
+Persistent cache storing each entry zlib-compressed in its own file below
+directory, so that a restarted process can serve the last documents without
+downloading them again. Entry files and the index (index.json, mapping entry
+files to their keys and sizes) are written to a temporary file and renamed
+into place, so readers never see partial entries. Reads are memory-mapped
+and decompressed a chunk at a time, so the compressed entry is never copied
+as a whole, and do not take the lock; writes and evictions take an exclusive
+lock on a lock file so several processes on one host can share the
+directory. Once the compressed entries exceed max_bytes, the least recently
+used ones (by file modification time, which is bumped on every read) are
+removed.
+
+Args:
+  directory: cache directory (created if missing)
+  max_bytes: maximum total size of the compressed entries (None for no limit)
+  compression: zlib compression level
+"""
+class OnionDiskCache(OnionCache):
+  INDEX = 'index.json'
+  LOCK = 'lock'
+  SUFFIX = '.entry'
+  # bytes of a mapped entry passed to the decompressor at a time
+  CHUNK_SIZE = 1024 * 1024
+
+  def __init__(self, directory, max_bytes = 1024 * 1024 * 1024,
+      compression = 6):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.compression = compression
+    self._lock = threading.Lock()
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def _path(self, name):
+    return os.path.join(self.directory, name)
+
+  @classmethod
+  def _filename(cls, key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest() + cls.SUFFIX
+
+  def _locked(self):
+    return _FileLock(self._path(self.LOCK), self._lock)
+
+  def _write(self, name, data):
+    fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+      _replace(tmp, self._path(name))
+    except Exception:
+      os.unlink(tmp)
+      raise
+
+  def _read_index(self):
+    try:
+      with open(self._path(self.INDEX), 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+      return {}
+
+  def _write_index(self, index):
+    self._write(self.INDEX, json.dumps(index).encode('utf-8'))
+
+  def _unlink(self, name):
+    try:
+      os.unlink(self._path(name))
+    except OSError:
+      pass
+
+  def _inflate(self, data):
+    """ Decompress a mapped entry and unmap it """
+    try:
+      decompressor = zlib.decompressobj()
+      parts = [decompressor.decompress(data[i:i + self.CHUNK_SIZE])
+          for i in range(0, len(data), self.CHUNK_SIZE)]
+      parts.append(decompressor.flush())
+      if not getattr(decompressor, 'eof', True):
+        raise zlib.error("Truncated entry")
+      return b''.join(parts)
+    finally:
+      data.close()
 
   def get(self, query, params):
-    return self.dict.get(key_serializer(query,params))
+    name = self._filename(key_serializer(query, params))
+    path = self._path(name)
+    try:
+      with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+          return None
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError):
+      return None
+    try:
+      document = json.loads(self._inflate(data).decode('utf-8'))
+    except (zlib.error, ValueError):
+      # a corrupt entry is treated as a miss and dropped
+      self._unlink(name)
+      return None
+    try:
+      # mark as most recently used
+      os.utime(path, None)
+    except OSError:
+      # read-only directory, or evicted by another process meanwhile
+      pass
+    return document
 
   def set(self, query, params, document):
-    self.dict[key_serializer(query, params)] = document
+    key = key_serializer(query, params)
+    name = self._filename(key)
+    data = zlib.compress(json.dumps(document).encode('utf-8'), self.compression)
+    with self._locked():
+      index = self._read_index()
+      if self.max_bytes is not None and len(data) > self.max_bytes:
+        self._unlink(name)
+        index.pop(name, None)
+      else:
+        self._write(name, data)
+        index[name] = {'key': key, 'size': len(data)}
+        self._evict(index, name)
+      self._write_index(index)
+
+  def _evict(self, index, keep):
+    if self.max_bytes is None:
+      return
+    total = sum(entry['size'] for entry in index.values())
+    if total <= self.max_bytes:
+      return
+    def mtime(name):
+      try:
+        return os.stat(self._path(name)).st_mtime
+      except OSError:
+        return 0
+    for name in sorted(index, key=mtime):
+      if total <= self.max_bytes:
+        break
+      if name == keep:
+        continue
+      total -= index.pop(name)['size']
+      self._unlink(name)
+
+  @contextlib.contextmanager
+  def lock(self, query, params, timeout = 30):
+    name = self._filename(key_serializer(query, params))
+    with _key_locks(self).hold(name):
+      if fcntl is None:
+        yield True
+        return
+      directory = self._path('locks')
+      if not os.path.isdir(directory):
+        try:
+          os.makedirs(directory)
+        except OSError:
+          pass
+      with open(os.path.join(directory, name), 'a') as f:
+        def try_acquire():
+          try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+          except (IOError, OSError):
+            return False
+        with _poll_lock(try_acquire,
+            lambda: fcntl.flock(f.fileno(), fcntl.LOCK_UN), timeout) as acquired:
+          yield acquired
+
+  def keys(self):
+    """ Cache keys of the stored entries, according to the index """
+    return [entry['key'] for entry in self._read_index().values()]
+
+  def size(self):
+    """ Total size of the compressed entries in bytes """
+    return sum(entry['size'] for entry in self._read_index().values())
+
+  def clear(self):
+    """ Remove all entries """
+    with self._locked():
+      for name in self._read_index():
+        self._unlink(name)
+      self._write_index({})
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+"""
+Exclusive lock held by a thread of this process and, where fcntl is
+available, by this process across all processes using the same lock file.
+"""
+class _FileLock(object):
+  def __init__(self, path, lock):
+    self.path = path
+    self.lock = lock
+    self.f = None
 
+  def __enter__(self):
+    self.lock.acquire()
+    try:
+      if fcntl is not None:
+        self.f = open(self.path, 'a')
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+    except:
+      self.lock.release()
+      raise
+    return self
+
+  def __exit__(self, *exc):
+    try:
+      if self.f is not None:
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        self.f.close()
+        self.f = None
+    finally:
+      self.lock.release()
+
+
+"""
+OnionMemcached class
 
+Stores documents zlib-compressed under hashed keys (see hashed_key). Values
+that do not fit into a single memcached item are split into chunks stored
+under their own keys, and the document key holds a manifest naming the
+chunks by a per-write version stamp together with their total length and
+SHA-1 digest, so that missing, evicted or mixed-up chunks are detected and
+reported as a miss instead of returning a corrupt document.
+
+Args:
+  host: memcached server address
+  chunk_size: maximum size of a stored value in bytes (memcached's item
+    limit is 1 MB including the key and item overhead)
+  compression: zlib compression level
+  expire: item lifetime in seconds (0 for no expiry)
+"""
 class OnionMemcached(OnionCache):
-  def __init__(self, host=('localhost', 11211)):
+  COMPRESSED = b'Z'
+  MANIFEST = b'M'
+
+  def __init__(self, host=('localhost', 11211), chunk_size = 1000 * 1000,
+      compression = 6, expire = 0):
     try:
       from pymemcache.client import Client
       self.memcached_client = Client(host, serializer=json_serializer, deserializer=json_deserializer)
     except ImportError:
       raise DependencyError("Error importing pymemcache library for OnionMemcached")
+    self.chunk_size = chunk_size
+    self.compression = compression
+    self.expire = expire
+
+  def _encode(self, key, document):
+    """
+    The memcached items storing document under key.
+
+    @rtype: tuple
+    @return: The value for key and a dict of chunk items it refers to.
+    """
+    data = zlib.compress(json.dumps(document).encode('utf-8'), self.compression)
+    if len(data) < self.chunk_size:
+      return self.COMPRESSED + data, {}
+    manifest = {'version': binascii.hexlify(os.urandom(8)).decode('ascii'),
+        'chunks': (len(data) + self.chunk_size - 1) // self.chunk_size,
+        'length': len(data), 'digest': hashlib.sha1(data).hexdigest()}
+    chunks = {}
+    for i, chunk_key in enumerate(self._chunk_keys(key, manifest)):
+      chunks[chunk_key] = data[i * self.chunk_size:(i + 1) * self.chunk_size]
+    return self.MANIFEST + json.dumps(manifest).encode('utf-8'), chunks
+
+  @staticmethod
+  def _chunk_keys(key, manifest):
+    return ['%s:%s:%d' % (key, manifest['version'], i)
+        for i in range(manifest['chunks'])]
+
+  def _manifest(self, value):
+    if isinstance(value, bytes) and value[:1] == self.MANIFEST:
+      try:
+        return json.loads(value[1:].decode('utf-8'))
+      except ValueError:
+        pass
+    return None
+
+  def _decode(self, key, value, chunks):
+    if value is None:
+      return None
+    manifest = self._manifest(value)
+    if manifest is not None:
+      try:
+        data = b''.join(chunks[k] for k in self._chunk_keys(key, manifest))
+      except (KeyError, TypeError):
+        return None
+      if len(data) != manifest['length'] or \
+          hashlib.sha1(data).hexdigest() != manifest['digest']:
+        return None
+    elif isinstance(value, bytes) and value[:1] == self.COMPRESSED:
+      data = value[1:]
+    else:
+      return None
+    try:
+      return json.loads(zlib.decompress(data).decode('utf-8'))
+    except (zlib.error, ValueError):
+      return None
+
+  def _chunks(self, keys, values):
+    chunk_keys = []
+    for key in keys:
+      manifest = self._manifest(values.get(key))
+      if manifest is not None:
+        chunk_keys.extend(self._chunk_keys(key, manifest))
+    if not chunk_keys:
+      return {}
+    return self.memcached_client.get_many(chunk_keys)
 
   def get(self, query, params):
-    return self.memcached_client.get(key_serializer(query,params))
+    return self.get_many([(query, params)])[0]
+
+  def get_many(self, requests):
+    keys = [hashed_key(query, params) for query, params in requests]
+    values = self.memcached_client.get_many(list(set(keys)))
+    chunks = self._chunks(set(keys), values)
+    return [self._decode(key, values.get(key), chunks) for key in keys]
 
   def set(self, query, params, document):
-    return self.memcached_client.set(key_serializer(query,params),document)
+    self.set_many([(query, params, document)])
+
+  def lock(self, query, params, timeout = 30):
+    client = self.memcached_client
+    expire = max(int(timeout), 1)
+    return _add_lock(
+        lambda k, v: client.add(k, v, expire=expire, noreply=False),
+        client.get, client.delete, hashed_key(query, params) + ':lock', timeout)
+
+  def set_many(self, items):
+    values, chunks = {}, {}
+    for query, params, document in items:
+      key = hashed_key(query, params)
+      values[key], document_chunks = self._encode(key, document)
+      chunks.update(document_chunks)
+    # chunks go first so that a manifest never refers to missing chunks
+    if chunks:
+      self.memcached_client.set_many(chunks, expire=self.expire)
+    self.memcached_client.set_many(values, expire=self.expire)
 
 class OnionDjangoCache(OnionCache):
   def __init__(self):
@@ -83,7 +618,22 @@ class OnionDjangoCache(OnionCache):
       raise DependencyError("Error importing django cache library for OnionDjangoCache")
 
   def get(self, query, params):
-    return self.cache.get(key_serializer(query, params))
+    return self.cache.get(hashed_key(query, params))
 
   def set(self, query, params, document):
-    return self.cache.set(key_serializer(query, params), document)
+    return self.cache.set(hashed_key(query, params), document)
+
+  def get_many(self, requests):
+    keys = [hashed_key(query, params) for query, params in requests]
+    values = self.cache.get_many(keys)
+    return [values.get(key) for key in keys]
+
+  def set_many(self, items):
+    self.cache.set_many(dict((hashed_key(query, params), document)
+        for query, params, document in items))
+
+  def lock(self, query, params, timeout = 30):
+    cache = self.cache
+    expire = max(int(timeout), 1)
+    return _add_lock(lambda k, v: cache.add(k, v, expire),
+        cache.get, cache.delete, hashed_key(query, params) + ':lock', timeout)
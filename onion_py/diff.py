@@ -0,0 +1,220 @@
+"""
+Onion-Py snapshot diffs
+
+Compares two snapshots of any document type record by record and produces a
+change feed of added, removed and changed relays and bridges. Records are
+matched by fingerprint (hashed fingerprint for bridges) and compared by a
+content digest first, so the cost is linear in the number of records and
+only changed records are compared field by field.
+
+    >>> feed = ChangeFeed(ignore=['last_seen', 'consensus_weight'])
+    >>> feed.update(manager.query('details'))
+    >>> for change in feed.update(manager.iter_query('details')):
+    ...   print(change)
+"""
+import hashlib
+import json
+from collections import OrderedDict
+import onion_py.streaming as streaming
+
+KEY_FIELDS = ['fingerprint', 'hashed_fingerprint', 'f', 'h']
+
+
+def record_key(record):
+  """ Fingerprint (or hashed fingerprint) identifying a raw record """
+  for field in KEY_FIELDS:
+    if record.get(field) is not None:
+      return record[field].upper()
+  return None
+
+
+def record_digest(record, ignore = None):
+  """ Content digest of a raw record, leaving out the ignored fields """
+  if ignore:
+    record = dict((k, v) for k, v in record.items() if k not in ignore)
+  return hashlib.sha1(json.dumps(record, sort_keys=True,
+      separators=(',', ':')).encode('utf-8')).digest()
+
+
+def iter_records(document):
+  """
+  Yield ('relays' or 'bridges', raw record) for a document object, a raw
+  document dict or an onion_py.streaming.DocumentStream (consuming it).
+  """
+  if isinstance(document, streaming.DocumentStream):
+    for item in document.iter_raw():
+      yield item
+    return
+  for kind in ('relays', 'bridges'):
+    if isinstance(document, dict):
+      records = document.get(kind)
+    else:
+      records = getattr(document, kind, None)
+      records = getattr(records, 'raw', records)
+    for record in records or []:
+      yield kind, record
+
+
+def index_records(document, ignore = None):
+  """
+  Index the records of a snapshot.
+
+  @rtype: dict
+  @return: Maps (kind, key) to (digest, raw record), in document order.
+  """
+  index = OrderedDict()
+  for kind, record in iter_records(document):
+    key = record_key(record)
+    if key is not None:
+      index[(kind, key)] = (record_digest(record, ignore), record)
+  return index
+
+
+"""
+Change to a single relay or bridge
+
+  - change: 'added', 'removed' or 'changed'
+  - kind: 'relays' or 'bridges'
+  - key: fingerprint (hashed fingerprint for bridges)
+  - fields: for changed records, maps each changed field to (old, new)
+  - old, new: the raw records (None when added or removed respectively)
+"""
+class Change(object):
+  __slots__ = ('change', 'kind', 'key', 'fields', 'old', 'new')
+
+  def __init__(self, change, kind, key, fields = None, old = None, new = None):
+    self.change = change
+    self.kind = kind
+    self.key = key
+    self.fields = fields or {}
+    self.old = old
+    self.new = new
+
+  def to_dict(self):
+    """ JSON-serialisable form for change feeds """
+    result = {'change': self.change, 'kind': self.kind, 'key': self.key}
+    if self.change == 'changed':
+      result['fields'] = dict((name, {'old': old, 'new': new})
+          for name, (old, new) in self.fields.items())
+    return result
+
+  def __str__(self):
+    if self.change == 'changed':
+      return "%s %s changed: %s" % (self.kind[:-1], self.key,
+          ", ".join(sorted(self.fields)))
+    return "%s %s %s" % (self.kind[:-1], self.key, self.change)
+
+
+def field_changes(old, new, ignore = None):
+  """
+  Field-level differences between two raw records.
+
+  @rtype: dict
+  @return: Maps each differing field to (old value, new value); missing
+  fields are reported as None.
+  """
+  changes = {}
+  for name in set(old) | set(new):
+    if ignore and name in ignore:
+      continue
+    if old.get(name) != new.get(name):
+      changes[name] = (old.get(name), new.get(name))
+  return changes
+
+
+def is_index(snapshot):
+  """ Whether snapshot is an index_records() index rather than a document """
+  return isinstance(snapshot, dict) and \
+      all(isinstance(key, tuple) and len(key) == 2 for key in snapshot)
+
+
+def iter_diff(old, new, ignore = None, new_index = None):
+  """
+  Compare two snapshots, yielding changes while the new one is read.
+
+  @param old: the previous snapshot (document, raw dict or DocumentStream),
+  or its index_records() index (built with any ignored fields).
+  @param new: the current snapshot; a DocumentStream is diffed as it is
+  parsed.
+  @param ignore: fields whose changes are not reported.
+  @param new_index: dict that is filled with the index of the new snapshot,
+  for diffing against the next one.
+  @rtype: generator
+  @return: Change objects: added and changed records in the order of the new
+  snapshot, followed by the removed records.
+  """
+  if ignore is not None:
+    ignore = set(ignore)
+  if not is_index(old):
+    old = index_records(old, ignore)
+  seen = set()
+  for kind, record in iter_records(new):
+    key = record_key(record)
+    if key is None:
+      continue
+    digest = record_digest(record, ignore)
+    if new_index is not None:
+      new_index[(kind, key)] = (digest, record)
+    seen.add((kind, key))
+    previous = old.get((kind, key))
+    if previous is None:
+      yield Change('added', kind, key, new=record)
+    elif previous[0] != digest:
+      fields = field_changes(previous[1], record, ignore)
+      # digests of an index built with other ignored fields always differ
+      if fields:
+        yield Change('changed', kind, key, fields, previous[1], record)
+  for (kind, key), (digest, record) in old.items():
+    if (kind, key) not in seen:
+      yield Change('removed', kind, key, old=record)
+
+
+def diff(old, new, ignore = None):
+  """
+  Compare two snapshots.
+
+  @rtype: list
+  @return: Change objects, see iter_diff.
+  """
+  return list(iter_diff(old, new, ignore))
+
+
+"""
+Change feed across publications
+
+Keeps the index of the last snapshot it was given; update() diffs the next
+snapshot against it. The first update only records the baseline.
+
+Args:
+  ignore: fields whose changes are not reported (e.g. last_seen)
+"""
+class ChangeFeed(object):
+  def __init__(self, ignore = None):
+    self.ignore = set(ignore) if ignore is not None else None
+    self.index = None
+    self.published = None
+
+  def update(self, document):
+    """
+    Diff a new snapshot against the previous one and make it the baseline.
+
+    @rtype: list
+    @return: Change objects (empty for the first snapshot).
+    """
+    new_index = OrderedDict()
+    if self.index is None:
+      for change in iter_diff({}, document, self.ignore, new_index):
+        pass
+      changes = []
+    else:
+      changes = list(iter_diff(self.index, document, self.ignore, new_index))
+    self.index = new_index
+    if isinstance(document, dict):
+      header = document.get
+    else:
+      header = lambda field: getattr(document, field, None)
+    self.published = (header('relays_published'), header('bridges_published'))
+    return changes
+
+  def __str__(self):
+    return "Change feed (%d records)" % (len(self.index or {}),)
@@ -0,0 +1,187 @@
+"""
+Onion-Py endpoint pool
+
+Tracks the latency and error rate of a set of OnionOO mirrors so a Manager
+can send each request to the currently best one and fail over to the next
+on server errors, timeouts and connection errors:
+
+    >>> pool = EndpointPool(['https://onionoo.torproject.org/',
+    ...     'https://onionoo.example.org/'], hedge_percentile=0.95)
+    >>> manager = Manager(OnionSimpleCache(), onionoo_host=pool)
+
+With hedge_percentile set, a request that takes longer than that percentile
+of its endpoint's recent response times is duplicated to the next endpoint
+and the first good answer is used.
+"""
+import collections
+import threading
+import time
+
+"""
+An OnionOO mirror and its recent performance
+
+  - host: base URL, ending with a slash
+  - latency: moving average of successful response times in seconds (None
+    before the first response)
+  - error_rate: moving average of failures (1) and successes (0)
+  - failures: consecutive failures
+  - down_until: the endpoint is only tried after all others until then
+  - samples: the most recent successful response times
+"""
+class Endpoint(object):
+  def __init__(self, host, samples = 100):
+    self.host = host if host.endswith('/') else host + '/'
+    self.latency = None
+    self.error_rate = 0.0
+    self.failures = 0
+    self.down_until = 0
+    self.requests = 0
+    self.samples = collections.deque(maxlen=samples)
+
+  def score(self):
+    """ Expected seconds per successful request (lower is better) """
+    return (self.latency or 0.0) / max(1.0 - self.error_rate, 0.05)
+
+  def percentile(self, q):
+    """ q-quantile (0 <= q <= 1) of the recent response times, or None """
+    if not self.samples:
+      return None
+    ordered = sorted(self.samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+  def __str__(self):
+    return "Endpoint %s (latency %s, error rate %.2f)" % (self.host,
+        "%.3fs" % self.latency if self.latency is not None else "unknown",
+        self.error_rate)
+
+
+"""
+Pool of OnionOO mirrors
+
+Args:
+  hosts: mirror base URLs, in order of preference while nothing is known
+    about them
+  alpha: weight of the newest observation in the moving averages
+  hedge_percentile: duplicate requests slower than this percentile of the
+    endpoint's response times to the next endpoint (None disables hedging)
+  hedge_min: lower bound of the hedging delay in seconds
+  min_samples: response times needed before an endpoint's requests are hedged
+  backoff: seconds an endpoint is demoted after a failure; doubled with
+    every further consecutive failure, up to max_backoff
+"""
+class EndpointPool(object):
+  # responses that are retried on another endpoint
+  RETRY_STATUSES = [500, 502, 503, 504]
+
+  def __init__(self, hosts, alpha = 0.2, hedge_percentile = None,
+      hedge_min = 0.05, min_samples = 10, backoff = 30, max_backoff = 600):
+    if not hosts:
+      raise ValueError("An endpoint pool needs at least one host")
+    self.endpoints = [Endpoint(host) for host in hosts]
+    self.alpha = alpha
+    self.hedge_percentile = hedge_percentile
+    self.hedge_min = hedge_min
+    self.min_samples = min_samples
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.hedges = 0
+    self.failovers = 0
+    self._lock = threading.Lock()
+
+  @property
+  def hosts(self):
+    return [e.host for e in self.endpoints]
+
+  def ranked(self, now = None):
+    """
+    The endpoints in the order they should be tried: available endpoints by
+    score (endpoints without measurements first, so every mirror gets
+    measured), then demoted ones by the end of their demotion.
+
+    @rtype: list
+    """
+    if now is None:
+      now = time.time()
+    with self._lock:
+      order = [(e.down_until > now, e.down_until if e.down_until > now
+          else 0, e.latency is not None, e.score(), i)
+          for i, e in enumerate(self.endpoints)]
+    return [self.endpoints[item[-1]] for item in sorted(order)]
+
+  def best(self):
+    return self.ranked()[0]
+
+  def endpoint_for(self, url):
+    """ The endpoint a request URL was sent to, or None """
+    for endpoint in self.endpoints:
+      if url and url.startswith(endpoint.host):
+        return endpoint
+    return None
+
+  def _average(self, current, value):
+    if current is None:
+      return value
+    return (1 - self.alpha) * current + self.alpha * value
+
+  def success(self, endpoint, seconds):
+    with self._lock:
+      endpoint.requests += 1
+      endpoint.latency = self._average(endpoint.latency, seconds)
+      endpoint.error_rate = self._average(endpoint.error_rate, 0.0)
+      endpoint.failures = 0
+      endpoint.down_until = 0
+      endpoint.samples.append(seconds)
+
+  def failure(self, endpoint, now = None):
+    """ Record a failed request and demote the endpoint for a while """
+    if now is None:
+      now = time.time()
+    with self._lock:
+      endpoint.requests += 1
+      endpoint.error_rate = self._average(endpoint.error_rate, 1.0)
+      endpoint.failures += 1
+      endpoint.down_until = now + min(self.backoff *
+          2 ** (endpoint.failures - 1), self.max_backoff)
+
+  def lagging(self, endpoint):
+    """
+    Record that an endpoint answered with an older publication than
+    another one did; it counts as an error but does not demote it.
+    """
+    with self._lock:
+      endpoint.error_rate = self._average(endpoint.error_rate, 1.0)
+
+  def record_hedge(self):
+    with self._lock:
+      self.hedges += 1
+
+  def record_failover(self):
+    with self._lock:
+      self.failovers += 1
+
+  def hedge_delay(self, endpoint):
+    """
+    Seconds after which a request to endpoint is duplicated.
+
+    @rtype: float
+    @return: The delay, or None if the request should not be hedged.
+    """
+    if self.hedge_percentile is None or \
+        len(endpoint.samples) < self.min_samples:
+      return None
+    return max(endpoint.percentile(self.hedge_percentile), self.hedge_min)
+
+  def stats(self):
+    """
+    @rtype: dict
+    @return: Per-host requests, latency, error rate and consecutive failures,
+    and the numbers of hedged and failed over requests.
+    """
+    with self._lock:
+      return {'hedges': self.hedges, 'failovers': self.failovers,
+          'endpoints': dict((e.host, {'requests': e.requests,
+            'latency': e.latency, 'error_rate': e.error_rate,
+            'failures': e.failures}) for e in self.endpoints)}
+
+  def __str__(self):
+    return "Endpoint pool (%s)" % (", ".join(self.hosts),)
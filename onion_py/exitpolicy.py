@@ -0,0 +1,173 @@
+"""
+Onion-Py exit policies
+
+Compiles OnionOO exit policy summaries ({"accept": ["80", "443-444"]} or
+{"reject": [...]}) into sorted sets of accepted port intervals, and indexes
+the policies of a whole details snapshot to answer port questions for all
+relays at once (the index requires numpy).
+"""
+import bisect
+import onion_py.objects as o
+
+MIN_PORT = 1
+MAX_PORT = 65535
+
+"""
+Compiled port policy
+
+Holds the accepted ports as sorted, disjoint, inclusive intervals
+(starts[i], ends[i]); allows(port) is a binary search.
+"""
+class PortPolicy(object):
+  __slots__ = ('starts', 'ends')
+
+  def __init__(self, intervals):
+    self.starts = [start for start, end in intervals]
+    self.ends = [end for start, end in intervals]
+
+  @staticmethod
+  def _parse(entries):
+    intervals = []
+    for entry in entries:
+      if '-' in entry:
+        start, end = entry.split('-')
+        intervals.append((int(start), int(end)))
+      else:
+        intervals.append((int(entry), int(entry)))
+    intervals.sort()
+    merged = []
+    for start, end in intervals:
+      if merged and start <= merged[-1][1] + 1:
+        merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+      else:
+        merged.append((start, end))
+    return merged
+
+  @classmethod
+  def from_summary(cls, summary):
+    """ Compile an exit policy summary; a missing summary accepts nothing """
+    if not summary:
+      return cls([])
+    if 'accept' in summary:
+      return cls(cls._parse(summary['accept']))
+    rejected = cls._parse(summary.get('reject') or [])
+    accepted = []
+    port = MIN_PORT
+    for start, end in rejected:
+      if start > port:
+        accepted.append((port, start - 1))
+      port = max(port, end + 1)
+    if port <= MAX_PORT:
+      accepted.append((port, MAX_PORT))
+    return cls(accepted)
+
+  def intervals(self):
+    return list(zip(self.starts, self.ends))
+
+  def allows(self, port):
+    i = bisect.bisect_right(self.starts, port) - 1
+    return i >= 0 and port <= self.ends[i]
+
+  def __eq__(self, other):
+    return isinstance(other, PortPolicy) and self.starts == other.starts and \
+        self.ends == other.ends
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __str__(self):
+    return "Port policy accepting " + ",".join(
+        str(s) if s == e else "%d-%d" % (s, e) for s, e in self.intervals())
+
+
+_compiled = {}
+_COMPILED_MAX = 10000
+
+def compile_policy(summary):
+  """
+  Compile an exit policy summary, sharing the result between relays with
+  identical summaries (most of the network uses a handful of policies).
+
+  @rtype: PortPolicy
+  """
+  if not summary:
+    key = None
+  else:
+    key = tuple((k, tuple(v)) for k, v in sorted(summary.items()))
+  policy = _compiled.get(key)
+  if policy is None:
+    policy = PortPolicy.from_summary(summary)
+    if len(_compiled) >= _COMPILED_MAX:
+      _compiled.clear()
+    _compiled[key] = policy
+  return policy
+
+
+"""
+Network-wide exit port index
+
+Flattens the accepted port intervals of all relays in a details snapshot
+into arrays so that "which relays allow port P" and "total exit probability
+for port P" are single vectorised passes, also for many ports at once.
+
+Args:
+  document: Details document (or a list of raw relay records)
+  ipv6: index exit_policy_v6_summary instead of exit_policy_summary
+  running_only: skip relays that are not running
+"""
+class ExitPortIndex(object):
+  def __init__(self, document, ipv6 = False, running_only = True):
+    np = o._numpy()
+    raw = document.relays if isinstance(document, o.Details) else document
+    raw = getattr(raw, 'raw', raw) or []
+    field = 'exit_policy_v6_summary' if ipv6 else 'exit_policy_summary'
+
+    fingerprints, probabilities = [], []
+    relay_index, starts, ends = [], [], []
+    for record in raw:
+      if running_only and record.get('running') is not True:
+        continue
+      policy = compile_policy(record.get(field))
+      if not policy.starts:
+        continue
+      i = len(fingerprints)
+      fingerprints.append(record.get('fingerprint'))
+      probabilities.append(record.get('exit_probability') or 0.0)
+      relay_index.extend([i] * len(policy.starts))
+      starts.extend(policy.starts)
+      ends.extend(policy.ends)
+
+    self.fingerprints = np.array(fingerprints, dtype=object)
+    self.exit_probability = np.array(probabilities, dtype=np.float64)
+    self.relay_index = np.array(relay_index, dtype=np.int64)
+    self.starts = np.array(starts, dtype=np.int64)
+    self.ends = np.array(ends, dtype=np.int64)
+
+  def _matches(self, ports):
+    np = o._numpy()
+    ports = np.asarray(ports, dtype=np.int64).reshape(-1, 1)
+    # a relay's intervals are disjoint, so each relay matches at most once
+    return (self.starts <= ports) & (ports <= self.ends)
+
+  def allowing(self, port):
+    """ Fingerprints of the relays whose policy allows port """
+    return list(self.fingerprints[self.relay_index[self._matches(port)[0]]])
+
+  def count(self, ports):
+    """ Number of relays allowing each port (scalar for a single port) """
+    np = o._numpy()
+    counts = self._matches(ports).sum(axis=1)
+    return int(counts[0]) if np.ndim(ports) == 0 else counts
+
+  def total_exit_probability(self, ports):
+    """ Summed exit probability of the relays allowing each port """
+    np = o._numpy()
+    weights = self.exit_probability[self.relay_index]
+    totals = self._matches(ports).astype(np.float64).dot(weights)
+    return float(totals[0]) if np.ndim(ports) == 0 else totals
+
+  def __len__(self):
+    return len(self.fingerprints)
+
+  def __str__(self):
+    return "Exit port index (%d relays)" % (len(self),)
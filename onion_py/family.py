@@ -0,0 +1,168 @@
+"""
+Onion-Py family graph
+
+Resolves the declared families of all relays in a details snapshot and
+computes mutual (valid) families, one-sided declarations and aggregate
+probabilities per family, in time linear in the number of relays and
+family declarations.
+"""
+import re
+
+_FINGERPRINT = re.compile(r'^\$?([0-9A-Fa-f]{40})(?:[=~].*)?$')
+
+AGGREGATE_FIELDS = ['consensus_weight_fraction', 'guard_probability',
+    'middle_probability', 'exit_probability']
+
+"""
+Family
+
+A connected group of relays linked by mutual family declarations.
+
+  - fingerprints: member fingerprints, in snapshot order
+  - aggregates: summed consensus_weight_fraction, guard_probability,
+    middle_probability and exit_probability of the members
+"""
+class Family(object):
+  def __init__(self, fingerprints, aggregates):
+    self.fingerprints = fingerprints
+    self.aggregates = aggregates
+
+  def __len__(self):
+    return len(self.fingerprints)
+
+  def __str__(self):
+    return "Family of %d relays (exit probability %f)" % \
+      (len(self.fingerprints), self.aggregates['exit_probability'])
+
+"""
+Family graph of a details snapshot
+
+Family entries may be given as "$FINGERPRINT", "$FINGERPRINT=nickname",
+"$FINGERPRINT~nickname" or a nickname; nicknames are only resolved if
+exactly one relay in the snapshot carries them. The family, effective_family
+and alleged_family fields are all taken into account.
+"""
+class FamilyGraph(object):
+  FAMILY_FIELDS = ['family', 'effective_family', 'alleged_family']
+
+  def __init__(self, document):
+    raw = getattr(document, 'relays', document)
+    self.relays = getattr(raw, 'raw', raw) or []
+    self.fingerprints = [(r.get('fingerprint') or '').upper()
+        for r in self.relays]
+    self._by_fingerprint = dict((fp, i)
+        for i, fp in enumerate(self.fingerprints))
+    nicknames = {}
+    for i, relay in enumerate(self.relays):
+      nickname = (relay.get('nickname') or '').lower()
+      nicknames[nickname] = i if nickname not in nicknames else None
+    self._by_nickname = nicknames
+
+    self.declared = []
+    self.unresolved = []
+    for i, relay in enumerate(self.relays):
+      declared = set()
+      unresolved = []
+      for field in self.FAMILY_FIELDS:
+        for entry in relay.get(field) or []:
+          j = self.resolve(entry)
+          if j is None:
+            if entry not in unresolved:
+              unresolved.append(entry)
+          elif j != i:
+            declared.add(j)
+      self.declared.append(declared)
+      self.unresolved.append(unresolved)
+
+    self.mutual = [set(j for j in declared if i in self.declared[j])
+        for i, declared in enumerate(self.declared)]
+    self.declared_by = [set() for relay in self.relays]
+    for i, declared in enumerate(self.declared):
+      for j in declared - self.mutual[i]:
+        self.declared_by[j].add(i)
+    self._components()
+
+  def resolve(self, entry):
+    """
+    Index of the relay a family entry, fingerprint or nickname refers to.
+
+    @rtype: int
+    @return: The index into the snapshot's relays, or None.
+    """
+    match = _FINGERPRINT.match(entry.strip())
+    if match is not None:
+      return self._by_fingerprint.get(match.group(1).upper())
+    if entry.startswith('$'):
+      return None
+    return self._by_nickname.get(entry.strip().lower())
+
+  def _components(self):
+    parent = list(range(len(self.relays)))
+
+    def find(i):
+      while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+      return i
+
+    for i, mutual in enumerate(self.mutual):
+      for j in mutual:
+        a, b = find(i), find(j)
+        if a != b:
+          parent[max(a, b)] = min(a, b)
+    self.component = [find(i) for i in range(len(self.relays))]
+    members = {}
+    for i, root in enumerate(self.component):
+      members.setdefault(root, []).append(i)
+    self._members = members
+
+  def _index(self, relay):
+    i = self.resolve(relay)
+    if i is None:
+      raise KeyError(relay)
+    return i
+
+  def _fingerprints(self, indexes):
+    return [self.fingerprints[i] for i in sorted(indexes)]
+
+  def mutual_members(self, relay):
+    """ Fingerprints of the relays with mutual family declarations """
+    return self._fingerprints(self.mutual[self._index(relay)])
+
+  def one_sided(self, relay):
+    """ Fingerprints the relay declares that do not declare it back """
+    i = self._index(relay)
+    return self._fingerprints(self.declared[i] - self.mutual[i])
+
+  def declared_by_others(self, relay):
+    """ Fingerprints of relays declaring this relay without it declaring them """
+    return self._fingerprints(self.declared_by[self._index(relay)])
+
+  def unresolved_members(self, relay):
+    """ Family entries of the relay that match no relay in the snapshot """
+    return list(self.unresolved[self._index(relay)])
+
+  def _family(self, members):
+    aggregates = dict((field, sum(self.relays[i].get(field) or 0.0
+        for i in members)) for field in AGGREGATE_FIELDS)
+    return Family(self._fingerprints(members), aggregates)
+
+  def family(self, relay):
+    """
+    The relay's family: all relays reachable through mutual declarations.
+
+    @rtype: Family
+    """
+    return self._family(self._members[self.component[self._index(relay)]])
+
+  def families(self, min_size = 2):
+    """ All families with at least min_size members """
+    return [self._family(members) for members in self._members.values()
+        if len(members) >= min_size]
+
+  def __len__(self):
+    return len(self.relays)
+
+  def __str__(self):
+    return "Family graph (%d relays, %d families)" % \
+      (len(self.relays), len(self.families()))
@@ -0,0 +1,251 @@
+"""
+Onion-Py instrumentation
+
+A Manager given an Instrumentation object reports where the time of every
+query goes, how many bytes were transferred, how the query was answered and
+the version of the returned document:
+
+    >>> metrics = MetricsAggregator()
+    >>> manager = Manager(OnionSimpleCache(), instrumentation=metrics)
+    >>> manager.query('details')
+    >>> print(metrics.exposition())
+
+Phases:
+  - cache_get, cache_set: cache lookups and stores
+  - derive: answering from a cached superset response or the snapshot index
+  - download: the (conditional) HTTP request including the body
+  - decode: interpreting the response (JSON decoding)
+  - build: constructing the document objects
+  - total: the whole Manager.query call
+
+Outcomes:
+  - hit: answered from a fresh cache entry
+  - derived: answered from a cached superset response
+  - snapshot: answered from the snapshot index (Manager(snapshot=True))
+  - stale: answered from an expired entry while it is revalidated
+  - miss: downloaded from OnionOO
+  - not_modified: revalidated with a 304 response
+  - outdated: a mirror answered with an older publication than the cached
+    one, which was kept
+  - coalesced: shared the request of another thread asking the same query
+  - error: the request failed
+
+Without instrumentation the Manager skips all of this.
+"""
+import bisect
+import threading
+import time
+
+clock = getattr(time, 'perf_counter', time.time)
+
+"""
+Instrumentation interface
+
+Subclasses override the hooks they are interested in; all of them are
+called synchronously from the querying thread and must be thread-safe.
+"""
+class Instrumentation(object):
+  def timing(self, query, phase, seconds):
+    """ A query phase took seconds """
+    pass
+
+  def outcome(self, query, outcome):
+    """ A query was answered in a certain way (hit, miss, ...) """
+    pass
+
+  def transferred(self, query, size):
+    """ size bytes of response body were received for a query """
+    pass
+
+  def version(self, query, version):
+    """ A document of a protocol version was returned """
+    pass
+
+
+"""
+Times a phase and reports it to an Instrumentation object
+"""
+class PhaseTimer(object):
+  __slots__ = ('instrumentation', 'query', 'phase', 'start')
+
+  def __init__(self, instrumentation, query, phase):
+    self.instrumentation = instrumentation
+    self.query = query
+    self.phase = phase
+
+  def __enter__(self):
+    self.start = clock()
+    return self
+
+  def __exit__(self, *exc):
+    self.instrumentation.timing(self.query, self.phase, clock() - self.start)
+
+
+"""
+Stands in for a PhaseTimer when instrumentation is disabled
+"""
+class _NullTimer(object):
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    pass
+
+NULL_TIMER = _NullTimer()
+
+
+"""
+Histogram with fixed bucket upper bounds
+
+Args:
+  buckets: sorted upper bounds; values above the last one are only counted
+    in the implicit +Inf bucket
+"""
+class Histogram(object):
+  def __init__(self, buckets):
+    self.buckets = list(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def cumulative(self):
+    """ (upper bound, number of values <= bound) pairs, ending with +Inf """
+    result, total = [], 0
+    for bound, count in zip(self.buckets + [float('inf')], self.counts):
+      total += count
+      result.append((bound, total))
+    return result
+
+  def quantile(self, q):
+    """ Upper bound of the bucket holding the q-quantile (0 <= q <= 1) """
+    if self.count == 0:
+      return None
+    rank = q * self.count
+    for bound, total in self.cumulative():
+      if total >= rank:
+        return bound
+
+
+def _labels(labels):
+  return ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+      .replace('"', '\\"')) for k, v in labels)
+
+
+def _bound(bound):
+  return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+"""
+In-memory metrics aggregator
+
+Counts outcomes, bytes and document versions per query type and keeps a
+latency histogram per query type and phase.
+
+Args:
+  buckets: histogram bucket upper bounds in seconds
+  prefix: metric name prefix used by exposition()
+"""
+class MetricsAggregator(Instrumentation):
+  BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+      30, 60]
+
+  def __init__(self, buckets = None, prefix = 'onionpy'):
+    self.buckets = list(buckets or self.BUCKETS)
+    self.prefix = prefix
+    self.histograms = {}
+    self.outcomes = {}
+    self.bytes = {}
+    self.versions = {}
+    self._lock = threading.Lock()
+
+  def timing(self, query, phase, seconds):
+    with self._lock:
+      histogram = self.histograms.get((query, phase))
+      if histogram is None:
+        histogram = self.histograms[(query, phase)] = Histogram(self.buckets)
+      histogram.observe(seconds)
+
+  def outcome(self, query, outcome):
+    with self._lock:
+      self.outcomes[(query, outcome)] = \
+          self.outcomes.get((query, outcome), 0) + 1
+
+  def transferred(self, query, size):
+    with self._lock:
+      self.bytes[query] = self.bytes.get(query, 0) + size
+
+  def version(self, query, version):
+    with self._lock:
+      self.versions[(query, version)] = \
+          self.versions.get((query, version), 0) + 1
+
+  def reset(self):
+    with self._lock:
+      self.histograms, self.outcomes = {}, {}
+      self.bytes, self.versions = {}, {}
+
+  def summary(self):
+    """
+    Plain data view of the metrics.
+
+    @rtype: dict
+    @return: 'outcomes' maps (query, outcome) to counts, 'bytes' query to
+    bytes, 'versions' (query, version) to counts and 'phases' (query, phase)
+    to a dict with count, sum, p50 and p99.
+    """
+    with self._lock:
+      phases = dict((key, {'count': h.count, 'sum': h.sum,
+          'p50': h.quantile(0.5), 'p99': h.quantile(0.99)})
+          for key, h in self.histograms.items())
+      return {'outcomes': dict(self.outcomes), 'bytes': dict(self.bytes),
+          'versions': dict(self.versions), 'phases': phases}
+
+  def exposition(self):
+    """
+    The metrics in the Prometheus text exposition format.
+
+    @rtype: str
+    """
+    p = self.prefix
+    lines = []
+    with self._lock:
+      lines.append('# HELP %s_phase_seconds Time spent per query phase' % p)
+      lines.append('# TYPE %s_phase_seconds histogram' % p)
+      for (query, phase), h in sorted(self.histograms.items()):
+        labels = [('query', query), ('phase', phase)]
+        for bound, total in h.cumulative():
+          lines.append('%s_phase_seconds_bucket{%s} %d' % (p,
+              _labels(labels + [('le', _bound(bound))]), total))
+        lines.append('%s_phase_seconds_sum{%s} %r' % (p, _labels(labels),
+            h.sum))
+        lines.append('%s_phase_seconds_count{%s} %d' % (p, _labels(labels),
+            h.count))
+      lines.append('# HELP %s_queries_total Queries by outcome' % p)
+      lines.append('# TYPE %s_queries_total counter' % p)
+      for (query, outcome), count in sorted(self.outcomes.items()):
+        lines.append('%s_queries_total{%s} %d' % (p, _labels([
+            ('query', query), ('outcome', outcome)]), count))
+      lines.append('# HELP %s_response_bytes_total Response body bytes '
+          'received' % p)
+      lines.append('# TYPE %s_response_bytes_total counter' % p)
+      for query, size in sorted(self.bytes.items()):
+        lines.append('%s_response_bytes_total{%s} %d' % (p,
+            _labels([('query', query)]), size))
+      lines.append('# HELP %s_documents_total Documents by protocol '
+          'version' % p)
+      lines.append('# TYPE %s_documents_total counter' % p)
+      for (query, version), count in sorted(self.versions.items(),
+          key=lambda item: (item[0][0], str(item[0][1]))):
+        lines.append('%s_documents_total{%s} %d' % (p, _labels([
+            ('query', query), ('version', version)]), count))
+    return "\n".join(lines) + "\n"
+
+  def __str__(self):
+    return "Metrics aggregator (%d queries)" % (sum(self.outcomes.values()),)
@@ -0,0 +1,544 @@
+"""
+Onion-Py local query engine
+
+Answers OnionOO details and summary queries from a complete details
+snapshot held in memory, following the parameter semantics documented at
+https://onionoo.torproject.org/protocol.html
+"""
+import base64
+import binascii
+import bisect
+import hashlib
+import operator
+import string
+
+
+class UnsupportedQueryError(Exception):
+  """ Raised for queries the local engine cannot answer like OnionOO would """
+  pass
+
+
+def _sha1_hex(fingerprint):
+  try:
+    return hashlib.sha1(binascii.unhexlify(fingerprint)).hexdigest().upper()
+  except (TypeError, ValueError):
+    return None
+
+
+def _address_host(address):
+  """ '1.2.3.4:9001' -> '1.2.3.4', '[::1]:9001' -> '[::1]' """
+  if address.startswith('['):
+    return address[:address.index(']') + 1]
+  return address.rsplit(':', 1)[0] if ':' in address else address
+
+
+def parse_bool(value):
+  value = str(value).lower()
+  if value not in ('true', 'false'):
+    raise ValueError("Invalid boolean value " + repr(value))
+  return value == 'true'
+
+
+def summarize_relay(relay):
+  """ Summary record for a details relay record """
+  addresses = []
+  for address in (relay.get('or_addresses') or []):
+    host = _address_host(address).strip('[]')
+    if host not in addresses:
+      addresses.append(host)
+  for address in (relay.get('exit_addresses') or []):
+    if address not in addresses:
+      addresses.append(address)
+  summary = {}
+  if relay.get('nickname') not in (None, 'Unnamed'):
+    summary['n'] = relay['nickname']
+  summary['f'] = relay.get('fingerprint')
+  summary['a'] = addresses
+  summary['r'] = relay.get('running')
+  return summary
+
+
+def summarize_bridge(bridge):
+  """ Summary record for a details bridge record """
+  summary = {}
+  if bridge.get('nickname') not in (None, 'Unnamed'):
+    summary['n'] = bridge['nickname']
+  summary['h'] = bridge.get('hashed_fingerprint')
+  summary['r'] = bridge.get('running')
+  return summary
+
+
+"""
+Sorted keys for prefix searches
+
+Args:
+  entries: (key, record) pairs; a record may appear under several keys
+"""
+class _PrefixIndex(object):
+  def __init__(self, entries):
+    entries = sorted(entries, key=operator.itemgetter(0))
+    self.keys = [key for key, record in entries]
+    self.records = [record for key, record in entries]
+
+  def match(self, prefix):
+    """ Records with a key starting with prefix """
+    start = bisect.bisect_left(self.keys, prefix)
+    end = bisect.bisect_left(self.keys, prefix + u'\uffff')
+    return set(self.records[start:end])
+
+
+"""
+Indexed details snapshot
+
+Built once per publication from an unfiltered details document. Holds
+inverted indexes from country, AS number and flag to records, and builds on
+first use:
+  - a fingerprint hash map (fingerprints, hashed and twice hashed
+    fingerprints, as accepted by the lookup parameter)
+  - the search indexes: sorted prefix indexes of the hex fingerprints
+    (including hashed fingerprints, as OnionOO's search matches those too),
+    base64 fingerprints, addresses and nickname suffixes (so any part of a
+    nickname is a prefix search), and a 4 hex character fingerprint block
+    index
+"""
+class SnapshotIndex(object):
+  QUERIES = ['details', 'summary']
+  SUPPORTED_PARAMS = ['type', 'running', 'search', 'lookup', 'country', 'as',
+      'flag', 'contact', 'fields', 'order', 'offset', 'limit']
+  ORDER_FIELDS = ['consensus_weight', 'first_seen']
+  HEADER_FIELDS = ['version', 'next_major_version_scheduled',
+      'relays_published', 'bridges_published']
+
+  def __init__(self, document):
+    self.header = dict((k, document.get(k)) for k in self.HEADER_FIELDS
+        if document.get(k) is not None)
+    self.relays = document.get('relays') or []
+    self.bridges = document.get('bridges') or []
+    self.published = (document.get('relays_published'),
+        document.get('bridges_published'))
+
+    self.countries = {}
+    self.as_numbers = {}
+    self.flags = {}
+    self._lookup = None
+    self._search = None
+
+    for i, relay in enumerate(self.relays):
+      key = ('relays', i)
+      if relay.get('country'):
+        self.countries.setdefault(relay['country'].lower(), []).append(i)
+      as_number = relay.get('as_number') or relay.get('as')
+      if as_number:
+        self.as_numbers.setdefault(self._as_key(as_number), []).append(i)
+      for flag in relay.get('flags') or []:
+        self.flags.setdefault(flag.lower(), set()).add(key)
+    for i, bridge in enumerate(self.bridges):
+      for flag in bridge.get('flags') or []:
+        self.flags.setdefault(flag.lower(), set()).add(('bridges', i))
+
+  def _fingerprints(self):
+    """ (key, fingerprint or hashed fingerprint, its hash) of every record """
+    for i, relay in enumerate(self.relays):
+      fp = (relay.get('fingerprint') or '').upper()
+      yield ('relays', i), fp, _sha1_hex(fp)
+    for i, bridge in enumerate(self.bridges):
+      hashed = (bridge.get('hashed_fingerprint') or '').upper()
+      yield ('bridges', i), hashed, _sha1_hex(hashed)
+
+  @property
+  def lookup(self):
+    """ Maps fingerprints and their (twice) hashed forms to records """
+    if self._lookup is None:
+      lookup = {}
+      for key, fp, hashed in self._fingerprints():
+        values = [fp, hashed]
+        if key[0] == 'relays' and hashed:
+          values.append(_sha1_hex(hashed))
+        for value in values:
+          if value:
+            lookup.setdefault(value, key)
+      self._lookup = lookup
+    return self._lookup
+
+  def _search_indexes(self):
+    """ The search indexes, built on the first search """
+    if self._search is None:
+      fingerprints, blocks = [], {}
+      for key, fp, hashed in self._fingerprints():
+        fingerprints.append((fp, key))
+        if hashed:
+          fingerprints.append((hashed, key))
+        for i in range(0, len(fp), 4):
+          blocks.setdefault(fp[i:i + 4], []).append(key)
+      nicknames, addresses, base64s = [], [], []
+      for kind, records in (('relays', self.relays),
+          ('bridges', self.bridges)):
+        for i, record in enumerate(records):
+          nickname = (record.get('nickname') or '').lower()
+          key = (kind, i)
+          nicknames.extend([(nickname[j:], key)
+              for j in range(len(nickname))])
+      for i, relay in enumerate(self.relays):
+        key = ('relays', i)
+        hosts = set([_address_host(a).strip('[]').lower()
+            for a in (relay.get('or_addresses') or [])] +
+            [a.lower() for a in (relay.get('exit_addresses') or [])])
+        addresses.extend((host, key) for host in hosts)
+        try:
+          base64s.append((base64.b64encode(binascii.unhexlify(
+              relay.get('fingerprint') or '')).decode('ascii').rstrip('='),
+              key))
+        except (TypeError, ValueError):
+          pass
+      self._search = {'fingerprints': _PrefixIndex(fingerprints),
+          'blocks': blocks, 'nicknames': _PrefixIndex(nicknames),
+          'addresses': _PrefixIndex(addresses),
+          'base64': _PrefixIndex(base64s)}
+    return self._search
+
+  @staticmethod
+  def _as_key(as_number):
+    as_number = str(as_number).upper()
+    return as_number[2:] if as_number.startswith('AS') else as_number
+
+  @staticmethod
+  def supports(query, params):
+    return query in SnapshotIndex.QUERIES and \
+        all(p in SnapshotIndex.SUPPORTED_PARAMS for p in params)
+
+  def _search_term(self, term):
+    if ':' in term and not term.startswith('['):
+      raise UnsupportedQueryError("Qualified search terms are not supported")
+    indexes = self._search_indexes()
+    lower = term.lower()
+    # onionoo matches any part of a nickname, not only its beginning
+    matches = indexes['nicknames'].match(lower)
+    fingerprint = term[1:] if term.startswith('$') else term
+    matches |= indexes['fingerprints'].match(fingerprint.upper())
+    if not term.startswith('$'):
+      # a block of a fingerprint written in space-separated groups of four
+      if len(term) == 4 and all(c in string.hexdigits for c in term):
+        matches.update(indexes['blocks'].get(term.upper(), ()))
+      matches |= indexes['addresses'].match(lower.lstrip('[').rstrip(']'))
+      matches |= indexes['base64'].match(term)
+    return matches
+
+  def select(self, params):
+    """
+    Evaluate the filtering parameters.
+
+    @rtype: tuple
+    @return: Lists of matching relay and bridge indexes, in snapshot order.
+    """
+    relays = set(range(len(self.relays)))
+    bridges = set(range(len(self.bridges)))
+
+    def restrict(keys):
+      relays.intersection_update(i for kind, i in keys if kind == 'relays')
+      bridges.intersection_update(i for kind, i in keys if kind == 'bridges')
+
+    if params.get('type') is not None:
+      kind = str(params['type']).lower()
+      if kind == 'relay':
+        bridges.clear()
+      elif kind == 'bridge':
+        relays.clear()
+      else:
+        raise ValueError("Invalid type " + repr(params['type']))
+    if params.get('running') is not None:
+      running = parse_bool(params['running'])
+      relays = set(i for i in relays
+          if (self.relays[i].get('running') is True) == running)
+      bridges = set(i for i in bridges
+          if (self.bridges[i].get('running') is True) == running)
+    if params.get('lookup') is not None:
+      keys = set()
+      for value in str(params['lookup']).split(','):
+        key = self.lookup.get(value.strip().lstrip('$').upper())
+        if key is not None:
+          keys.add(key)
+      restrict(keys)
+    if params.get('country') is not None:
+      relays.intersection_update(
+          self.countries.get(str(params['country']).lower(), ()))
+      bridges.clear()
+    if params.get('as') is not None:
+      relays.intersection_update(
+          self.as_numbers.get(self._as_key(params['as']), ()))
+      bridges.clear()
+    if params.get('flag') is not None:
+      restrict(self.flags.get(str(params['flag']).lower(), ()))
+    if params.get('contact') is not None:
+      contact = str(params['contact']).lower()
+      relays = set(i for i in relays
+          if contact in (self.relays[i].get('contact') or '').lower())
+      bridges.clear()
+    if params.get('search') is not None:
+      for term in str(params['search']).split():
+        restrict(self._search_term(term))
+    return sorted(relays), sorted(bridges)
+
+  def _order(self, records, indexes, order):
+    for field in reversed(order):
+      descending = field.startswith('-')
+      name = field.lstrip('-').lower()
+      if name not in self.ORDER_FIELDS:
+        raise ValueError("Invalid order field " + repr(field))
+      present = [i for i in indexes if records[i].get(name) is not None]
+      missing = [i for i in indexes if records[i].get(name) is None]
+      present.sort(key=lambda i: records[i][name], reverse=descending)
+      indexes = present + missing
+    return indexes
+
+  @staticmethod
+  def _project(record, fields):
+    if fields is None:
+      return record
+    return dict((k, v) for k, v in record.items() if k.lower() in fields)
+
+  def evaluate(self, query, params):
+    """
+    Answer a query from the snapshot.
+
+    @rtype: dict
+    @return: The raw document OnionOO would return.
+    @raise ValueError: on parameter values OnionOO would reject.
+    @raise UnsupportedQueryError: if the query needs OnionOO itself.
+    """
+    if not self.supports(query, params):
+      raise UnsupportedQueryError(
+          "Query cannot be answered from a details snapshot")
+    relays, bridges = self.select(params)
+
+    if params.get('order') is not None:
+      order = [o.strip() for o in str(params['order']).split(',') if o.strip()]
+      relays = self._order(self.relays, relays, order)
+      bridges = self._order(self.bridges, bridges, order)
+
+    # relays are skipped and kept first, then bridges
+    offset = int(params.get('offset') or 0)
+    if offset > 0:
+      skipped = min(offset, len(relays))
+      relays = relays[skipped:]
+      bridges = bridges[offset - skipped:]
+    if params.get('limit') is not None:
+      limit = max(int(params['limit']), 0)
+      relays = relays[:limit]
+      bridges = bridges[:max(limit - len(relays), 0)]
+
+    document = dict(self.header)
+    if query == 'summary':
+      document['relays'] = [summarize_relay(self.relays[i]) for i in relays]
+      document['bridges'] = [summarize_bridge(self.bridges[i]) for i in bridges]
+    else:
+      fields = None
+      if params.get('fields') is not None:
+        fields = set(f.strip().lower() for f in
+            str(params['fields']).split(','))
+      document['relays'] = [self._project(self.relays[i], fields)
+          for i in relays]
+      document['bridges'] = [self._project(self.bridges[i], fields)
+          for i in bridges]
+    return document
+
+
+# details fields a parameter reads when it is evaluated locally
+PARAM_FIELDS = {
+    'type': [],
+    'running': ['running'],
+    'lookup': ['fingerprint', 'hashed_fingerprint'],
+    'country': ['country'],
+    'as': ['as', 'as_number'],
+    'flag': ['flags'],
+    'contact': ['contact'],
+    'search': ['nickname', 'fingerprint', 'hashed_fingerprint',
+        'or_addresses', 'exit_addresses'],
+    }
+# details fields needed to build summary records
+SUMMARY_FIELDS = ['nickname', 'fingerprint', 'hashed_fingerprint',
+    'or_addresses', 'exit_addresses', 'running']
+WINDOW_PARAMS = ['fields', 'offset', 'limit']
+
+
+def _fields(params):
+  if params.get('fields') is None:
+    return None
+  return set(f.strip().lower() for f in str(params['fields']).split(',')
+      if f.strip())
+
+
+def _window(params):
+  offset = int(params.get('offset') or 0)
+  limit = params.get('limit')
+  return offset, None if limit is None else int(limit)
+
+
+def _filters(params):
+  return dict((k, v) for k, v in params.items() if k not in WINDOW_PARAMS)
+
+
+def derivation(query, params, base_query, base_params):
+  """
+  Work out how the answer to a query can be computed from the response to a
+  base query that has more fields, fewer filters or a larger offset/limit
+  window. Both parameter sets must be canonical (see
+  onion_py.manager.BaseManager.canonical_params).
+
+  @rtype: tuple
+  @return: ('window', start, stop, fields) if the answer is a slice of the
+  base response, or ('filter', params) if it is the base response evaluated
+  with the remaining parameters.
+  @raise UnsupportedQueryError: if the answer cannot be derived.
+  """
+  fields = _fields(params)
+  base_fields = _fields(base_params)
+
+  if query == base_query and _filters(params) == _filters(base_params):
+    # the fields parameter only applies to details documents
+    if query != 'details':
+      fields = None
+    elif base_fields is not None and (fields is None or
+        not fields <= base_fields):
+      raise UnsupportedQueryError("Base response lacks requested fields")
+    base_offset, base_limit = _window(base_params)
+    offset, limit = _window(params)
+    if offset < base_offset or (base_limit is not None and (limit is None or
+        offset + limit > base_offset + base_limit)):
+      raise UnsupportedQueryError("Base response window is too small")
+    start = offset - base_offset
+    return ('window', start, None if limit is None else start + limit, fields)
+
+  if base_query != 'details' or not SnapshotIndex.supports(query, params):
+    raise UnsupportedQueryError("Query cannot be derived locally")
+  if any(p in base_params for p in ('order', 'offset', 'limit')):
+    raise UnsupportedQueryError("Base response is ordered or truncated")
+  for param in base_params:
+    if param != 'fields' and param not in params:
+      raise UnsupportedQueryError("Base response is filtered by " + param)
+
+  residual = {}
+  for param, value in params.items():
+    base_value = base_params.get(param)
+    if param in WINDOW_PARAMS or param == 'order' or base_value is None:
+      residual[param] = value
+    elif value == base_value:
+      continue
+    elif param == 'lookup' and \
+        set(value.split(',')) <= set(base_value.split(',')):
+      residual[param] = value
+    elif param == 'search' and set(base_value.split()) <= set(value.split()):
+      base_terms = base_value.split()
+      residual[param] = " ".join(t for t in value.split()
+          if t not in base_terms)
+    else:
+      raise UnsupportedQueryError("Base response is filtered by " + param)
+
+  if base_fields is not None:
+    needed = set()
+    for param in residual:
+      needed.update(PARAM_FIELDS.get(param, []))
+    if residual.get('order') is not None:
+      needed.update(f.strip().lstrip('-')
+          for f in residual['order'].split(','))
+    if query == 'summary':
+      needed.update(SUMMARY_FIELDS)
+    elif fields is None:
+      raise UnsupportedQueryError("Base response lacks requested fields")
+    else:
+      needed.update(fields)
+    if not needed <= base_fields:
+      raise UnsupportedQueryError("Base response lacks requested fields")
+  return ('filter', residual)
+
+
+def derive(query, params, base_query, base_params, record, index = None):
+  """
+  Answer a query from the raw response to a base query (see derivation).
+
+  @type index: SnapshotIndex
+  @param index: index over record to evaluate filters with; callers deriving
+  many queries from the same response should pass it (built if None).
+  @rtype: dict
+  @return: The raw document OnionOO would return.
+  @raise UnsupportedQueryError: if the answer cannot be derived.
+  @raise ValueError: on parameter values OnionOO would reject.
+  """
+  plan = derivation(query, params, base_query, base_params)
+  if plan[0] == 'filter':
+    if index is None:
+      index = SnapshotIndex(record)
+    return index.evaluate(query, plan[1])
+
+  start, stop, fields = plan[1:]
+  records = [('relays', r) for r in record.get('relays') or []] + \
+      [('bridges', b) for b in record.get('bridges') or []]
+  document = dict((k, v) for k, v in record.items()
+      if k not in ('relays', 'bridges'))
+  for kind in ('relays', 'bridges'):
+    if kind in record:
+      document[kind] = [SnapshotIndex._project(r, fields)
+          for k, r in records[start:stop] if k == kind]
+  return document
+
+
+def _record_key(record):
+  for key in ('fingerprint', 'hashed_fingerprint', 'f', 'h'):
+    if record.get(key) is not None:
+      return record[key]
+  return None
+
+
+def compare_documents(local, remote):
+  """
+  Compare a locally computed raw document with the one OnionOO returned.
+
+  @rtype: list
+  @return: Human readable descriptions of the differences (empty if the
+  documents agree).
+  """
+  differences = []
+  for field in SnapshotIndex.HEADER_FIELDS:
+    if local.get(field) != remote.get(field):
+      differences.append("{}: {!r} != {!r}".format(field, local.get(field),
+        remote.get(field)))
+  for kind in ('relays', 'bridges'):
+    local_records = local.get(kind) or []
+    remote_records = remote.get(kind) or []
+    local_keys = [_record_key(r) for r in local_records]
+    remote_keys = [_record_key(r) for r in remote_records]
+    if local_keys != remote_keys:
+      missing = [k for k in remote_keys if k not in local_keys]
+      extra = [k for k in local_keys if k not in remote_keys]
+      if missing or extra:
+        differences.append("{}: missing {}, unexpected {}".format(kind,
+          missing, extra))
+      else:
+        differences.append("{}: different order".format(kind))
+      continue
+    for key, l, r in zip(local_keys, local_records, remote_records):
+      if l != r:
+        fields = sorted(k for k in set(l) | set(r) if l.get(k) != r.get(k))
+        differences.append("{} {}: fields differ: {}".format(kind, key,
+          ", ".join(fields)))
+  return differences
+
+
+def validate(snapshot, fetch_remote, queries):
+  """
+  Validation harness comparing local answers with remote (or recorded) ones.
+
+  @type snapshot: SnapshotIndex
+  @param fetch_remote: callable(query, params) returning the raw document
+  OnionOO returned for the same publication, e.g. loaded from a fixture.
+  @param queries: iterable of (query, params) tuples.
+  @rtype: list
+  @return: (query, params, differences) for every query whose answers differ.
+  """
+  failures = []
+  for query, params in queries:
+    remote = fetch_remote(query, params)
+    local = snapshot.evaluate(query, params)
+    differences = compare_documents(local, remote)
+    if differences:
+      failures.append((query, params, differences))
+  return failures
@@ -4,8 +4,24 @@ Onion-Py Manager
 Logic for interacting with OnionOO
 """
 import requests
+import requests.adapters
 import json
+import time
+import hashlib
+import binascii
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+try:
+  from urllib.parse import urlencode
+except ImportError:
+  from urllib import urlencode
 import onion_py.objects as o
+import onion_py.streaming as streaming
+import onion_py.local as local
+import onion_py.instrumentation as instr
+import onion_py.endpoints as endpoints
 
 class OnionPyError(Exception):
   pass
@@ -61,9 +77,13 @@ class ServiceUnavailableError(OnionPyError):
   pass
 
 """
-The main OnionOO api wrapper class.
+Shared OnionOO api logic.
+
+Parameter validation, cache freshness, response handling and document
+construction live here so that the blocking Manager and the asyncio based
+onion_py.aio.AsyncManager only differ in how they talk HTTP.
 """
-class Manager:
+class BaseManager(object):
   OOO_URL = 'https://onionoo.torproject.org/'
   OOO_SLUG = 'ONIONOO'
   OOO_VERSION_MAJOR = 4
@@ -86,7 +106,7 @@ class Manager:
       'as',
       'flag',
       'first_seen_days',
-      'last_seen_says',
+      'last_seen_days',
       'contact',
       'fields',
       'order',
@@ -94,18 +114,33 @@ class Manager:
       'limit'
       ]
 
-  """
-  The OnionOO constructor.
-
-  Args:
-    memcached_host: tuple (hostname, port) - if set to None, caching of responses in memcached will be disabled.
-    onionoo_host: hostname for the onionoo api endpoint - defaults to canonical onionoo.torproject.org
-  """
-  def __init__(self, cache = None, onionoo_host = None):
+  def __init__(self, cache = None, onionoo_host = None, timeout = (10, 60),
+      publication_interval = 3600, min_fresh = 60, max_fresh = None,
+      instrumentation = None):
     self.cache_client = cache
     self.onionoo_host = onionoo_host or self.OOO_URL
+    self.timeout = timeout
+    self.publication_interval = publication_interval
+    self.min_fresh = min_fresh
+    self.max_fresh = max_fresh
+    self.instrumentation = instrumentation
 
-  def query(self, query, **kwargs):
+  def _phase(self, query, phase):
+    """ Time a query phase (a shared no-op without instrumentation) """
+    if self.instrumentation is None:
+      return instr.NULL_TIMER
+    return instr.PhaseTimer(self.instrumentation, query, phase)
+
+  def _outcome(self, query, outcome):
+    if self.instrumentation is not None:
+      self.instrumentation.outcome(query, outcome)
+
+  def _transferred(self, query, size):
+    if self.instrumentation is not None:
+      self.instrumentation.transferred(query, size)
+
+  def _prepare(self, query, kwargs):
+    """ Validate a query and return the (canonical) request parameters """
     if query not in self.OOO_QUERIES:
       raise InvalidDocumentTypeError(query)
 
@@ -114,57 +149,891 @@ class Manager:
       if param not in self.OOO_QUERYPARAMS:
          raise InvalidParameterError(param)
 
-    params = kwargs
+    return self.canonical_params(kwargs)
+
+  @staticmethod
+  def canonical_params(params):
+    """
+    Normalise request parameters so that equivalent queries are equal (and
+    share a cache key): lists become comma-separated strings, the fields,
+    lookup and as lists and the search terms are de-duplicated and sorted,
+    values onionoo compares case-insensitively are lower-cased (fingerprints
+    upper-cased), 'AS' prefixes are dropped and unset parameters removed.
+    The order list keeps its order.
+
+    @rtype: dict
+    """
+    canonical = {}
+    for param, value in params.items():
+      if value is None:
+        continue
+      if isinstance(value, (list, tuple)):
+        value = ",".join(str(v) for v in value)
+      elif isinstance(value, bool):
+        value = 'true' if value else 'false'
+      else:
+        value = str(value)
+
+      if param in ('fields', 'lookup', 'as'):
+        values = set()
+        for v in value.split(','):
+          v = v.strip()
+          if param == 'fields':
+            v = v.lower()
+          elif param == 'lookup':
+            v = v.lstrip('$').upper()
+          else:
+            v = v.upper()
+            v = v[2:] if v.startswith('AS') else v
+          if v:
+            values.add(v)
+        value = ",".join(sorted(values))
+      elif param == 'order':
+        value = ",".join(v.strip().lower() for v in value.split(',')
+            if v.strip())
+      elif param == 'search':
+        value = " ".join(sorted(set(value.split())))
+      elif param in ('type', 'running', 'country', 'flag', 'contact'):
+        value = value.lower()
+      else:
+        value = value.strip()
+      canonical[param] = value
+    return canonical
+
+  def _check_status(self, status, reason, url):
+    """ Raise the error for a response that carries no document """
+    if status == 400:
+      raise BadRequestError("OnionPy did not accept our query: {} ({})".\
+          format(reason, url))
+    elif status in [500, 503]:
+      raise ServiceUnavailableError('OnionPy is down: {}'.format(reason))
+    # e.g. 501 for queries a server does not implement
+    raise OnionooError(status, "Unexpected response: {} ({})".format(reason,
+        url))
+
+  @staticmethod
+  def _decode(content):
+    # the body is already inflated by the http library; decoding the bytes
+    # ourselves skips charset detection on multi-megabyte bodies
+    return json.loads(content.decode('utf-8'))
+
+  def _expires(self, record, now):
+    """
+    Compute the end of the freshness window for a freshly (re)validated
+    response: onionoo will not publish anything new before the next
+    publication is due.
+    """
+    published = o.parse_timestamp(record.get('relays_published'))
+    if published is not None and self.publication_interval:
+      expires = published + self.publication_interval
+    else:
+      expires = now
+    expires = max(expires, now + self.min_fresh)
+    if self.max_fresh is not None:
+      expires = min(expires, now + self.max_fresh)
+    return expires
+
+  @staticmethod
+  def _fresh_record(cache_entry, now):
+    if cache_entry is not None and cache_entry.get('expires', 0) > now:
+      return cache_entry['record']
+    return None
+
+  @staticmethod
+  def _conditional_headers(cache_entry):
+    if cache_entry is None:
+      return None
+    headers = {}
+    if cache_entry.get('timestamp') is not None:
+      headers['If-Modified-Since'] = cache_entry['timestamp']
+    if cache_entry.get('etag') is not None:
+      headers['If-None-Match'] = cache_entry['etag']
+    return headers
+
+  def _process_response(self, cache_entry, now, status, headers, content,
+      reason, url):
+    """
+    Interpret the answer to a (conditional) request.
+
+    @rtype: tuple
+    @return: The raw result document and the cache entry that should be
+    stored for it.
+    @raise OnionPyError: for any status other than 200 and a 304 answering a
+    conditional request.
+    """
+    if status == 304 and cache_entry is not None:
+      result = cache_entry['record']
+      cache_entry['expires'] = self._expires(result, now)
+      cache_entry['timestamp'] = headers.get('Last-Modified',
+          cache_entry.get('timestamp'))
+      cache_entry['etag'] = headers.get('ETag', cache_entry.get('etag'))
+      return result, cache_entry
+    elif status == 200:
+      result = self._decode(content)
+      cache_entry = { 'timestamp': headers.get('Last-Modified'),
+          'etag': headers.get('ETag'),
+          'expires': self._expires(result, now),
+          'size': len(content),
+          'record': result }
+      return result, cache_entry
+    self._check_status(status, reason, url)
+
+  def _check_version(self, version):
+    versions = version.split('.')
+    if int(versions[0]) > self.OOO_VERSION_MAJOR:
+      raise MajorVersionMismatchError("Received OnionOO Document with version {}, this library only supports up to version {}".format(versions[0],self.OOO_VERSION_MAJOR))
+
+  def _build_document(self, query, result):
+    if result is not None:
+      with self._phase(query, 'build'):
+        document = self.OOO_QUERIES[query](result)
+      self._check_version(document.version)
+      if self.instrumentation is not None:
+        self.instrumentation.version(query, document.version)
+      return document
+    else:
+      return None
+
+"""
+A request in flight, shared by all threads asking the same query.
+"""
+class _Flight(object):
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+"""
+The main OnionOO api wrapper class.
+
+Managers are thread-safe: queries may be issued from any number of threads,
+and identical queries that miss the cache at the same time are sent to
+OnionOO once, with all callers receiving the result. Concurrent misses in
+other processes are serialised through the cache's per-key lock (see
+onion_py.caching.OnionCache.lock).
+"""
+class Manager(BaseManager):
+  # Conservative upper bound for request URLs built by lookup_many
+  MAX_URL_LENGTH = 2000
+  # Number of cached queries per document type considered for superset reuse
+  MAX_STORED_QUERIES = 256
+  # Number of cached responses kept indexed for answering derived queries
+  MAX_DERIVATION_INDEXES = 4
+  # Seconds to wait for another thread or process fetching the same query
+  LOCK_TIMEOUT = 90
+  # Threads running hedged requests to an endpoint pool
+  HEDGE_WORKERS = 16
+
+  """
+  The OnionOO constructor.
+
+  Args:
+    cache: OnionCache instance used to cache responses - if set to None, caching will be disabled.
+    onionoo_host: hostname for the onionoo api endpoint - defaults to canonical onionoo.torproject.org; a list of mirrors or an onion_py.endpoints.EndpointPool sends every request to the best performing mirror, failing over to the others
+    pool_connections: number of per-host connection pools to keep
+    pool_maxsize: maximum number of connections kept open per host
+    max_retries: number of times a failed connection attempt is retried
+    timeout: (connect, read) timeout in seconds passed to every request
+    keep_alive: reuse connections between queries
+    compression: ask onionoo for gzip/deflate encoded responses
+    publication_interval: seconds between two onionoo publications; cache entries are served without revalidation until relays_published + publication_interval
+    min_fresh: minimum number of seconds a (re)validated cache entry is served without revalidation, even if the next publication is overdue
+    max_fresh: upper bound on the freshness window in seconds (None for no bound)
+    snapshot: answer details and summary queries locally from one complete details document per publication
+    reuse_supersets: answer queries from a fresh cached response to a query with more fields, fewer filters or a larger window, see onion_py.local.derivation; off by default, as the local engine does not match OnionOO for every query (e.g. qualified search terms are sent to OnionOO, but other differences would be served as cache hits)
+    max_stale: serve cache entries up to max_stale seconds past their freshness window while they are revalidated in the background (0 to always wait for the revalidation)
+    instrumentation: onion_py.instrumentation.Instrumentation receiving per-query phase timings, outcomes and transfer sizes (None to disable)
+  """
+  def __init__(self, cache = None, onionoo_host = None, pool_connections = 4,
+      pool_maxsize = 10, max_retries = 0, timeout = (10, 60), keep_alive = True,
+      compression = True, publication_interval = 3600, min_fresh = 60,
+      max_fresh = None, snapshot = False, reuse_supersets = False,
+      max_stale = 0, instrumentation = None):
+    if isinstance(onionoo_host, (list, tuple)):
+      onionoo_host = endpoints.EndpointPool(onionoo_host)
+    self.endpoints = None
+    if isinstance(onionoo_host, endpoints.EndpointPool):
+      self.endpoints = onionoo_host
+      onionoo_host = onionoo_host.hosts[0]
+    self._hedge_executor = None
+    self._hedge_lock = threading.Lock()
+    BaseManager.__init__(self, cache, onionoo_host, timeout,
+        publication_interval, min_fresh, max_fresh, instrumentation)
+    self.snapshot = snapshot
+    self._snapshot = None
+    self._snapshot_expires = 0
+    self._snapshot_lock = threading.Lock()
+    self.reuse_supersets = reuse_supersets
+    self._stored = {}
+    self._stored_lock = threading.Lock()
+    self._indexes = OrderedDict()
+    self._inflight = {}
+    self._inflight_lock = threading.Lock()
+    self.max_stale = max_stale
+
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize, max_retries=max_retries)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+    self.session.headers['Accept-Encoding'] = \
+        'gzip, deflate' if compression else 'identity'
+    if not keep_alive:
+      self.session.headers['Connection'] = 'close'
+
+  def close(self):
+    """ Close all pooled connections """
+    with self._hedge_lock:
+      if self._hedge_executor is not None:
+        self._hedge_executor.shutdown(wait=False)
+        self._hedge_executor = None
+    self.session.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def pool_stats(self):
+    """
+    Connection pool statistics, per host.
+
+    @rtype: dict
+    @return: Maps 'scheme://host:port' to a dict holding the number of
+    connections opened, requests sent, requests that reused an already open
+    connection and connections currently idle in the pool.
+    """
+    stats = {}
+    adapters = []
+    for adapter in self.session.adapters.values():
+      if adapter not in adapters:
+        adapters.append(adapter)
+    for adapter in adapters:
+      pools = adapter.poolmanager.pools
+      for key in pools.keys():
+        pool = pools[key]
+        host = '{}://{}:{}'.format(pool.scheme, pool.host, pool.port)
+        stats[host] = {
+            'connections': pool.num_connections,
+            'requests': pool.num_requests,
+            'reused': max(pool.num_requests - pool.num_connections, 0),
+            'idle': self._idle_connections(pool)
+            }
+    return stats
+
+  @staticmethod
+  def _idle_connections(pool):
+    # the pool queue is pre-filled with None placeholders for connections
+    # that have not been opened yet
+    if pool.pool is None:
+      return 0
+    return len([c for c in list(pool.pool.queue) if c is not None])
+
+  def _get(self, url, params, headers = None, stream = False):
+    if stream:
+      return self.session.get(url, params=params, headers=headers,
+          timeout=self.timeout, stream=True)
+    return self.session.get(url, params=params, headers=headers,
+        timeout=self.timeout)
+
+  def _attempt(self, endpoint, query, params, headers, stream = False):
+    """
+    Send a request to one endpoint of the pool and record how it went. A
+    streamed response is timed up to its headers and its body is left
+    unread unless it is a server error.
+    """
+    start = instr.clock()
+    try:
+      r = self._get(endpoint.host + query, params, headers, stream)
+      if not stream or r.status_code in self.endpoints.RETRY_STATUSES:
+        r.content
+    except requests.RequestException:
+      self.endpoints.failure(endpoint)
+      raise
+    if r.status_code in self.endpoints.RETRY_STATUSES:
+      self.endpoints.failure(endpoint)
+    else:
+      self.endpoints.success(endpoint, instr.clock() - start)
+    return r
+
+  def _hedges(self):
+    with self._hedge_lock:
+      if self._hedge_executor is None:
+        self._hedge_executor = ThreadPoolExecutor(
+            max_workers=self.HEDGE_WORKERS)
+      return self._hedge_executor
+
+  def _get_pooled(self, query, params, headers, stream = False):
+    """
+    Send a request to the best endpoint of the pool, failing over to the
+    next one on server errors, timeouts and connection errors. With hedging,
+    a request outlasting its endpoint's hedging delay is duplicated to the
+    next endpoint and the first good answer is used. Streamed requests are
+    not hedged, as the losing response would have to be read or discarded.
+
+    @return: The response; the last server error response if all endpoints
+    failed.
+    @raise requests.RequestException: if all endpoints failed and the last
+    one did not answer.
+    """
+    pool = self.endpoints
+    candidates = pool.ranked()
+    failure = None
+    while candidates:
+      if failure is not None:
+        pool.record_failover()
+      endpoint = candidates.pop(0)
+      delay = pool.hedge_delay(endpoint) if candidates and not stream \
+          else None
+      if delay is None:
+        attempts = [endpoint]
+      else:
+        executor = self._hedges()
+        pending = [executor.submit(self._attempt, endpoint, query, params,
+            headers)]
+        done, _ = concurrent.futures.wait(pending, timeout=delay)
+        if not done:
+          pool.record_hedge()
+          pending.append(executor.submit(self._attempt, candidates.pop(0),
+              query, params, headers))
+        attempts = concurrent.futures.as_completed(pending)
+      for attempt in attempts:
+        try:
+          if delay is None:
+            r = self._attempt(attempt, query, params, headers, stream)
+          else:
+            r = attempt.result()
+        except requests.RequestException as e:
+          failure = e
+          continue
+        if r.status_code not in pool.RETRY_STATUSES:
+          return r
+        failure = r
+    if isinstance(failure, Exception):
+      raise failure
+    return failure
+
+  def _remember(self, query, params):
+    """ Note that the cache holds a response to a query """
+    key = tuple(sorted(params.items()))
+    with self._stored_lock:
+      stored = self._stored.setdefault(query, OrderedDict())
+      stored.pop(key, None)
+      stored[key] = params
+      if len(stored) > self.MAX_STORED_QUERIES:
+        stored.popitem(last=False)
+
+  def _derive(self, query, params, now):
+    """
+    Answer a query from a fresh cached response to a superset query.
 
-    # turn list params into comma-separated strings
-    for param in ['fields','order']:
-      if param in params and type(params[param]) is list:
-        params[param] = ",".join(params[param])
+    @rtype: dict
+    @return: The raw result document, or None.
+    """
+    candidates = []
+    with self._stored_lock:
+      for base_query in set([query, 'details']):
+        # most recently stored first
+        for base_params in reversed(list(self._stored.get(base_query,
+            {}).values())):
+          if base_query == query and base_params == params:
+            continue
+          try:
+            plan = local.derivation(query, params, base_query, base_params)
+          except local.UnsupportedQueryError:
+            continue
+          candidates.append((base_query, base_params, plan))
+    for base_query, base_params, plan in candidates:
+      record = self._fresh_record(self.cache_client.get(base_query,
+          base_params), now)
+      if record is None:
+        continue
+      index = None
+      if plan[0] == 'filter':
+        index = self._derivation_index(base_query, base_params, record)
+      try:
+        return local.derive(query, params, base_query, base_params, record,
+            index)
+      except (local.UnsupportedQueryError, ValueError):
+        continue
+    return None
 
-    # build request
-    url = self.onionoo_host + query
+  def _derivation_index(self, query, params, record):
+    """
+    The SnapshotIndex over a cached response, built once per response and
+    publication and shared by all queries derived from it.
 
+    @rtype: onion_py.local.SnapshotIndex
+    """
+    key = (query, tuple(sorted(params.items())))
+    published = (record.get('relays_published'),
+        record.get('bridges_published'))
+    with self._stored_lock:
+      index = self._indexes.pop(key, None)
+      if index is not None and index.published == published:
+        self._indexes[key] = index
+        return index
+    index = local.SnapshotIndex(record)
+    with self._stored_lock:
+      self._indexes.pop(key, None)
+      self._indexes[key] = index
+      while len(self._indexes) > self.MAX_DERIVATION_INDEXES:
+        self._indexes.popitem(last=False)
+    return index
+
+  def _fetch(self, query, params):
+    """ Fetch the raw result document for a validated query """
     # check for cache entry
     cache_entry = None
     if self.cache_client is not None:
-      cache_entry = self.cache_client.get(query, params)
-
-    result = None
-
-    if cache_entry is not None:
-      since = cache_entry['timestamp']
-      headers = {'If-Modified-Since': since}
-      r = requests.head(url, params=params, headers=headers)
-      if r.status_code == 304:
-        result = cache_entry['record']
-      elif r.status_code == 400:
-        raise BadRequestError("OnionPy did not accept our query: {} ({})".\
-            format(r.reason, r.url))
-      elif r.status_code in [500, 503]:
-        raise ServiceUnavailableError('OnionPy is down: {}'.format(r.reason))
+      with self._phase(query, 'cache_get'):
+        cache_entry = self.cache_client.get(query, params)
+
+    now = time.time()
+    result = self._fresh_record(cache_entry, now)
+    if result is not None:
+      self._outcome(query, 'hit')
+
+    if result is None and self.reuse_supersets and \
+        self.cache_client is not None:
+      with self._phase(query, 'derive'):
+        result = self._derive(query, params, now)
+      if result is not None:
+        self._outcome(query, 'derived')
+
+    if result is None and cache_entry is not None and self.max_stale and \
+        now < cache_entry.get('expires', 0) + self.max_stale:
+      # serve the previous entry while it is being revalidated
+      self._revalidate_in_background(query, params)
+      result = cache_entry['record']
+      self._outcome(query, 'stale')
 
     if result is None:
-      # Make full request
-      r = requests.get(url, params=params)
-      if r.status_code == 200:
-        result = r.json()
-        # Save to cache
-        if self.cache_client is not None:
-          cache_entry = { 'timestamp': r.headers['Last-Modified'],
-              'record': result }
-          self.cache_client.set(query, params, cache_entry)
-      elif r.status_code == 400:
-        raise BadRequestError("OnionPy did not accept our query: {} ({})".\
-            format(r.reason, r.url))
-      elif r.status_code in [500, 503]:
-        raise ServiceUnavailableError('OnionPy is down: {}'.format(r.reason))
+      # concurrent identical queries share a single request
+      result = self._single_flight(self._flight_key(query, params),
+          lambda: self._request(query, params))
 
-    if result is not None:
-      document = self.OOO_QUERIES[query](result)
+    return result
 
-      versions = document.version.split('.')
-      if int(versions[0]) > self.OOO_VERSION_MAJOR:
-        raise MajorVersionMismatchError("Received OnionOO Document with version {}, this library only supports up to version {}".format(versions[0],self.OOO_VERSION_MAJOR))
-      return document
+  @staticmethod
+  def _flight_key(query, params):
+    return (query, tuple(sorted(params.items())))
+
+  def _revalidate_in_background(self, query, params):
+    key = self._flight_key(query, params)
+    with self._inflight_lock:
+      if key in self._inflight:
+        return
+
+    def revalidate():
+      try:
+        self._single_flight(key, lambda: self._request(query, params))
+      except Exception:
+        # the entry stays stale; a later query tries again
+        pass
+    thread = threading.Thread(target=revalidate)
+    thread.daemon = True
+    thread.start()
+
+  def _single_flight(self, key, fetch):
+    """
+    Run fetch, unless a call for the same key is already running in another
+    thread; then wait for it and share its result (or exception).
+    """
+    with self._inflight_lock:
+      flight = self._inflight.get(key)
+      leader = flight is None
+      if leader:
+        flight = self._inflight[key] = _Flight()
+    if not leader:
+      self._outcome(key[0], 'coalesced')
+      flight.done.wait()
+      if flight.error is not None:
+        raise flight.error
+      return flight.result
+    try:
+      flight.result = fetch()
+    except Exception as e:
+      flight.error = e
+      raise
+    finally:
+      with self._inflight_lock:
+        del self._inflight[key]
+      flight.done.set()
+    return flight.result
+
+  def _cache_lock(self, query, params):
+    """
+    The cache's lock for a query. Caches implementing only get and set are
+    locked per key within this process, like OnionCache.lock does.
+    """
+    lock = getattr(self.cache_client, 'lock', None)
+    if lock is not None:
+      return lock(query, params, self.LOCK_TIMEOUT)
+    # onion_py.caching imports this module
+    from onion_py.caching import _key_locks, key_serializer
+    return _key_locks(self.cache_client).hold(key_serializer(query, params))
+
+  def _request(self, query, params, force = False):
+    """
+    Request a document, holding the cache's lock for the query. Unless
+    forced, a fresh cache entry stored in the meantime (by another process)
+    is used instead.
+    """
+    if self.cache_client is None:
+      return self._revalidate(query, params, None)
+    with self._cache_lock(query, params):
+      with self._phase(query, 'cache_get'):
+        cache_entry = self.cache_client.get(query, params)
+      result = None
+      if not force:
+        result = self._fresh_record(cache_entry, time.time())
+        if result is not None:
+          # stored by another process while we waited for the lock
+          self._outcome(query, 'hit')
+      if result is None:
+        result = self._revalidate(query, params, cache_entry)
+      return result
+
+  def refresh(self, query, **kwargs):
+    """
+    Revalidate the cached answer to a query with OnionOO now, even if it is
+    still fresh (used by onion_py.refresh.Refresher).
+
+    @rtype: Document
+    """
+    params = self._prepare(query, kwargs)
+    return self._build_document(query, self._single_flight(
+        self._flight_key(query, params),
+        lambda: self._request(query, params, force=True)))
+
+  def _revalidate(self, query, params, cache_entry):
+    """ Make a (conditional) request and cache the answer """
+    now = time.time()
+    previous = cache_entry['record'] if cache_entry is not None else None
+    headers = self._conditional_headers(cache_entry)
+    try:
+      with self._phase(query, 'download'):
+        if self.endpoints is not None:
+          r = self._get_pooled(query, params, headers)
+        else:
+          r = self._get(self.onionoo_host + query, params, headers)
+        content = r.content
+      self._transferred(query, len(content))
+      with self._phase(query, 'decode'):
+        result, cache_entry = self._process_response(cache_entry, now,
+            r.status_code, r.headers, content, r.reason, r.url)
+    except Exception:
+      self._outcome(query, 'error')
+      raise
+    if previous is not None and result is not previous and \
+        self._outdated(query, result, previous, r.url):
+      return previous
+    else:
+      self._outcome(query, 'not_modified' if r.status_code == 304 else 'miss')
+    # Save to cache
+    if cache_entry is not None and self.cache_client is not None:
+      with self._phase(query, 'cache_set'):
+        self.cache_client.set(query, params, cache_entry)
+      self._remember(query, params)
+    return result
+
+  def _outdated(self, query, result, previous, url):
+    """
+    Check whether a response carries an older publication than the cached
+    one, i.e. it came from a mirror lagging behind. The lagging mirror is
+    recorded and the newer answer should be kept.
+
+    @rtype: bool
+    """
+    if (result.get('relays_published') or '') >= \
+        (previous.get('relays_published') or ''):
+      return False
+    self._outcome(query, 'outdated')
+    if self.endpoints is not None:
+      endpoint = self.endpoints.endpoint_for(url)
+      if endpoint is not None:
+        self.endpoints.lagging(endpoint)
+    return True
+
+  def query(self, query, **kwargs):
+    params = self._prepare(query, kwargs)
+    with self._phase(query, 'total'):
+      return self._query(query, params)
+
+  def _query(self, query, params):
+    if self.snapshot and local.SnapshotIndex.supports(query, params):
+      index = self.snapshot_index()
+      if index is not None:
+        try:
+          with self._phase(query, 'derive'):
+            result = index.evaluate(query, params)
+        except local.UnsupportedQueryError:
+          pass
+        except ValueError as e:
+          raise BadRequestError("OnionPy did not accept our query: {}".\
+              format(e))
+        else:
+          self._outcome(query, 'snapshot')
+          return self._build_document(query, result)
+
+    return self._build_document(query, self._fetch(query, params))
+
+  def snapshot_index(self):
+    """
+    The local index over the complete details document of the current
+    publication. The document is fetched (through the cache) at most once
+    per freshness window and indexed once per publication.
+
+    @rtype: onion_py.local.SnapshotIndex
+    @return: The index, or None if OnionOO did not return a document.
+    """
+    with self._snapshot_lock:
+      now = time.time()
+      if self._snapshot is not None and self._snapshot_expires > now:
+        return self._snapshot
+      record = self._fetch('details', {})
+      if record is None:
+        return None
+      published = (record.get('relays_published'),
+          record.get('bridges_published'))
+      if self._snapshot is None or self._snapshot.published != published:
+        self._snapshot = local.SnapshotIndex(record)
+      self._snapshot_expires = self._expires(record, now)
+      return self._snapshot
+
+  def iter_query(self, query, chunk_size = 65536, **kwargs):
+    """
+    Query OnionOO and parse the response incrementally.
+
+    Fresh or revalidated (304) cache entries are streamed from the cache;
+    anything else is parsed while it is downloaded and is not written to the
+    cache, so memory use does not depend on the size of the document. With
+    an endpoint pool the request fails over like any other, but is not
+    hedged; a mirror answering with an older publication than the cached
+    one is recorded as lagging and the cache entry is streamed instead.
+
+    @rtype: onion_py.streaming.DocumentStream
+    @return: A stream whose header fields are set and which yields the relay
+    and bridge objects one at a time.
+    """
+    params = self._prepare(query, kwargs)
+    document_class = self.OOO_QUERIES[query]
+
+    cache_entry = None
+    if self.cache_client is not None:
+      with self._phase(query, 'cache_get'):
+        cache_entry = self.cache_client.get(query, params)
+
+    now = time.time()
+    record = self._fresh_record(cache_entry, now)
+    if record is not None:
+      self._outcome(query, 'hit')
     else:
+      # streamed bodies are neither timed nor counted
+      headers = self._conditional_headers(cache_entry)
+      if self.endpoints is not None:
+        r = self._get_pooled(query, params, headers, stream=True)
+      else:
+        r = self._get(self.onionoo_host + query, params, headers, stream=True)
+      if r.status_code == 200:
+        chunks = streaming.decode_chunks(r.iter_content(chunk_size))
+        stream = streaming.DocumentStream(document_class,
+            streaming.DocumentParser(chunks).events(), r.close)
+        if cache_entry is not None and self._outdated(query,
+            {'relays_published': stream.relays_published},
+            cache_entry['record'], r.url):
+          stream.close()
+          record = cache_entry['record']
+        else:
+          self._outcome(query, 'miss')
+      else:
+        self._outcome(query, 'not_modified' if r.status_code == 304
+            else 'error')
+        r.close()
+        record, cache_entry = self._process_response(cache_entry, now,
+            r.status_code, r.headers, b'', r.reason, r.url)
+        self.cache_client.set(query, params, cache_entry)
+        self._remember(query, params)
+    if record is not None:
+      stream = streaming.DocumentStream(document_class,
+          streaming.record_events(record))
+
+    self._check_version(stream.version)
+    return stream
+
+  @staticmethod
+  def _published(record):
+    return (record.get('relays_published') or '',
+        record.get('bridges_published') or '')
+
+  def query_sharded(self, query, shards = 4, max_attempts = 3, **kwargs):
+    """
+    Fetch a document as parallel offset/limit shards and merge them.
+
+    The records are counted with a summary query first, and the shards are
+    then fetched concurrently (and cached) like any other query. Shards that
+    were answered from a different publication than the newest one are
+    revalidated until all of them agree, so the merged document holds the
+    same records as a single fetch of the whole document.
+
+    @rtype: Document
+    @raise DataError: if the shards still disagree on the publication after
+    max_attempts rounds of revalidation.
+    """
+    params = self._prepare(query, kwargs)
+    offset = int(params.get('offset') or 0)
+    limit = int(params['limit']) if params.get('limit') is not None else None
+
+    count_params = dict((k, v) for k, v in params.items()
+        if k not in ('fields', 'order'))
+    counted = self._fetch('summary', count_params) or {}
+    total = len(counted.get('relays') or []) + \
+        len(counted.get('bridges') or [])
+    shards = max(min(shards, total), 1)
+    if shards == 1:
+      return self._build_document(query, self._fetch(query, params))
+
+    size = (total + shards - 1) // shards
+    shard_params = []
+    for i in range(shards):
+      p = dict(params)
+      p['offset'] = str(offset + i * size)
+      if i < shards - 1:
+        p['limit'] = str(size)
+      elif limit is not None:
+        p['limit'] = str(limit - i * size)
+      else:
+        # the last shard picks up records published since counting
+        p.pop('limit', None)
+      shard_params.append(p)
+
+    def refetch(i):
+      return self._single_flight(self._flight_key(query, shard_params[i]),
+          lambda: self._request(query, shard_params[i], force=True))
+
+    with ThreadPoolExecutor(max_workers=shards) as executor:
+      results = list(executor.map(lambda p: self._fetch(query, p),
+          shard_params))
+      for attempt in range(max_attempts + 1):
+        if any(r is None for r in results):
+          raise DataError("OnionOO returned no document for a shard")
+        published = [self._published(r) for r in results]
+        newest = max(published)
+        stale = [i for i, p in enumerate(published) if p != newest]
+        if not stale:
+          break
+        if attempt == max_attempts:
+          raise DataError("Shards of the {} document straddle publications "
+              "{}".format(query, sorted(set(published))))
+        for i, result in zip(stale, list(executor.map(refetch, stale))):
+          results[i] = result
+
+    record = dict((k, v) for k, v in results[0].items()
+        if k not in ('relays', 'bridges'))
+    for kind in ('relays', 'bridges'):
+      if any(kind in r for r in results):
+        record[kind] = [item for r in results for item in r.get(kind) or []]
+    return self._build_document(query, record)
+
+  @staticmethod
+  def _normalize_fingerprint(fingerprint):
+    return fingerprint.strip().lstrip('$').upper()
+
+  @staticmethod
+  def _hash_fingerprint(fingerprint):
+    try:
+      return hashlib.sha1(binascii.unhexlify(fingerprint)).hexdigest().upper()
+    except (TypeError, ValueError):
       return None
+
+  @staticmethod
+  def _record_fingerprint(record):
+    return getattr(record, 'fingerprint', None) or \
+        getattr(record, 'hashed_fingerprint', None) or \
+        getattr(record, 'hash', None)
+
+  def _lookup_chunks(self, url, fingerprints, params):
+    """
+    Split fingerprints into comma-separated lookup values that keep the
+    request URL below MAX_URL_LENGTH.
+    """
+    base = len(url) + len('?lookup=') + len(urlencode(sorted(params.items())))
+    # every fingerprint costs its own length plus an encoded comma ('%2C')
+    per_chunk = max((self.MAX_URL_LENGTH - base) // 43, 1)
+    return [",".join(fingerprints[i:i + per_chunk])
+        for i in range(0, len(fingerprints), per_chunk)]
+
+  def lookup_many(self, fingerprints, doc_type = 'details', fields = None,
+      max_workers = 4, **kwargs):
+    """
+    Look up many relays and/or bridges with as few requests as possible.
+
+    The fingerprints are packed into comma-separated lookup parameters as long
+    as the URL allows and the resulting chunks are queried concurrently.
+    Relays may be given by fingerprint or hashed fingerprint, bridges by
+    hashed fingerprint or fingerprint.
+
+    @rtype: dict
+    @return: Maps every requested (upper case, '$'-stripped) fingerprint to the
+    matching relay or bridge object, or to None if onionoo did not return it.
+    """
+    if doc_type not in self.OOO_QUERIES:
+      raise InvalidDocumentTypeError(doc_type)
+    for param in kwargs.keys():
+      if param not in self.OOO_QUERYPARAMS or param == 'lookup':
+        raise InvalidParameterError(param)
+
+    requested = []
+    for fingerprint in fingerprints:
+      fingerprint = self._normalize_fingerprint(fingerprint)
+      if fingerprint not in requested:
+        requested.append(fingerprint)
+
+    params = dict(kwargs)
+    if fields is not None:
+      if type(fields) is not list:
+        fields = fields.split(',')
+      # we need the fingerprints to match the answers to the questions
+      for field in ['fingerprint', 'hashed_fingerprint']:
+        if field not in fields:
+          fields = fields + [field]
+      params['fields'] = ",".join(fields)
+
+    # map every value onionoo might report back to the requested fingerprint
+    index = {}
+    for fingerprint in requested:
+      index[fingerprint] = fingerprint
+      hashed = self._hash_fingerprint(fingerprint)
+      if hashed is not None:
+        index.setdefault(hashed, fingerprint)
+
+    def fetch(lookup):
+      chunk_params = dict(params)
+      chunk_params['lookup'] = lookup
+      return self.query(doc_type, **chunk_params)
+
+    hosts = self.endpoints.hosts if self.endpoints is not None else \
+        [self.onionoo_host]
+    chunks = self._lookup_chunks(max(hosts, key=len) + doc_type, requested,
+        params)
+    if len(chunks) == 1:
+      documents = [fetch(chunks[0])]
+    else:
+      with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        documents = list(executor.map(fetch, chunks))
+
+    results = dict((fingerprint, None) for fingerprint in requested)
+    for document in documents:
+      if document is None:
+        continue
+      for record in list(document.relays or []) + list(document.bridges or []):
+        key = self._record_fingerprint(record)
+        if key is None:
+          continue
+        key = key.upper()
+        match = index.get(key) or index.get(self._hash_fingerprint(key))
+        if match is not None:
+          results[match] = record
+    return results
@@ -4,6 +4,117 @@ Class wrappers for the OnionOO objects
 
 import string
 import re
+import time
+import calendar
+from collections import OrderedDict
+try:
+  from collections.abc import Sequence
+except ImportError:
+  from collections import Sequence
+
+def parse_timestamp(timestamp):
+  """
+  Parse an OnionOO UTC timestamp ("YYYY-MM-DD hh:mm:ss").
+
+  @rtype: int
+  @return: Seconds since the epoch, or None if no timestamp was given.
+  """
+  if timestamp is None:
+    return None
+  return calendar.timegm(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S'))
+
+"""
+Lazy record sequence
+
+Documents keep the raw records as received from OnionOO and only build the
+wrapper object for a record when it is accessed. The most recently used
+objects are kept around so repeated access to the same record is cheap;
+others are rebuilt from the raw record on every access, so changes made to
+a record object are lost once it is evicted (change raw instead).
+
+Compares equal to a list or tuple of the same record objects and to a
+RecordList over equal raw records; + concatenates into a plain list. Use
+to_list() (the raw records) to serialise it, e.g. with json.dumps.
+
+  - raw: the list of raw record dicts
+  - record_class: class wrapping a single record
+  - cache_size: number of built objects to keep (0 disables the cache)
+"""
+class RecordList(Sequence):
+  CACHE_SIZE = 128
+
+  def __init__(self, records, record_class, cache_size = None):
+    self.raw = records
+    self.record_class = record_class
+    self.cache_size = self.CACHE_SIZE if cache_size is None else cache_size
+    self._cache = OrderedDict()
+
+  def __len__(self):
+    return len(self.raw)
+
+  def _build(self, index):
+    record = self._cache.pop(index, None)
+    if record is not None:
+      # move to the most recently used end
+      self._cache[index] = record
+    else:
+      record = self.record_class(self.raw[index])
+      if self.cache_size > 0:
+        self._cache[index] = record
+        while len(self._cache) > self.cache_size:
+          try:
+            self._cache.popitem(last=False)
+          except KeyError:
+            # emptied by a concurrent reader
+            break
+    return record
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self._build(i) for i in range(*index.indices(len(self.raw)))]
+    if index < 0:
+      index += len(self.raw)
+    if index < 0 or index >= len(self.raw):
+      raise IndexError("record index out of range")
+    return self._build(index)
+
+  def __iter__(self):
+    # a full pass would only churn the cache, so build without it
+    cache = self._cache
+    record_class = self.record_class
+    for i, raw in enumerate(self.raw):
+      record = cache.get(i)
+      yield record if record is not None else record_class(raw)
+
+  def __eq__(self, other):
+    if isinstance(other, RecordList):
+      return self.record_class is other.record_class and self.raw == other.raw
+    if isinstance(other, (list, tuple)):
+      return list(self) == list(other)
+    return NotImplemented
+
+  def __ne__(self, other):
+    equal = self.__eq__(other)
+    return equal if equal is NotImplemented else not equal
+
+  __hash__ = None
+
+  def __add__(self, other):
+    if not isinstance(other, (RecordList, list, tuple)):
+      return NotImplemented
+    return list(self) + list(other)
+
+  def __radd__(self, other):
+    if not isinstance(other, (list, tuple)):
+      return NotImplemented
+    return list(other) + list(self)
+
+  def to_list(self):
+    """ JSON-serialisable form: the raw records as received from OnionOO """
+    return self.raw
+
+  def __repr__(self):
+    return "<%d lazy %s records>" % (len(self.raw), self.record_class.__name__)
 
 """
 Relay summary field
@@ -14,7 +125,9 @@ The relay summary contains:
   - addresses
   - running
 """
-class RelaySummary:
+class RelaySummary(object):
+  __slots__ = ('nickname', 'fingerprint', 'addresses', 'running')
+
   def __init__(self, document):
     self.nickname = document.get('n')
     self.fingerprint = document.get('f')
@@ -33,7 +146,9 @@ The bridge summary contains:
   - hash
   - running
 """
-class BridgeSummary:
+class BridgeSummary(object):
+  __slots__ = ('nickname', 'hash', 'running')
+
   def __init__(self, document):
     self.nickname = document.get('n')
     self.hash = document.get('h')
@@ -41,7 +156,7 @@ class BridgeSummary:
 
   def __str__(self):
     return "Bridge summary for %s (%s) " % \
-      (self.nickname or "<Not named>", self.fingerprint or "<No fingerprint>")
+      (self.nickname or "<Not named>", self.hash or "<No fingerprint>")
 
 """
 Summary document
@@ -58,13 +173,18 @@ The summary document contains:
 
 """
 class Summary:
+  relay_class = RelaySummary
+  bridge_class = BridgeSummary
+
   def __init__(self, document):
     self.version = document.get('version')
     self.next_major_version_scheduled = document.get('next_major_version_scheduled')
     self.relays_published = document.get('relays_published')
     self.bridges_published = document.get('bridges_published')
-    self.relays = [RelaySummary(d) for d in document.get('relays')]
-    self.bridges = [BridgeSummary(d) for d in document.get('bridges')]
+    self.relays = RecordList(document.get('relays'), RelaySummary) if \
+        document.get('relays') is not None else None
+    self.bridges = RecordList(document.get('bridges'), BridgeSummary) if \
+        document.get('bridges') is not None else None
 
   def __str__(self):
     return "Summary document (%d bridges, %d relays)" % \
@@ -98,13 +218,23 @@ The relay detail contains:
   - contact
   - platform
   - recommended_version
+  - family
   - effective_family
   - consensus_weight_fraction
   - guard_probability
   - middle_probability
   - exit_probability
 """
-class RelayDetails:
+class RelayDetails(object):
+  __slots__ = ('nickname', 'fingerprint', 'or_addresses', 'exit_addresses',
+      'dir_address', 'last_seen', 'last_changed_address_or_port', 'first_seen',
+      'running', 'hibernating', 'flags', 'geo', 'as_number', 'as_name',
+      'consensus_weight', 'host_name', 'last_restarted', 'bandwidth',
+      'exit_policy', 'exit_policy_summary', 'exit_policy_v6_summary', 'contact',
+      'platform', 'recommended_version', 'family', 'effective_family',
+      'consensus_weight_fraction', 'guard_probability', 'middle_probability',
+      'exit_probability', '_policies')
+
   def __init__(self, document):
     g = document.get
     self.nickname = g('nickname')
@@ -133,11 +263,13 @@ class RelayDetails:
     self.contact = g('contact')
     self.platform = g('platform')
     self.recommended_version = g('recommended_version')
+    self.family = g('family')
     self.effective_family = g('effective_family')
     self.consensus_weight_fraction = g('consensus_weight_fraction')
     self.guard_probability = g('guard_probability')
     self.middle_probability = g('middle_probability')
     self.exit_probability = g('exit_probability')
+    self._policies = None
 
   def is_stable(self):
     return self.flags is not None and 'Stable' in self.flags
@@ -151,22 +283,23 @@ class RelayDetails:
     else:
       return None
 
-  def check_exitport(self):
-    def in_ports(ports):
-      for entry in ports:
-        if entry == '80':
-          return True
-        elif '-' in entry:
-          [x,y] = entry.split('-')
-          if 80 in range(int(x), int(y)):
-            return True
-      return False
-
-    if 'accept' in self.exit_policy_summary:
-      return in_ports(self.exit_policy_summary['accept'])
-    elif 'reject' in self.exit_policy_summary:
-      return not in_ports(self.exit_policy_summary['reject'])
-    return False
+  def compiled_exit_policy(self, ipv6 = False):
+    """
+    The compiled exit policy summary.
+
+    @rtype: onion_py.exitpolicy.PortPolicy
+    """
+    if self._policies is None:
+      from onion_py.exitpolicy import compile_policy
+      self._policies = (compile_policy(self.exit_policy_summary),
+          compile_policy(self.exit_policy_v6_summary))
+    return self._policies[1 if ipv6 else 0]
+
+  def allows_port(self, port, ipv6 = False):
+    return self.compiled_exit_policy(ipv6).allows(port)
+
+  def check_exitport(self, port = 80):
+    return self.allows_port(port)
 
   def parse_email(self):
     """
@@ -219,7 +352,11 @@ The bridge detail contains:
   - platform
   - transports
 """
-class BridgeDetails:
+class BridgeDetails(object):
+  __slots__ = ('nickname', 'hashed_fingerprint', 'or_addresses', 'last_seen',
+      'first_seen', 'running', 'flags', 'last_restarted',
+      'advertised_bandwidth', 'platform', 'transports')
+
   def __init__(self, document):
     g = document.get
     self.nickname = g('nickname')
@@ -254,18 +391,31 @@ The details document contains:
   - bridges: bridge details
 """
 class Details:
+  relay_class = RelayDetails
+  bridge_class = BridgeDetails
+
   def __init__(self, document):
     self.version = document.get('version')
     self.next_major_version_scheduled = document.get('next_major_version_scheduled')
     self.relays_published = document.get('relays_published')
     self.bridges_published = document.get('bridges_published')
-    self.relays = [RelayDetails(d) for d in document.get('relays')]
-    self.bridges = [BridgeDetails(d) for d in document.get('bridges')]
+    self.relays = RecordList(document.get('relays'), RelayDetails) if \
+        document.get('relays') is not None else None
+    self.bridges = RecordList(document.get('bridges'), BridgeDetails) if \
+        document.get('bridges') is not None else None
 
   def __str__(self):
     return "Details document (%d bridges, %d relays)" % \
       (len(self.bridges or []),len(self.relays or []))
 
+def _numpy():
+  try:
+    import numpy
+    return numpy
+  except ImportError:
+    from onion_py.caching import DependencyError
+    raise DependencyError("Error importing numpy library for history analysis")
+
 """
 Graph history object
 
@@ -276,8 +426,14 @@ Graph history contains:
   - factor
   - count
   - values
+
+The values are normalised integers; the array methods (which require numpy)
+apply factor and the timing information for you.
 """
-class GraphHistory:
+class GraphHistory(object):
+  __slots__ = ('first', 'last', 'interval', 'factor', 'count', 'values',
+      '_decoded')
+
   def __init__(self, document):
     g = document.get
     self.first = g('first')
@@ -286,11 +442,130 @@ class GraphHistory:
     self.factor = g('factor')
     self.count = g('count')
     self.values = g('values')
+    self._decoded = None
     #TODO: support additional statistic fields carried in history objects (countries, transports, versions)
 
+  def decoded(self):
+    """
+    Decode the history values.
+
+    @rtype: numpy.ndarray
+    @return: float64 array of values * factor, with NaN for missing values.
+    """
+    if self._decoded is None:
+      np = _numpy()
+      values = np.array(self.values or [], dtype=np.float64)
+      self._decoded = values * (self.factor if self.factor is not None else 1)
+    return self._decoded
+
+  def _timed(self):
+    """ Whether the values can be placed in time """
+    return self.first is not None and bool(self.interval)
+
+  def timestamps(self):
+    """
+    Timestamps of the history values.
+
+    @rtype: numpy.ndarray
+    @return: int64 array of seconds since the epoch, one per value (empty
+    if first or interval is missing). Use .astype('datetime64[s]') for
+    datetimes.
+    """
+    np = _numpy()
+    if not self._timed():
+      return np.zeros(0, dtype=np.int64)
+    return parse_timestamp(self.first) + \
+        np.arange(len(self.values or []), dtype=np.int64) * self.interval
+
+  def sum(self):
+    """ Sum of all present decoded values """
+    np = _numpy()
+    return float(np.nansum(self.decoded()))
+
+  def mean(self):
+    """ Mean of all present decoded values (NaN if there are none) """
+    np = _numpy()
+    values = self.decoded()
+    present = np.count_nonzero(~np.isnan(values))
+    if present == 0:
+      return float('nan')
+    return float(np.nansum(values)) / present
+
+  def percentile(self, q):
+    """ q-th percentile(s) of the present decoded values """
+    np = _numpy()
+    values = self.decoded()
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+      return float('nan')
+    return np.percentile(values, q)
+
+  def resample(self, interval, how = 'mean'):
+    """
+    Resample the history into buckets of interval seconds, aligned to the
+    epoch.
+
+    @type how: str
+    @param how: 'mean' or 'sum' of the present values in each bucket.
+    @rtype: tuple
+    @return: (timestamps, values) arrays; buckets without present values
+    are NaN.
+    """
+    if how not in ('mean', 'sum'):
+      raise ValueError("Unsupported resampling method " + repr(how))
+    np = _numpy()
+    values = self.decoded()
+    timestamps = self.timestamps()
+    if len(timestamps) == 0:
+      return timestamps, values[:0]
+    buckets = timestamps // interval
+    first_bucket = buckets[0]
+    index = buckets - first_bucket
+    present = ~np.isnan(values)
+    sums = np.bincount(index, weights=np.where(present, values, 0.0))
+    counts = np.bincount(index, weights=present.astype(np.float64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+      result = sums / counts if how == 'mean' else \
+          np.where(counts > 0, sums, np.nan)
+    return (first_bucket + np.arange(len(sums), dtype=np.int64)) * interval, \
+        result
+
   def __str__(self):
     return "Graph history object"
 
+def stack_histories(histories):
+  """
+  Align many graph histories with the same interval on a common time grid.
+
+  @type histories: list
+  @param histories: GraphHistory objects (None entries give all-NaN rows).
+  @rtype: tuple
+  @return: (timestamps, matrix) where matrix has one row of decoded values
+  per history and NaN where a history has no value, so statistics over all
+  relays can be computed with numpy's nan-aware reductions along axis 1.
+  """
+  np = _numpy()
+  present = [h for h in histories if h is not None and h.values and
+      h._timed()]
+  intervals = set(h.interval for h in present)
+  if len(intervals) > 1:
+    raise ValueError("Cannot stack histories with different intervals")
+  if not present:
+    return np.zeros(0, dtype=np.int64), \
+        np.full((len(histories), 0), np.nan)
+  interval = intervals.pop()
+  starts = [parse_timestamp(h.first) for h in present]
+  start = min(starts)
+  end = max(s + len(h.values) * interval for s, h in zip(starts, present))
+  matrix = np.full((len(histories), (end - start) // interval), np.nan)
+  starts = iter(starts)
+  for row, h in enumerate(histories):
+    if h is None or not h.values or not h._timed():
+      continue
+    offset = (next(starts) - start) // interval
+    matrix[row, offset:offset + len(h.values)] = h.decoded()
+  return start + np.arange(matrix.shape[1], dtype=np.int64) * interval, matrix
+
 """
 Bandwidth object
 
@@ -299,16 +574,23 @@ The bandwidth object contains:
   - write_history
   - read_history
 """
-class BandwidthDetail:
+class BandwidthDetail(object):
+  __slots__ = ('fingerprint', 'write_history', 'read_history')
+
   def __init__(self, document):
     g = document.get
-    self.finger_print = g('fingerprint')
+    self.fingerprint = g('fingerprint')
     self.write_history = dict([(k, GraphHistory(v)) for k,v in
       g('write_history').items()]) if g('write_history') is not None else None
     self.read_history = dict([(k, GraphHistory(v)) for k,v in
       g('read_history').items()]) if g('read_history') is not None else None
 
 
+  @property
+  def finger_print(self):
+    """ Deprecated spelling of fingerprint, kept for compatibility """
+    return self.fingerprint
+
   def __str__(self):
     return "Bandwidth object"
 
@@ -326,14 +608,19 @@ The bandwidth document contains:
   - bridges
 """
 class Bandwidth:
+  relay_class = BandwidthDetail
+  bridge_class = BandwidthDetail
+
   def __init__(self,document):
     g = document.get
     self.version = g('version')
     self.next_major_version_scheduled = g('next_major_version_scheduled')
     self.relays_published = g('relays_published')
     self.bridges_published = g('bridges_published')
-    self.relays = [BandwidthDetail(d) for d in g('relays')]
-    self.bridges = [BandwidthDetail(d) for d in g('bridges')]
+    self.relays = RecordList(g('relays'), BandwidthDetail) if \
+        g('relays') is not None else None
+    self.bridges = RecordList(g('bridges'), BandwidthDetail) if \
+        g('bridges') is not None else None
 
   def __str__(self):
     return "Bandwidth document (histories of %d bridges and %d relays)" % \
@@ -350,7 +637,10 @@ The relay weight object contains:
   - exit_probability
   - consensus_weight
 """
-class RelayWeight:
+class RelayWeight(object):
+  __slots__ = ('fingerprint', 'consensus_weight_fraction', 'guard_probability',
+      'middle_probability', 'exit_probability', 'consensus_weight')
+
   def __init__(self, document):
     g = document.get
     self.fingerprint = g('fingerprint')
@@ -388,13 +678,16 @@ The weights document contains:
   - bridges
 """
 class Weights:
+  relay_class = RelayWeight
+  bridge_class = None
+
   def __init__(self,document):
     g = document.get
     self.version = g('version')
     self.next_major_version_scheduled = g('next_major_version_scheduled')
     self.relays_published = g('relays_published')
     self.bridges_published = g('bridges_published')
-    self.relays = [RelayWeight(d) for d in g('relays')] if \
+    self.relays = RecordList(g('relays'), RelayWeight) if \
       g('relays') is not None else None
     self.bridges = []
 
@@ -409,7 +702,9 @@ The bridge client object contains:
   - fingerprint
   - average_clients
 """
-class BridgeClient:
+class BridgeClient(object):
+  __slots__ = ('fingerprint', 'average_clients')
+
   def __init__(self, document):
     g = document.get
     self.fingerprint = g('fingerprint')
@@ -436,6 +731,9 @@ The clients document contains:
   - bridges
 """
 class Clients:
+  relay_class = None
+  bridge_class = BridgeClient
+
   def __init__(self, document):
     g = document.get
     self.version = g('version')
@@ -443,7 +741,7 @@ class Clients:
     self.relays_published = g('relays_published')
     self.bridges_published = g('bridges_published')
     self.relays = []
-    self.bridges = [BridgeClient(d) for d in g('bridges')] if \
+    self.bridges = RecordList(g('bridges'), BridgeClient) if \
         g('bridges') is not None else None
 
   def __str__(self):
@@ -458,7 +756,9 @@ The relay uptime object contains:
   - uptime
   - flags
 """
-class RelayUptime:
+class RelayUptime(object):
+  __slots__ = ('fingerprint', 'uptime', 'flags')
+
   def __init__(self, document):
     g = document.get
     self.fingerprint = g('fingerprint')
@@ -479,7 +779,9 @@ The bridge uptime object contains:
   - fingerprint
   - uptime
 """
-class BridgeUptime:
+class BridgeUptime(object):
+  __slots__ = ('fingerprint', 'uptime')
+
   def __init__(self, document):
     g = document.get
     self.fingerprint = g('fingerprint')
@@ -505,15 +807,18 @@ The uptime document contains:
   - bridges
 """
 class Uptime:
+  relay_class = RelayUptime
+  bridge_class = BridgeUptime
+
   def __init__(self, document):
     g = document.get
     self.version = g('version')
     self.next_major_version_scheduled = g('next_major_version_scheduled')
     self.relays_published = g('relays_published')
     self.bridges_published = g('bridges_published')
-    self.relays = [RelayUptime(d) for d in g('relays')] if \
+    self.relays = RecordList(g('relays'), RelayUptime) if \
         g('relays') is not None else None
-    self.bridges = [BridgeUptime(d) for d in g('bridges')] if \
+    self.bridges = RecordList(g('bridges'), BridgeUptime) if \
         g('bridges') is not None else None
 
   def __str__(self):
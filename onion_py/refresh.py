@@ -0,0 +1,153 @@
+"""
+Onion-Py background refresher
+
+Keeps the cached answers to a set of hot queries up to date: the next
+OnionOO publication is predicted from relays_published/bridges_published
+and the queries are revalidated shortly after it, so users do not have to
+wait for the download. Combine with Manager(max_stale=...) so that queries
+arriving while a revalidation is running are answered from the previous
+entry.
+
+    >>> manager = Manager(OnionSimpleCache(), max_stale=600)
+    >>> refresher = Refresher(manager)
+    >>> refresher.register('details', type='relay', running=True)
+    >>> refresher.start()
+    ...
+    >>> refresher.stop()
+
+onion_py.aio.refresh_forever runs a refresher as an asyncio task instead of
+a thread.
+"""
+import threading
+import time
+import onion_py.objects as o
+
+"""
+Refresher for a Manager's hot queries
+
+Args:
+  manager: the Manager whose cache is kept up to date
+  delay: seconds after the predicted publication to revalidate, allowing
+    for OnionOO's processing time
+  retry_interval: seconds between revalidations while a publication is
+    overdue or after a failed revalidation
+"""
+class Refresher(object):
+  def __init__(self, manager, delay = 300, retry_interval = 60):
+    self.manager = manager
+    self.delay = delay
+    self.retry_interval = retry_interval
+    self.refreshes = 0
+    self.errors = 0
+    self.last_error = None
+    self._queries = {}
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._thread = None
+
+  def register(self, query, **kwargs):
+    """ Keep a query fresh; it is first refreshed on the next run """
+    params = self.manager._prepare(query, kwargs)
+    key = self.manager._flight_key(query, params)
+    with self._lock:
+      if key not in self._queries:
+        self._queries[key] = [query, params, 0]
+
+  def unregister(self, query, **kwargs):
+    params = self.manager._prepare(query, kwargs)
+    with self._lock:
+      self._queries.pop(self.manager._flight_key(query, params), None)
+
+  def queries(self):
+    """ The registered (query, params, next refresh time) entries """
+    with self._lock:
+      return [tuple(entry) for entry in self._queries.values()]
+
+  def next_refresh(self, document, now):
+    """
+    When to revalidate a document next: shortly after the publication
+    following the most recent one it contains, or after retry_interval if
+    that publication is overdue.
+
+    @rtype: float
+    @return: Seconds since the epoch.
+    """
+    published = [o.parse_timestamp(getattr(document, field, None))
+        for field in ('relays_published', 'bridges_published')]
+    published = [p for p in published if p is not None]
+    if not published:
+      return now + self.retry_interval
+    expected = max(published) + self.manager.publication_interval + self.delay
+    if expected <= now:
+      return now + self.retry_interval
+    return expected
+
+  def run_pending(self):
+    """
+    Revalidate the queries that are due.
+
+    @rtype: float
+    @return: Seconds until the next query is due.
+    """
+    now = time.time()
+    with self._lock:
+      due = [(key, entry[0], entry[1])
+          for key, entry in self._queries.items() if entry[2] <= now]
+    for key, query, params in due:
+      if self._stop.is_set():
+        break
+      try:
+        document = self.manager.refresh(query, **params)
+        next_at = self.next_refresh(document, time.time())
+        self.refreshes += 1
+      except Exception as e:
+        self.errors += 1
+        self.last_error = e
+        next_at = time.time() + self.retry_interval
+      with self._lock:
+        if key in self._queries:
+          self._queries[key][2] = next_at
+    with self._lock:
+      if not self._queries:
+        return self.retry_interval
+      return max(min(entry[2] for entry in self._queries.values()) -
+          time.time(), 0)
+
+  def _run(self):
+    while not self._stop.is_set():
+      self._stop.wait(self.run_pending())
+
+  def start(self):
+    """ Run the refresher on a background thread """
+    if self._thread is not None and self._thread.is_alive():
+      return
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self, timeout = None):
+    """
+    Stop the background thread. A revalidation in progress is completed.
+
+    @rtype: bool
+    @return: Whether the thread has exited.
+    """
+    self._stop.set()
+    if self._thread is None:
+      return True
+    self._thread.join(timeout)
+    stopped = not self._thread.is_alive()
+    if stopped:
+      self._thread = None
+    return stopped
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.stop()
+
+  def __str__(self):
+    return "Refresher (%d queries)" % (len(self._queries),)
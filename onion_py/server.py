@@ -0,0 +1,432 @@
+"""
+Onion-Py local OnionOO server
+
+A stand-in for onionoo.torproject.org serving recorded or synthetic
+documents on all six endpoints, for offline load testing of caching,
+concurrency and retries:
+
+    >>> server = OnionooServer(SyntheticNetwork(relays=5000), latency=0.05,
+    ...     errors={503: 0.01}).start()
+    >>> manager = Manager(OnionSimpleCache(), onionoo_host=server.url)
+    >>> manager.query('details', type='relay', running=True, limit=10)
+    >>> server.stop()
+
+The query parameters are evaluated with onion_py.local's engine on the
+details document (plus first_seen_days and last_seen_days); the history
+documents return the records of the relays and bridges the same
+parameters select from the details document. Responses carry Last-Modified
+(the publication time) and ETag headers, are answered with 304 to matching
+conditional requests, and are gzip-compressed when asked to.
+
+Queries OnionOO accepts but this server cannot evaluate are answered with
+501 Not Implemented rather than 400, so they are not mistaken for client
+errors. These are searches with qualified terms (e.g. search=country:us).
+
+From the command line:
+
+    python -m onion_py.server --relays 5000 --port 8080 --latency 0.05
+    python -m onion_py.server --document details=details.json ...
+"""
+import email.utils
+import gzip
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+try:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.parse import urlsplit, parse_qsl
+except ImportError:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urlparse import urlsplit, parse_qsl
+import onion_py.local as local
+import onion_py.objects as o
+from onion_py.manager import BaseManager
+
+DAYS_PARAMS = {'first_seen_days': 'first_seen', 'last_seen_days': 'last_seen'}
+# answers kept per publication, so repeated queries skip evaluation
+RESPONSE_CACHE_SIZE = 256
+
+
+def parse_days(value):
+  """
+  Parse a first_seen_days/last_seen_days range ("x-y", "x-", "-y" or "x").
+
+  @rtype: tuple
+  @return: (minimum, maximum) days ago; maximum is None if unbounded.
+  @raise ValueError: for malformed ranges.
+  """
+  low, sep, high = str(value).partition('-')
+  low = int(low) if low else 0
+  high = (int(high) if high else None) if sep else low
+  if low < 0 or (high is not None and high < low):
+    raise ValueError("Invalid days range " + repr(value))
+  return low, high
+
+
+def http_date(seconds):
+  return email.utils.formatdate(seconds, usegmt=True)
+
+
+"""
+Snapshot index also evaluating first_seen_days and last_seen_days, relative
+to the server's clock as OnionOO does.
+"""
+class _ServerIndex(local.SnapshotIndex):
+  SUPPORTED_PARAMS = local.SnapshotIndex.SUPPORTED_PARAMS + list(DAYS_PARAMS)
+
+  @staticmethod
+  def supports(query, params):
+    return query in _ServerIndex.QUERIES and \
+        all(p in _ServerIndex.SUPPORTED_PARAMS for p in params)
+
+  def select(self, params):
+    relays, bridges = local.SnapshotIndex.select(self, params)
+    now = time.time()
+    for param, field in DAYS_PARAMS.items():
+      if params.get(param) is None:
+        continue
+      low, high = parse_days(params[param])
+      def within(record):
+        seen = o.parse_timestamp(record.get(field))
+        if seen is None:
+          return False
+        days = int((now - seen) // 86400)
+        return low <= days and (high is None or days <= high)
+      relays = [i for i in relays if within(self.relays[i])]
+      bridges = [i for i in bridges if within(self.bridges[i])]
+    return relays, bridges
+
+
+"""
+One publication: the documents and everything derived from them
+"""
+class _Publication(object):
+  def __init__(self, documents):
+    details = documents.get('details')
+    if details is None:
+      details = self._skeleton(documents)
+    self.documents = documents
+    self.index = _ServerIndex(details)
+    self.history = {}
+    for query, document in documents.items():
+      if query in ('details', 'summary'):
+        continue
+      records = {}
+      for kind in ('relays', 'bridges'):
+        for record in document.get(kind) or []:
+          records[(kind, (record.get('fingerprint') or '').upper())] = record
+      self.history[query] = records
+    published = [o.parse_timestamp(details.get(field))
+        for field in ('relays_published', 'bridges_published')]
+    published = [p for p in published if p is not None]
+    self.last_modified = max(published) if published else int(time.time())
+    self.etag = '"%s"' % hashlib.sha1(("%s %s" % (details.get(
+        'relays_published'), details.get('bridges_published'))).encode(
+        'utf-8')).hexdigest()
+    self.responses = {}
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def _skeleton(documents):
+    """ Details document listing the records of the history documents """
+    relays, bridges, header = {}, {}, {}
+    for document in documents.values():
+      for field in local.SnapshotIndex.HEADER_FIELDS:
+        if document.get(field) is not None:
+          header.setdefault(field, document[field])
+      for record in document.get('relays') or []:
+        key = local._record_key(record)
+        relays.setdefault(key, {'fingerprint': key})
+      for record in document.get('bridges') or []:
+        key = local._record_key(record)
+        bridges.setdefault(key, {'hashed_fingerprint': key})
+    header['relays'] = list(relays.values())
+    header['bridges'] = list(bridges.values())
+    return header
+
+  def evaluate(self, query, params):
+    """
+    The raw document answering a query.
+
+    @raise ValueError: for parameters OnionOO would reject.
+    @raise KeyError: if no document of that type is served.
+    """
+    if query in ('details', 'summary'):
+      if query == 'summary' and 'summary' in self.documents and not params:
+        return self.documents['summary']
+      if query == 'details' and 'details' not in self.documents:
+        raise KeyError(query)
+      return self.index.evaluate(query, params)
+    records = self.history[query]
+    params = dict((k, v) for k, v in params.items() if k != 'fields')
+    selected = self.index.evaluate('details', params)
+    document = dict(self.index.header)
+    for field in local.SnapshotIndex.HEADER_FIELDS:
+      if self.documents[query].get(field) is not None:
+        document[field] = self.documents[query][field]
+    for kind, key in (('relays', 'fingerprint'),
+        ('bridges', 'hashed_fingerprint')):
+      if kind not in self.documents[query]:
+        continue
+      document[kind] = [records[(kind, (r.get(key) or '').upper())]
+          for r in selected[kind]
+          if (kind, (r.get(key) or '').upper()) in records]
+    return document
+
+  def response(self, query, params):
+    """ (body, gzipped body) for a query, cached per publication """
+    key = (query, tuple(sorted(params.items())))
+    with self.lock:
+      response = self.responses.get(key)
+    if response is None:
+      body = json.dumps(self.evaluate(query, params),
+          separators=(',', ':')).encode('utf-8')
+      buf = io.BytesIO()
+      with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+        f.write(body)
+      response = (body, buf.getvalue())
+      with self.lock:
+        if len(self.responses) >= RESPONSE_CACHE_SIZE:
+          self.responses.clear()
+        self.responses[key] = response
+    return response
+
+
+class _Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    if self.server.onionoo.verbose:
+      BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  def do_GET(self):
+    self.server.onionoo._handle(self)
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+"""
+Local OnionOO server
+
+Args:
+  documents: dict mapping document types to recorded raw documents, or an
+    onion_py.synthetic.SyntheticNetwork to serve all six types from; the
+    details document is needed to answer details queries and is used for
+    filtering (without one, only fingerprints can be looked up)
+  host, port: address to listen on (port 0 picks a free port)
+  latency: seconds to wait before answering each request
+  bandwidth: bytes per second each response body is throttled to (None for
+    unthrottled)
+  errors: dict mapping status codes (400, 500, 503, ...) to the probability
+    that a request is answered with them
+  compression: gzip responses to clients accepting it
+  seed: random seed for error injection
+  verbose: log requests to stderr
+"""
+class OnionooServer(object):
+  CHUNK_SIZE = 16384
+
+  def __init__(self, documents, host = '127.0.0.1', port = 0, latency = 0,
+      bandwidth = None, errors = None, compression = True, seed = None,
+      verbose = False):
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.errors = dict(errors or {})
+    self.compression = compression
+    self.verbose = verbose
+    self.requests = 0
+    self.statuses = {}
+    self.bytes_sent = 0
+    self._random = random.Random(seed)
+    self._injected = []
+    self._lock = threading.Lock()
+    self._publication = None
+    self.publish(documents)
+    self.httpd = _HTTPServer((host, port), _Handler)
+    self.httpd.onionoo = self
+    self._thread = None
+
+  @property
+  def url(self):
+    """ The onionoo_host to give a Manager """
+    host, port = self.httpd.server_address[:2]
+    return 'http://%s:%d/' % (host, port)
+
+  def publish(self, documents):
+    """ Serve a new publication (documents as for the constructor) """
+    if hasattr(documents, 'document'):
+      documents = dict((query, documents.document(query))
+          for query in BaseManager.OOO_QUERIES)
+    publication = _Publication(documents)
+    with self._lock:
+      self._publication = publication
+
+  def fail_next(self, status, count = 1):
+    """ Answer the next count requests with status """
+    with self._lock:
+      self._injected.extend([status] * count)
+
+  def _error(self):
+    with self._lock:
+      if self._injected:
+        return self._injected.pop(0)
+      roll = self._random.random()
+    for status, probability in sorted(self.errors.items()):
+      if roll < probability:
+        return status
+      roll -= probability
+    return None
+
+  def _count(self, status, size):
+    with self._lock:
+      self.requests += 1
+      self.statuses[status] = self.statuses.get(status, 0) + 1
+      self.bytes_sent += size
+
+  def _send(self, handler, status, body = b'', headers = None):
+    # counted first: clients may see the response as soon as the headers
+    self._count(status, len(body))
+    handler.send_response(status)
+    for name, value in (headers or {}).items():
+      handler.send_header(name, value)
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    if self.bandwidth:
+      # ~20 writes per second
+      size = max(min(self.CHUNK_SIZE, self.bandwidth // 20), 1)
+      for i in range(0, len(body), size):
+        chunk = body[i:i + size]
+        time.sleep(len(chunk) / float(self.bandwidth))
+        handler.wfile.write(chunk)
+    else:
+      handler.wfile.write(body)
+
+  def _handle(self, handler):
+    if self.latency:
+      time.sleep(self.latency)
+    url = urlsplit(handler.path)
+    query = url.path.strip('/')
+    params = dict(parse_qsl(url.query, keep_blank_values=True))
+    with self._lock:
+      publication = self._publication
+
+    status = self._error()
+    if status is not None:
+      self._send(handler, status, b'', {'Content-Type': 'text/plain'})
+      return
+    if query not in BaseManager.OOO_QUERIES:
+      self._send(handler, 404)
+      return
+    if any(p not in BaseManager.OOO_QUERYPARAMS for p in params):
+      self._send(handler, 400)
+      return
+
+    headers = {'Last-Modified': http_date(publication.last_modified),
+        'ETag': publication.etag, 'Content-Type':
+        'application/json; charset=utf-8', 'Vary': 'Accept-Encoding'}
+    if handler.headers.get('If-None-Match') == publication.etag:
+      self._send(handler, 304, b'', headers)
+      return
+    since = handler.headers.get('If-Modified-Since')
+    if since is not None and handler.headers.get('If-None-Match') is None:
+      since = email.utils.parsedate_tz(since)
+      if since is not None and \
+          email.utils.mktime_tz(since) >= publication.last_modified:
+        self._send(handler, 304, b'', headers)
+        return
+
+    try:
+      body, gzipped = publication.response(query, params)
+    except local.UnsupportedQueryError:
+      # valid for OnionOO, but not implemented here
+      self._send(handler, 501)
+      return
+    except ValueError:
+      self._send(handler, 400)
+      return
+    except KeyError:
+      self._send(handler, 404)
+      return
+    if self.compression and \
+        'gzip' in (handler.headers.get('Accept-Encoding') or ''):
+      body = gzipped
+      headers['Content-Encoding'] = 'gzip'
+    self._send(handler, 200, body, headers)
+
+  def start(self):
+    """ Serve on a background thread """
+    if self._thread is None:
+      self._thread = threading.Thread(target=self.httpd.serve_forever,
+          kwargs={'poll_interval': 0.1})
+      self._thread.daemon = True
+      self._thread.start()
+    return self
+
+  def stop(self):
+    """ Stop serving and close the listening socket """
+    if self._thread is not None:
+      self.httpd.shutdown()
+      self._thread.join()
+      self._thread = None
+    self.httpd.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
+
+  def __str__(self):
+    return "Local OnionOO server at %s (%d requests)" % (self.url,
+        self.requests)
+
+
+def main(argv):
+  import argparse
+  from onion_py.synthetic import SyntheticNetwork
+  parser = argparse.ArgumentParser(description='Local OnionOO server')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--relays', type=int, default=1000,
+      help='size of the synthetic network')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--document', action='append', default=[],
+      metavar='TYPE=FILE', help='serve a recorded document instead')
+  parser.add_argument('--latency', type=float, default=0)
+  parser.add_argument('--bandwidth', type=int, default=None,
+      help='bytes per second per response')
+  parser.add_argument('--error', action='append', default=[],
+      metavar='STATUS=PROBABILITY', help='inject error responses')
+  parser.add_argument('--no-compression', action='store_true')
+  args = parser.parse_args(argv[1:])
+
+  if args.document:
+    documents = {}
+    for spec in args.document:
+      query, path = spec.split('=', 1)
+      with open(path) as f:
+        documents[query] = json.load(f)
+  else:
+    documents = SyntheticNetwork(args.relays, seed=args.seed)
+  errors = dict((int(status), float(probability)) for status, probability in
+      (spec.split('=', 1) for spec in args.error))
+  server = OnionooServer(documents, args.host, args.port, args.latency,
+      args.bandwidth, errors, not args.no_compression, args.seed, True)
+  print("Serving on %s" % (server.url,))
+  try:
+    server.httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.httpd.server_close()
+
+if __name__ == "__main__":
+  import sys
+  main(sys.argv)
@@ -0,0 +1,180 @@
+"""
+Onion-Py streaming document parser
+
+Parses OnionOO documents incrementally so that only one relay or bridge
+record has to be held in memory at a time.
+"""
+import codecs
+import json
+import re
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+"""
+Incremental parser for OnionOO's top-level document object.
+
+Consumes text chunks and produces ('member', key, value) events for plain
+top-level members and ('item', key, element) events for every element of the
+top-level arrays named in stream_keys.
+"""
+class DocumentParser:
+  def __init__(self, chunks, stream_keys = ('relays', 'bridges')):
+    self.chunks = iter(chunks)
+    self.stream_keys = stream_keys
+    self.decoder = json.JSONDecoder()
+    self.buf = ''
+    self.pos = 0
+    self.eof = False
+
+  def _fill(self):
+    """ Read the next chunk, dropping what has been consumed already """
+    for chunk in self.chunks:
+      if chunk:
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+    self.eof = True
+    return False
+
+  def _peek(self):
+    """ Skip whitespace and return the next character """
+    while True:
+      self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if not self._fill():
+        raise ValueError("Unexpected end of document")
+
+  def _expect(self, char):
+    if self._peek() != char:
+      raise ValueError("Expected {!r} at position {}".format(char, self.pos))
+    self.pos += 1
+
+  def _value(self):
+    self._peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buf, self.pos)
+        # a number at the end of the buffer might continue in the next chunk
+        if end < len(self.buf) or self.eof:
+          self.pos = end
+          return value
+      except ValueError:
+        if self.eof:
+          raise
+      self._fill()
+
+  def events(self):
+    self._expect('{')
+    if self._peek() == '}':
+      return
+    while True:
+      key = self._value()
+      self._expect(':')
+      if key in self.stream_keys and self._peek() == '[':
+        self.pos += 1
+        if self._peek() == ']':
+          self.pos += 1
+        else:
+          while True:
+            yield ('item', key, self._value())
+            if self._peek() == ',':
+              self.pos += 1
+            else:
+              self._expect(']')
+              break
+      else:
+        yield ('member', key, self._value())
+      if self._peek() == ',':
+        self.pos += 1
+      else:
+        self._expect('}')
+        return
+
+
+def decode_chunks(chunks, encoding = 'utf-8'):
+  """ Decode an iterable of byte chunks into text chunks """
+  decoder = codecs.getincrementaldecoder(encoding)()
+  for chunk in chunks:
+    yield decoder.decode(chunk)
+  yield decoder.decode(b'', True)
+
+
+def record_events(record):
+  """ Produce the parser events for an already decoded document """
+  for key, value in record.items():
+    if key in ('relays', 'bridges') and value is not None:
+      for item in value:
+        yield ('item', key, item)
+    else:
+      yield ('member', key, value)
+
+
+"""
+Document stream
+
+Iterating a document stream yields the relay objects followed by the bridge
+objects of a document, one at a time. The header fields (version,
+next_major_version_scheduled, relays_published) are read before the first
+record; bridges_published becomes available once the relays have been
+consumed, as OnionOO sends it after them.
+"""
+class DocumentStream:
+  HEADER_FIELDS = ['version', 'next_major_version_scheduled',
+      'relays_published', 'bridges_published']
+
+  def __init__(self, document_class, events, close = None):
+    self.document_class = document_class
+    self.version = None
+    self.next_major_version_scheduled = None
+    self.relays_published = None
+    self.bridges_published = None
+    self._events = events
+    self._close = close
+    self._pending = None
+    # read the header up to the first record
+    for event in self._events:
+      if event[0] == 'item':
+        self._pending = event
+        break
+      self._member(event[1], event[2])
+
+  def _member(self, key, value):
+    if key in self.HEADER_FIELDS:
+      setattr(self, key, value)
+
+  def iter_raw(self):
+    """ Yield ('relays' or 'bridges', raw record dict) tuples """
+    try:
+      if self._pending is not None:
+        event, self._pending = self._pending, None
+        yield event[1], event[2]
+      for event in self._events:
+        if event[0] == 'item':
+          yield event[1], event[2]
+        else:
+          self._member(event[1], event[2])
+    finally:
+      self.close()
+
+  def __iter__(self):
+    relay_class = self.document_class.relay_class
+    bridge_class = self.document_class.bridge_class
+    for key, record in self.iter_raw():
+      record_class = relay_class if key == 'relays' else bridge_class
+      if record_class is not None:
+        yield record_class(record)
+
+  def close(self):
+    if self._close is not None:
+      self._close()
+      self._close = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def __str__(self):
+    return "Streamed %s document" % (self.document_class.__name__,)
@@ -0,0 +1,280 @@
+"""
+Onion-Py synthetic documents
+
+Generates OnionOO documents of every type with the shape, field coverage and
+history lengths of the real service, at any scale. The documents of one
+SyntheticNetwork describe the same relays and bridges, and the same seed
+always yields the same documents, so benchmark runs are comparable.
+
+    >>> network = SyntheticNetwork(relays=10000, seed=1)
+    >>> details = network.document('details')
+    >>> body = network.body('bandwidth')
+
+Used by benchmarks/run.py and the test suite.
+"""
+import json
+import random
+import time
+
+FLAGS = ['Authority', 'BadExit', 'Exit', 'Fast', 'Guard', 'HSDir',
+    'NoEdConsensus', 'Running', 'Stable', 'StaleDesc', 'V2Dir', 'Valid']
+COUNTRIES = ['us', 'de', 'fr', 'nl', 'ca', 'gb', 'se', 'ch', 'ru', 'fi',
+    'at', 'ro', 'pl', 'lu', 'jp', 'ua', 'no', 'cz', 'es', 'it']
+PLATFORMS = ['Tor 0.4.8.%d on Linux', 'Tor 0.4.7.%d on FreeBSD',
+    'Tor 0.4.8.%d on Windows 10']
+TRANSPORTS = ['obfs4', 'snowflake', 'webtunnel', 'meek']
+
+# (period, interval in seconds, number of values) as published by OnionOO
+BANDWIDTH_PERIODS = [('1_month', 14400, 180), ('6_months', 43200, 364),
+    ('1_year', 172800, 183), ('5_years', 864000, 183)]
+WEIGHTS_PERIODS = [('1_week', 3600, 168), ('1_month', 14400, 180),
+    ('6_months', 43200, 364), ('1_year', 172800, 183),
+    ('5_years', 864000, 183)]
+CLIENTS_PERIODS = [('1_month', 86400, 30), ('6_months', 86400, 182),
+    ('1_year', 172800, 183), ('5_years', 864000, 183)]
+UPTIME_PERIODS = WEIGHTS_PERIODS
+UPTIME_FLAGS = ['Exit', 'Fast', 'Guard', 'HSDir', 'Running', 'Stable', 'V2Dir',
+    'Valid']
+
+# distinct value series generated per history length; records draw from
+# them, which keeps generating large documents cheap
+SERIES = 32
+
+
+def format_timestamp(seconds):
+  """ OnionOO UTC timestamp ("YYYY-MM-DD hh:mm:ss") for seconds since epoch """
+  return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+
+"""
+A synthetic Tor network
+
+Args:
+  relays: number of relays
+  bridges: number of bridges (defaults to a quarter of the relays)
+  seed: random seed; equal arguments produce equal documents
+  published: relays_published as seconds since the epoch (defaults to the
+    start of the current hour); bridges are published half an hour earlier
+  histories: history periods to include as a subset of the period names
+    (None for all of them)
+  missing: fraction of history values that are missing (null)
+"""
+class SyntheticNetwork(object):
+  def __init__(self, relays = 1000, bridges = None, seed = 0,
+      published = None, histories = None, missing = 0.02):
+    self.relays = relays
+    self.bridges = relays // 4 if bridges is None else bridges
+    self.seed = seed
+    if published is None:
+      published = int(time.time()) // 3600 * 3600
+    self.published = published
+    self.histories = histories
+    self.missing = missing
+    self._series = {}
+    self._details = None
+
+  def _rng(self, salt):
+    return random.Random("%s:%s" % (self.seed, salt))
+
+  def _relay(self, rng, i):
+    published = self.published
+    flags = ['Fast', 'Running', 'V2Dir', 'Valid']
+    roll = rng.random()
+    if roll < 0.35:
+      flags += ['Guard', 'Stable', 'HSDir']
+    if roll > 0.75:
+      flags.append('Exit')
+    flags.sort()
+    weight = int(rng.paretovariate(1.2) * 200)
+    address = '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+    first_seen = published - rng.randint(3600, 86400 * 3000)
+    exit = 'Exit' in flags
+    record = {
+        'nickname': 'relay%d' % i,
+        'fingerprint': '%040X' % rng.getrandbits(160),
+        'or_addresses': ['%s:%d' % (address, rng.choice([443, 9001]))],
+        'exit_addresses': [address] if exit and rng.random() < 0.2 else None,
+        'dir_address': '%s:9030' % address if rng.random() < 0.3 else None,
+        'last_seen': format_timestamp(published),
+        'last_changed_address_or_port': format_timestamp(first_seen),
+        'first_seen': format_timestamp(first_seen),
+        'running': rng.random() < 0.95,
+        'flags': flags,
+        'country': rng.choice(COUNTRIES),
+        'as_number': 'AS%d' % rng.randint(1, 65000),
+        'as_name': 'Synthetic Hosting %d' % rng.randint(1, 500),
+        'consensus_weight': weight,
+        'host_name': 'relay%d.example.org' % i,
+        'last_restarted': format_timestamp(published -
+            rng.randint(3600, 86400 * 60)),
+        'bandwidth_rate': 1073741824,
+        'bandwidth_burst': 1073741824,
+        'observed_bandwidth': weight * 10000,
+        'advertised_bandwidth': weight * 10000,
+        'exit_policy': ['accept *:80', 'accept *:443', 'reject *:*'] if exit
+            else ['reject *:*'],
+        'exit_policy_summary': {'accept': ['80', '443']} if exit
+            else {'reject': ['1-65535']},
+        'contact': '0x%08X Operator %d <op%d AT example dot org>' %
+            (rng.getrandbits(32), i, i) if rng.random() < 0.8 else None,
+        'platform': rng.choice(PLATFORMS) % rng.randint(1, 12),
+        'recommended_version': rng.random() < 0.9,
+        'consensus_weight_fraction': 0.0,
+        'guard_probability': 0.0,
+        'middle_probability': 0.0,
+        'exit_probability': 0.0,
+        }
+    return dict((k, v) for k, v in record.items() if v is not None)
+
+  def _bridge(self, rng, i):
+    published = self.published - 1800
+    first_seen = published - rng.randint(3600, 86400 * 2000)
+    return {
+        'nickname': 'bridge%d' % i,
+        'hashed_fingerprint': '%040X' % rng.getrandbits(160),
+        'or_addresses': ['10.255.%d.%d:443' % (i >> 8 & 255, i & 255)],
+        'last_seen': format_timestamp(published),
+        'first_seen': format_timestamp(first_seen),
+        'running': rng.random() < 0.9,
+        'flags': ['Fast', 'Running', 'Stable', 'Valid'],
+        'last_restarted': format_timestamp(published -
+            rng.randint(3600, 86400 * 60)),
+        'advertised_bandwidth': rng.randint(10000, 10000000),
+        'platform': rng.choice(PLATFORMS) % rng.randint(1, 12),
+        'transports': [rng.choice(TRANSPORTS)],
+        }
+
+  def _probabilities(self, relays):
+    total = float(sum(r['consensus_weight'] for r in relays) or 1)
+    guards = [r for r in relays if 'Guard' in r['flags']]
+    exits = [r for r in relays if 'Exit' in r['flags']]
+    for kind, members in (('guard_probability', guards),
+        ('exit_probability', exits), ('middle_probability', relays)):
+      weight = float(sum(r['consensus_weight'] for r in members) or 1)
+      for r in members:
+        r[kind] = r['consensus_weight'] / weight
+    for r in relays:
+      r['consensus_weight_fraction'] = r['consensus_weight'] / total
+
+  def details(self):
+    """
+    The relay and bridge details records.
+
+    @rtype: tuple
+    @return: (relays, bridges) lists of raw records, shared between calls.
+    """
+    if self._details is None:
+      rng = self._rng('details')
+      relays = [self._relay(rng, i) for i in range(self.relays)]
+      self._probabilities(relays)
+      bridges = [self._bridge(rng, i) for i in range(self.bridges)]
+      self._details = (relays, bridges)
+    return self._details
+
+  def _values(self, count):
+    series = self._series.get(count)
+    if series is None:
+      rng = self._rng('series:%d' % count)
+      series = self._series[count] = []
+      for i in range(SERIES):
+        level = rng.randint(100, 900)
+        values = []
+        for j in range(count):
+          if rng.random() < self.missing:
+            values.append(None)
+          else:
+            level = min(999, max(0, level + rng.randint(-40, 40)))
+            values.append(level)
+        series.append(values)
+    return series
+
+  def _history(self, rng, periods, factor):
+    histories = {}
+    end = self.published
+    for period, interval, count in periods:
+      if self.histories is not None and period not in self.histories:
+        continue
+      last = end // interval * interval
+      histories[period] = {
+          'first': format_timestamp(last - (count - 1) * interval),
+          'last': format_timestamp(last),
+          'interval': interval,
+          'factor': factor,
+          'count': count,
+          'values': rng.choice(self._values(count)),
+          }
+    return histories
+
+  def _header(self, relays, bridges):
+    document = {'version': '4.0',
+        'relays_published': format_timestamp(self.published),
+        'bridges_published': format_timestamp(self.published - 1800)}
+    if relays is not None:
+      document['relays'] = relays
+    if bridges is not None:
+      document['bridges'] = bridges
+    return document
+
+  def document(self, query):
+    """
+    Generate a complete document.
+
+    @type query: str
+    @param query: one of the Manager.OOO_QUERIES document types.
+    @rtype: dict
+    @return: The raw document as OnionOO would return it.
+    """
+    relays, bridges = self.details()
+    rng = self._rng(query)
+    if query == 'details':
+      return self._header(relays, bridges)
+    elif query == 'summary':
+      return self._header(
+          [{'n': r['nickname'], 'f': r['fingerprint'],
+            'a': [a.rsplit(':', 1)[0] for a in r['or_addresses']],
+            'r': r['running']} for r in relays],
+          [{'n': b['nickname'], 'h': b['hashed_fingerprint'],
+            'r': b['running']} for b in bridges])
+    elif query == 'bandwidth':
+      def bandwidth(fingerprint):
+        return {'fingerprint': fingerprint,
+            'write_history': self._history(rng, BANDWIDTH_PERIODS, 12345.67),
+            'read_history': self._history(rng, BANDWIDTH_PERIODS, 12345.67)}
+      return self._header([bandwidth(r['fingerprint']) for r in relays],
+          [bandwidth(b['hashed_fingerprint']) for b in bridges])
+    elif query == 'weights':
+      return self._header([dict([('fingerprint', r['fingerprint'])] +
+          [(field, self._history(rng, WEIGHTS_PERIODS, factor))
+            for field, factor in (('consensus_weight_fraction', 1e-6),
+              ('guard_probability', 1e-6), ('middle_probability', 1e-6),
+              ('exit_probability', 1e-6), ('consensus_weight', 10.0))])
+          for r in relays], None)
+    elif query == 'clients':
+      return self._header(None, [{'fingerprint': b['hashed_fingerprint'],
+          'average_clients': self._history(rng, CLIENTS_PERIODS, 0.5)}
+          for b in bridges])
+    elif query == 'uptime':
+      return self._header(
+          [{'fingerprint': r['fingerprint'],
+            'uptime': self._history(rng, UPTIME_PERIODS, 0.001001),
+            'flags': dict((flag, self._history(rng, UPTIME_PERIODS, 0.001001))
+                for flag in UPTIME_FLAGS if flag in r['flags'])}
+            for r in relays],
+          [{'fingerprint': b['hashed_fingerprint'],
+            'uptime': self._history(rng, UPTIME_PERIODS, 0.001001)}
+            for b in bridges])
+    raise ValueError("unknown document type: %s" % (query,))
+
+  def body(self, query):
+    """ The document serialised as an OnionOO response body (bytes) """
+    return json.dumps(self.document(query),
+        separators=(',', ':')).encode('utf-8')
+
+  def __str__(self):
+    return "Synthetic network (%d relays, %d bridges, seed %s)" % \
+        (self.relays, self.bridges, self.seed)
+
+
+def generate(query, relays = 1000, **kwargs):
+  """ Generate a raw document, see SyntheticNetwork for the arguments """
+  return SyntheticNetwork(relays, **kwargs).document(query)
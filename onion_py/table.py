@@ -0,0 +1,168 @@
+"""
+Onion-Py columnar relay tables
+
+A RelayTable holds one numpy array per relay field of a Details or Summary
+document so that questions about the whole network can be answered with
+vectorised filters instead of Python loops. Requires numpy.
+
+    >>> t = RelayTable.from_document(manager.query('details'))
+    >>> fast_guards = t.filter(t.has_flag('Running', 'Guard') &
+    ...     (t.as_number == 3320) & (t.advertised_bandwidth > 10e6))
+    >>> fast_guards.sort('consensus_weight', descending=True).relays()[:5]
+"""
+import onion_py.objects as o
+
+def parse_as_number(as_number):
+  """ Parse 'AS1234', '1234' or 1234 into 1234 (-1 if missing) """
+  if as_number is None or as_number == '':
+    return -1
+  as_number = str(as_number)
+  if as_number[:2].upper() == 'AS':
+    as_number = as_number[2:]
+  return int(as_number)
+
+"""
+Columnar view of the relays in a snapshot
+
+Columns:
+  - fingerprint, nickname, country: object arrays of strings ('' if missing)
+  - running: bool
+  - flags: uint64 bitmask, see flag_names / has_flag
+  - as_number: int64 (-1 if missing)
+  - consensus_weight, bandwidth_rate, bandwidth_burst, observed_bandwidth,
+    advertised_bandwidth, consensus_weight_fraction, guard_probability,
+    middle_probability, exit_probability: float64 (NaN if missing)
+"""
+class RelayTable(object):
+  FLAGS = ['Authority', 'BadExit', 'Exit', 'Fast', 'Guard', 'HSDir',
+      'NoEdConsensus', 'Running', 'Stable', 'StaleDesc', 'Sybil', 'V2Dir',
+      'Valid']
+  STRING_COLUMNS = ['fingerprint', 'nickname', 'country']
+  NUMBER_COLUMNS = ['consensus_weight', 'bandwidth_rate', 'bandwidth_burst',
+      'observed_bandwidth', 'advertised_bandwidth', 'consensus_weight_fraction',
+      'guard_probability', 'middle_probability', 'exit_probability']
+  # summary documents use abbreviated keys
+  SUMMARY_KEYS = {'fingerprint': 'f', 'nickname': 'n', 'running': 'r'}
+
+  def __init__(self, columns, flag_names, raw, rows, record_class):
+    self.columns = columns
+    self.flag_names = flag_names
+    self.raw = raw
+    self.rows = rows
+    self.record_class = record_class
+
+  @classmethod
+  def from_document(cls, document):
+    """
+    Build a table from a Details or Summary document in a single pass over
+    its raw relay records.
+    """
+    np = o._numpy()
+    if isinstance(document, o.Summary):
+      record_class = o.RelaySummary
+      keys = cls.SUMMARY_KEYS
+    elif isinstance(document, o.Details):
+      record_class = o.RelayDetails
+      keys = {}
+    else:
+      raise TypeError("RelayTable needs a Details or Summary document")
+    raw = document.relays
+    raw = getattr(raw, 'raw', raw) or []
+
+    flag_names = list(cls.FLAGS)
+    flag_bits = dict((f, 1 << i) for i, f in enumerate(flag_names))
+    names = cls.STRING_COLUMNS + cls.NUMBER_COLUMNS
+    values = dict((name, []) for name in names)
+    running, flags, as_numbers = [], [], []
+    appenders = [(values[name].append, keys.get(name, name)) for name in names]
+    running_key = keys.get('running', 'running')
+
+    for record in raw:
+      g = record.get
+      for append, key in appenders:
+        append(g(key))
+      running.append(g(running_key) is True)
+      mask = 0
+      for flag in g('flags') or ():
+        bit = flag_bits.get(flag)
+        if bit is None:
+          if len(flag_names) == 64:
+            raise ValueError("More than 64 distinct relay flags")
+          bit = flag_bits[flag] = 1 << len(flag_names)
+          flag_names.append(flag)
+        mask |= bit
+      flags.append(mask)
+      as_numbers.append(parse_as_number(g('as_number') or g('as')))
+
+    columns = {}
+    for name in cls.STRING_COLUMNS:
+      column = np.empty(len(raw), dtype=object)
+      column[:] = [v or '' for v in values[name]]
+      columns[name] = column
+    for name in cls.NUMBER_COLUMNS:
+      columns[name] = np.array(values[name], dtype=np.float64)
+    columns['running'] = np.array(running, dtype=bool)
+    columns['flags'] = np.array(flags, dtype=np.uint64)
+    columns['as_number'] = np.array(as_numbers, dtype=np.int64)
+    return cls(columns, flag_names, raw, np.arange(len(raw)), record_class)
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __getitem__(self, name):
+    return self.columns[name]
+
+  def __getattr__(self, name):
+    columns = self.__dict__.get('columns')
+    if columns is not None and name in columns:
+      return columns[name]
+    raise AttributeError(name)
+
+  def flag_mask(self, *flags):
+    """ Bitmask for the given flags (None if a flag never occurs) """
+    np = o._numpy()
+    mask = 0
+    for flag in flags:
+      if flag not in self.flag_names:
+        return None
+      mask |= 1 << self.flag_names.index(flag)
+    return np.uint64(mask)
+
+  def has_flag(self, *flags):
+    """ Boolean array: relays carrying all of the given flags """
+    np = o._numpy()
+    mask = self.flag_mask(*flags)
+    if mask is None:
+      return np.zeros(len(self), dtype=bool)
+    return (self.columns['flags'] & mask) == mask
+
+  def filter(self, mask):
+    """ New table holding the rows selected by a boolean array """
+    return self.take(o._numpy().flatnonzero(mask))
+
+  def take(self, indices):
+    """ New table holding the rows at the given positions, in that order """
+    columns = dict((name, column[indices])
+        for name, column in self.columns.items())
+    return RelayTable(columns, self.flag_names, self.raw, self.rows[indices],
+        self.record_class)
+
+  def sort(self, column, descending = False):
+    """ New table sorted by a column (missing numbers sort last) """
+    np = o._numpy()
+    values = self.columns[column]
+    if values.dtype == object:
+      order = np.argsort(values, kind='stable')
+      if descending:
+        order = order[::-1]
+    else:
+      values = values.astype(np.float64)
+      order = np.argsort(-values if descending else values, kind='stable')
+    return self.take(order)
+
+  def relays(self):
+    """ The rows as relay objects (RelayDetails or RelaySummary) """
+    return [self.record_class(self.raw[i]) for i in self.rows]
+
+  def __str__(self):
+    return "Relay table (%d relays)" % (len(self),)
@@ -13,11 +13,13 @@ setup(
     packages=['onion_py'],
     scripts=['bin/onion.py'],
 
-    install_requires = ['requests>=2.0.0'],
+    install_requires = ['requests>=2.0.0', 'futures; python_version < "3.0"'],
 
     extras_require = {
       'Results caching with memcached': ['pymemcache>=1.2.1','six'],
-      'Results caching with django-cache': ['django']
+      'Results caching with django-cache': ['django'],
+      'asyncio support': ['aiohttp>=3.3'],
+      'Vectorised history analysis': ['numpy>=1.13']
       },
     dependency_links = [
       'git+https://github.com/pinterest/pymemcache.git'
@@ -1 +1 @@
-__all__ = ['objects']
+__all__ = ['objects', 'aio', 'streaming', 'table', 'local', 'exitpolicy', 'family', 'caching', 'refresh', 'diff', 'archive', 'instrumentation', 'synthetic', 'server', 'endpoints']
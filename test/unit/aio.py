@@ -0,0 +1,106 @@
+import unittest
+import json
+import onion_py
+from onion_py.objects import *
+from onion_py.manager import *
+from onion_py.caching import OnionSimpleCache
+
+try:
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from onion_py.aio import AsyncManager, AsyncCacheAdapter, refresh_forever
+    import asyncio
+    HAVE_AIOHTTP = True
+except ImportError:
+    HAVE_AIOHTTP = False
+
+
+@unittest.skipUnless(HAVE_AIOHTTP, 'aiohttp not installed')
+class TestAsyncManager(unittest.IsolatedAsyncioTestCase):
+    """ Test case for the asyncio Manager """
+
+    async def asyncSetUp(self):
+        self.requests = []
+
+        async def handler(request):
+            self.requests.append(request)
+            doc_type = request.match_info['doc_type']
+            if doc_type == 'uptime':
+                return web.Response(status=503)
+            if request.headers.get('If-None-Match') == '"1"':
+                return web.Response(status=304)
+            body = {'version': '4.0', 'relays_published': '2015-01-01 00:00:00',
+                'relays': [{'fingerprint': 'A' * 40}], 'bridges': []}
+            return web.Response(body=json.dumps(body),
+                content_type='application/json', headers={'ETag': '"1"',
+                  'Last-Modified': 'Thu, 01 Jan 2015 00:00:00 GMT'})
+
+        app = web.Application()
+        app.router.add_get('/{doc_type}', handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.manager = AsyncManager(OnionSimpleCache(),
+            onionoo_host=str(self.server.make_url('/')), min_fresh=0)
+
+    async def asyncTearDown(self):
+        await self.manager.close()
+        await self.server.close()
+
+    async def test_query(self):
+        doc = await self.manager.query('details', type='relay')
+        self.assertEqual(type(doc), Details)
+        self.assertEqual(doc.relays[0].fingerprint, 'A' * 40)
+        self.assertEqual(self.requests[0].query['type'], 'relay')
+
+    async def test_validation(self):
+        with self.assertRaises(InvalidDocumentTypeError):
+            await self.manager.query('invalid_document_type')
+        with self.assertRaises(InvalidParameterError):
+            await self.manager.query('details', typo='relay')
+
+    async def test_errors(self):
+        with self.assertRaises(ServiceUnavailableError):
+            await self.manager.query('uptime')
+
+    async def test_revalidation(self):
+        await self.manager.query('details')
+        doc = await self.manager.query('details')
+        self.assertEqual(type(doc), Details)
+        self.assertEqual(self.requests[1].headers['If-None-Match'], '"1"')
+
+    async def test_gather(self):
+        docs = await self.manager.gather(['summary', ('details', {'limit': 1}),
+            'uptime'], limit=2, return_exceptions=True)
+        self.assertEqual(type(docs[0]), Summary)
+        self.assertEqual(type(docs[1]), Details)
+        self.assertIsInstance(docs[2], ServiceUnavailableError)
+
+    async def test_cache_adapter(self):
+        adapter = AsyncCacheAdapter(OnionSimpleCache())
+        await adapter.set('details', {}, {'record': 1})
+        self.assertEqual(await adapter.get('details', {}), {'record': 1})
+
+@unittest.skipUnless(HAVE_AIOHTTP, 'aiohttp not installed')
+class TestRefreshTask(unittest.IsolatedAsyncioTestCase):
+    """ Test case for running a refresher as an asyncio task """
+
+    async def test_cancel(self):
+        class Refresher:
+            runs = 0
+            def run_pending(self):
+                self.runs += 1
+                return 0.01
+
+        refresher = Refresher()
+        task = asyncio.ensure_future(refresh_forever(refresher))
+        while refresher.runs < 3:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        runs = refresher.runs
+        await asyncio.sleep(0.05)
+        self.assertEqual(refresher.runs, runs)
+
+if __name__ == '__main__':
+    unittest.main()
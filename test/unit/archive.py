@@ -0,0 +1,97 @@
+import unittest
+import os
+import shutil
+import tempfile
+from onion_py.objects import *
+from onion_py.archive import *
+
+
+def details(hour, relays, bridges=()):
+    published = '2015-01-01 %02d:00:00' % hour
+    return {'version': '4.0', 'relays_published': published,
+        'bridges_published': published, 'relays': list(relays),
+        'bridges': list(bridges)}
+
+
+def relay(fingerprint, weight, running=True, flags=('Running',), **fields):
+    record = {'fingerprint': fingerprint, 'nickname': 'n' + fingerprint[0],
+        'running': running, 'flags': list(flags), 'consensus_weight': weight,
+        'or_addresses': ['10.0.0.1:9001', '[::1]:9001'], 'as_number': 'AS3'}
+    record.update(fields)
+    return record
+
+
+class TestArchive(unittest.TestCase):
+    """ Test case for the snapshot archive """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = Archive(self.directory)
+        self.archive.append(Details(details(0, [relay('B' * 40, 10),
+            relay('A' * 40, 5, flags=['Running', 'Exit'], country='de',
+                exit_probability=0.5)],
+            [{'hashed_fingerprint': 'C' * 40, 'nickname': 'bridge',
+                'running': True}])))
+        self.archive.append(details(1, [relay('A' * 40, 7),
+            relay('D' * 40, 20, running=False)]))
+        self.archive.append(details(2, [relay('B' * 40, 30,
+            advertised_bandwidth=1000)]))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_history(self):
+        history = self.archive.relay_history('a' * 40)
+        self.assertEqual([(h['published'], h['consensus_weight'])
+            for h in history], [(parse_timestamp('2015-01-01 00:00:00'), 5),
+            (parse_timestamp('2015-01-01 01:00:00'), 7)])
+        first = history[0]
+        self.assertEqual(first['flags'], ['Running', 'Exit'])
+        self.assertEqual(first['country'], 'de')
+        self.assertEqual(first['address'], '10.0.0.1')
+        self.assertEqual(first['as_number'], 3)
+        self.assertEqual(first['exit_probability'], 0.5)
+        self.assertIsNone(first['guard_probability'])
+        self.assertIsNone(first['advertised_bandwidth'])
+        self.assertTrue(first['running'])
+        self.assertEqual(first['kind'], 'relay')
+        self.assertIsNone(history[1]['country'])
+
+    def test_range_and_fields(self):
+        history = self.archive.relay_history('B' * 40,
+            start='2015-01-01 00:30:00', fields=['nickname'])
+        self.assertEqual(history, [{'published':
+            parse_timestamp('2015-01-01 02:00:00'), 'nickname': 'nB'}])
+        self.assertEqual(self.archive.relay_history('E' * 40), [])
+        self.assertEqual(self.archive.relay_history('C' * 40)[0]['kind'],
+            'bridge')
+
+    def test_totals(self):
+        totals = self.archive.totals(end='2015-01-01 01:00:00')
+        self.assertEqual([(t['relays'], t['running_relays'], t['bridges'],
+            t['consensus_weight']) for t in totals], [(2, 2, 1, 15), (2, 1, 0, 7)])
+        self.assertEqual(self.archive.totals()[-1]['advertised_bandwidth'], 1000)
+
+    def test_reopen_and_append_only(self):
+        archive = Archive(self.directory)
+        self.assertEqual(len(archive), 3)
+        self.assertEqual(archive.relay_history('D' * 40)[0]['running'], False)
+        self.assertFalse(archive.append(details(2, [])))
+        with self.assertRaises(ValueError):
+            archive.append(details(1, []))
+        archive.append(details(3, [relay('E' * 40, 1)]))
+        self.archive.reload()
+        self.assertEqual(self.archive.relay_history('E' * 40)[0]['nickname'],
+            'nE')
+        self.assertEqual(len(self.archive.block('2015-01-01 03:00:00')), 1)
+
+    def test_interrupted_append(self):
+        with open(os.path.join(self.directory, 'strings'), 'ab') as f:
+            f.write(b'\xff\x00\x00\x00partial')
+        archive = Archive(self.directory)
+        archive.append(details(3, [relay('F' * 40, 1)]))
+        self.assertEqual(Archive(self.directory).relay_history('F' * 40)[0]
+            ['nickname'], 'nF')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,288 @@
+import unittest
+import threading
+import mock
+import os
+import shutil
+import tempfile
+from onion_py.caching import *
+
+try:
+    import pymemcache
+    HAVE_PYMEMCACHE = True
+except ImportError:
+    HAVE_PYMEMCACHE = False
+
+
+def entry(size, published=None):
+    record = {'relays': []}
+    if published is not None:
+        record['relays_published'] = published
+    return {'timestamp': None, 'size': size, 'record': record}
+
+
+class TestSimpleCache(unittest.TestCase):
+    """ Test case for the bounded in-process cache """
+
+    def test_lru_entries(self):
+        cache = OnionSimpleCache(max_entries=2)
+        cache.set('details', {'limit': 1}, entry(10))
+        cache.set('details', {'limit': 2}, entry(10))
+        cache.get('details', {'limit': 1})
+        cache.set('details', {'limit': 3}, entry(10))
+        self.assertIsNotNone(cache.get('details', {'limit': 1}))
+        self.assertIsNone(cache.get('details', {'limit': 2}))
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1,
+            'evictions': 1, 'expirations': 0, 'entries': 2, 'bytes': 20})
+
+    def test_max_bytes(self):
+        cache = OnionSimpleCache(max_bytes=100)
+        cache.set('details', {'limit': 1}, entry(60))
+        cache.set('details', {'limit': 2}, entry(30))
+        cache.set('details', {'limit': 1}, entry(50))
+        self.assertEqual(cache.total_bytes, 80)
+        cache.set('details', {'limit': 3}, entry(40))
+        self.assertIsNone(cache.get('details', {'limit': 2}))
+        self.assertEqual(cache.total_bytes, 90)
+        # entries larger than the whole cache are not stored
+        cache.set('details', {'limit': 4}, entry(101))
+        self.assertIsNone(cache.get('details', {'limit': 4}))
+
+    def test_size_estimate(self):
+        cache = OnionSimpleCache()
+        cache.set('summary', {}, {'record': {'relays': []}})
+        self.assertEqual(cache.total_bytes, len('{"record": {"relays": []}}'))
+
+    @mock.patch('onion_py.caching.time.time')
+    def test_ttl(self, mock_time):
+        cache = OnionSimpleCache(ttl=3600, min_ttl=600)
+        now = parse_timestamp('2015-01-01 12:00:00')
+        mock_time.return_value = now
+        cache.set('details', {}, entry(1, '2015-01-01 11:30:00'))
+        cache.set('summary', {}, entry(1, '2015-01-01 08:00:00'))
+        mock_time.return_value = now + 599
+        self.assertIsNotNone(cache.get('summary', {}))
+        mock_time.return_value = now + 1799
+        self.assertIsNotNone(cache.get('details', {}))
+        self.assertIsNone(cache.get('summary', {}))
+        mock_time.return_value = now + 1800
+        self.assertIsNone(cache.get('details', {}))
+        self.assertEqual(cache.stats()['expirations'], 2)
+        self.assertEqual(cache.total_bytes, 0)
+
+    def test_lock(self):
+        cache = OnionSimpleCache()
+        order = []
+        with cache.lock('details', {}) as acquired:
+            self.assertTrue(acquired)
+            def other():
+                with cache.lock('details', {}):
+                    order.append('other')
+            t = threading.Thread(target=other)
+            t.start()
+            with cache.lock('summary', {}):
+                order.append('summary')
+            t.join(0.1)
+            order.append('first')
+        t.join()
+        self.assertEqual(order, ['summary', 'first', 'other'])
+        self.assertEqual(cache._key_locks._locks, {})
+
+    def test_threads(self):
+        cache = OnionSimpleCache(max_entries=50)
+
+        def work(n):
+            for i in range(500):
+                cache.set('details', {'limit': (n * i) % 97}, entry(1))
+                cache.get('details', {'limit': i % 97})
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(cache.dict), 50)
+        self.assertEqual(cache.total_bytes, 50)
+
+
+class TestDiskCache(unittest.TestCase):
+    """ Test case for the persistent disk cache """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_persistence(self):
+        cache = OnionDiskCache(self.directory)
+        document = entry(10, '2015-01-01 12:00:00')
+        cache.set('details', {'limit': 1}, document)
+        self.assertIsNone(cache.get('details', {'limit': 2}))
+        other = OnionDiskCache(self.directory)
+        self.assertEqual(other.get('details', {'limit': 1}), document)
+        self.assertEqual(other.keys(), [key_serializer('details', {'limit': 1})])
+        # no temporary files are left behind
+        self.assertEqual(sorted(os.listdir(self.directory)),
+            sorted(['index.json', 'lock', OnionDiskCache._filename(
+                key_serializer('details', {'limit': 1}))]))
+
+    def test_eviction(self):
+        document = {'record': {'relays': [str(i) for i in range(100)]}}
+        cache = OnionDiskCache(self.directory)
+        cache.set('details', {'limit': 0}, document)
+        size = cache.size()
+        cache.clear()
+        self.assertEqual(cache.size(), 0)
+        cache = OnionDiskCache(self.directory, max_bytes=2 * size)
+        for i in range(3):
+            cache.set('details', {'limit': i}, document)
+            path = os.path.join(self.directory, OnionDiskCache._filename(
+                key_serializer('details', {'limit': i})))
+            os.utime(path, (1000 + i, 1000 + i))
+        self.assertEqual(cache.size(), 2 * size)
+        self.assertIsNone(cache.get('details', {'limit': 0}))
+        self.assertEqual(cache.get('details', {'limit': 1}), document)
+        # reading refreshes the entry, so 2 is now least recently used
+        cache.set('details', {'limit': 3}, document)
+        self.assertIsNotNone(cache.get('details', {'limit': 1}))
+        self.assertIsNone(cache.get('details', {'limit': 2}))
+
+    def test_lock(self):
+        first = OnionDiskCache(self.directory)
+        second = OnionDiskCache(self.directory)
+        with first.lock('details', {}) as acquired:
+            self.assertTrue(acquired)
+            with second.lock('details', {}, timeout=0.1) as acquired:
+                self.assertFalse(acquired)
+            with second.lock('summary', {}, timeout=0.1) as acquired:
+                self.assertTrue(acquired)
+        with second.lock('details', {}, timeout=0.1) as acquired:
+            self.assertTrue(acquired)
+
+    def test_corrupt_entry(self):
+        cache = OnionDiskCache(self.directory)
+        cache.set('summary', {}, entry(1))
+        path = os.path.join(self.directory,
+            OnionDiskCache._filename(key_serializer('summary', {})))
+        with open(path, 'wb') as f:
+            f.write(b'garbage')
+        self.assertIsNone(cache.get('summary', {}))
+        self.assertFalse(os.path.exists(path))
+
+    def test_chunked_read(self):
+        cache = OnionDiskCache(self.directory)
+        cache.CHUNK_SIZE = 7
+        document = {'record': {'relays': [str(i) for i in range(100)]}}
+        cache.set('details', {}, document)
+        self.assertEqual(cache.get('details', {}), document)
+        # a truncated entry is dropped like any other corrupt one
+        path = os.path.join(self.directory,
+            OnionDiskCache._filename(key_serializer('details', {})))
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        self.assertIsNone(cache.get('details', {}))
+        self.assertFalse(os.path.exists(path))
+
+    def test_readonly_entry(self):
+        cache = OnionDiskCache(self.directory)
+        document = entry(1, '2015-01-01 12:00:00')
+        cache.set('summary', {}, document)
+        # failing to refresh the access time does not discard the entry
+        with mock.patch('os.utime', side_effect=OSError):
+            self.assertEqual(cache.get('summary', {}), document)
+        self.assertEqual(cache.get('summary', {}), document)
+
+class FakeMemcached(object):
+    """ In-memory stand-in for a memcached server with an item size limit """
+
+    def __init__(self, *args, **kwargs):
+        self.items = {}
+        self.limit = 1000
+        self.calls = 0
+
+    def get_many(self, keys):
+        self.calls += 1
+        return dict((k, self.items[k]) for k in keys if k in self.items)
+
+    def set_many(self, values, expire=0):
+        self.calls += 1
+        for key, value in values.items():
+            assert len(key) <= 250
+            if len(value) <= self.limit:
+                self.items[key] = value
+
+    def add(self, key, value, expire=0, noreply=None):
+        if key in self.items:
+            return False
+        self.items[key] = value
+        return True
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def delete(self, key):
+        self.items.pop(key, None)
+
+
+@unittest.skipUnless(HAVE_PYMEMCACHE, 'pymemcache not installed')
+class TestMemcached(unittest.TestCase):
+    """ Test case for chunked memcached storage """
+
+    def setUp(self):
+        patcher = mock.patch('pymemcache.client.Client', FakeMemcached)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = OnionMemcached(chunk_size=500)
+        self.client = self.cache.memcached_client
+        # incompressible enough to need several chunks
+        self.large = {'record': {'relays': [hashed_key('details', {'limit': i})
+            for i in range(100)]}}
+
+    def test_hashed_keys(self):
+        params = {'search': 'x' * 1000}
+        self.assertEqual(len(hashed_key('details', params)), 48)
+        self.cache.set('details', params, entry(1))
+        self.assertEqual(self.cache.get('details', params), entry(1))
+
+    def test_chunks(self):
+        self.cache.set('details', {}, self.large)
+        self.assertGreater(len(self.client.items), 2)
+        self.assertEqual(self.cache.get('details', {}), self.large)
+
+    def test_missing_chunk(self):
+        self.cache.set('details', {}, self.large)
+        chunk = [k for k in self.client.items if k.endswith(':1')][0]
+        del self.client.items[chunk]
+        self.assertIsNone(self.cache.get('details', {}))
+
+    def test_stale_chunk(self):
+        self.cache.set('details', {}, self.large)
+        chunk = [k for k in self.client.items if k.endswith(':0')][0]
+        self.client.items[chunk] = self.client.items[chunk][::-1]
+        self.assertIsNone(self.cache.get('details', {}))
+
+    def test_many(self):
+        self.cache.set_many([('details', {}, self.large),
+            ('summary', {}, entry(1))])
+        self.client.calls = 0
+        self.assertEqual(self.cache.get_many([('summary', {}),
+            ('details', {}), ('bandwidth', {})]),
+            [entry(1), self.large, None])
+        self.assertEqual(self.client.calls, 2)
+
+    def test_lock(self):
+        with self.cache.lock('details', {}) as acquired:
+            self.assertTrue(acquired)
+            with self.cache.lock('details', {}, timeout=0.1) as acquired:
+                self.assertFalse(acquired)
+            self.assertEqual(len(self.client.items), 1)
+        self.assertEqual(self.client.items, {})
+        # an expired lock taken over by someone else is left alone
+        with self.cache.lock('details', {}):
+            self.client.items[hashed_key('details', {}) + ':lock'] = b'other'
+        self.assertEqual(len(self.client.items), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+import json
+from onion_py.objects import *
+from onion_py.streaming import *
+from onion_py.diff import *
+
+OLD = {
+    'version': '4.0',
+    'relays_published': '2015-01-01 00:00:00',
+    'relays': [
+        {'nickname': 'a', 'fingerprint': 'A' * 40, 'flags': ['Running'],
+            'or_addresses': ['10.0.0.1:9001'], 'last_seen': '2015-01-01 00:00:00'},
+        {'nickname': 'b', 'fingerprint': 'B' * 40, 'flags': ['Running', 'Exit'],
+            'exit_policy_summary': {'accept': ['80']}},
+        {'nickname': 'c', 'fingerprint': 'C' * 40, 'flags': []},
+    ],
+    'bridges': [
+        {'nickname': 'x', 'hashed_fingerprint': 'A' * 40, 'running': True},
+    ]
+}
+
+NEW = {
+    'version': '4.0',
+    'relays_published': '2015-01-01 01:00:00',
+    'relays': [
+        {'nickname': 'a', 'fingerprint': 'A' * 40, 'flags': ['Running'],
+            'or_addresses': ['10.0.0.1:9001'], 'last_seen': '2015-01-01 01:00:00'},
+        {'nickname': 'b', 'fingerprint': 'B' * 40, 'flags': ['Running'],
+            'family': ['$' + 'D' * 40]},
+        {'nickname': 'd', 'fingerprint': 'D' * 40, 'flags': ['Running']},
+    ],
+    'bridges': [
+        {'nickname': 'x', 'hashed_fingerprint': 'A' * 40, 'running': False},
+    ]
+}
+
+
+def summary(changes):
+    return [(c.change, c.kind, c.key[0]) for c in changes]
+
+
+class TestDiff(unittest.TestCase):
+    """ Test case for snapshot diffs """
+
+    def test_diff(self):
+        changes = diff(Details(OLD), Details(NEW), ignore=['last_seen'])
+        self.assertEqual(summary(changes), [('changed', 'relays', 'B'),
+            ('added', 'relays', 'D'), ('changed', 'bridges', 'A'),
+            ('removed', 'relays', 'C')])
+        self.assertEqual(changes[0].fields, {
+            'flags': (['Running', 'Exit'], ['Running']),
+            'exit_policy_summary': ({'accept': ['80']}, None),
+            'family': (None, ['$' + 'D' * 40])})
+        self.assertEqual(changes[2].to_dict(), {'change': 'changed',
+            'kind': 'bridges', 'key': 'A' * 40,
+            'fields': {'running': {'old': True, 'new': False}}})
+        self.assertEqual(str(changes[3]), 'relay ' + 'C' * 40 + ' removed')
+
+    def test_unchanged(self):
+        self.assertEqual(diff(OLD, Details(OLD)), [])
+        changes = diff(OLD, NEW)
+        self.assertEqual(changes[0].fields, {'last_seen':
+            ('2015-01-01 00:00:00', '2015-01-01 01:00:00')})
+
+    def test_empty_snapshot(self):
+        # a raw document without records is not mistaken for an index
+        self.assertEqual(summary(diff({'version': '4.0'}, NEW)),
+            [('added', 'relays', 'A'), ('added', 'relays', 'B'),
+            ('added', 'relays', 'D'), ('added', 'bridges', 'A')])
+        self.assertEqual(summary(diff(index_records(OLD), NEW)),
+            summary(diff(OLD, NEW)))
+
+    def test_index_ignore(self):
+        # an index built without ignoring last_seen
+        self.assertEqual(summary(diff(index_records(OLD), NEW,
+            ignore=['last_seen'])), summary(diff(OLD, NEW,
+            ignore=['last_seen'])))
+
+    def test_digest_ignores_key_order(self):
+        self.assertEqual(record_digest({'a': 1, 'b': 2}),
+            record_digest({'b': 2, 'a': 1}))
+        self.assertEqual(record_digest({'a': 1, 'b': 2}, {'b'}),
+            record_digest({'a': 1, 'b': 3}, {'b'}))
+
+    def test_stream(self):
+        text = json.dumps(NEW)
+        chunks = [text[i:i + 7] for i in range(0, len(text), 7)]
+        stream = DocumentStream(Details, DocumentParser(chunks).events())
+        changes = iter_diff(OLD, stream, ignore=['last_seen'])
+        self.assertEqual(next(changes).key, 'B' * 40)
+        self.assertEqual(len(list(changes)), 3)
+
+    def test_feed(self):
+        feed = ChangeFeed(ignore=['last_seen'])
+        self.assertEqual(feed.update(Details(OLD)), [])
+        self.assertEqual(len(feed.update(Details(NEW))), 4)
+        self.assertEqual(feed.published, ('2015-01-01 01:00:00', None))
+        self.assertEqual(feed.update(NEW), [])
+        self.assertEqual(summary(feed.update(OLD))[-1],
+            ('removed', 'relays', 'D'))
+
+if __name__ == '__main__':
+    unittest.main()
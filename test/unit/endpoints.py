@@ -0,0 +1,158 @@
+import unittest
+import socket
+import time
+from onion_py.manager import *
+from onion_py.caching import OnionSimpleCache
+from onion_py.synthetic import SyntheticNetwork
+from onion_py.server import OnionooServer
+from onion_py.endpoints import *
+
+PUBLISHED = int(time.time()) // 3600 * 3600
+
+
+def unused_url():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return 'http://127.0.0.1:%d/' % port
+
+
+class TestEndpointPool(unittest.TestCase):
+    """ Test case for endpoint selection """
+
+    def test_ranking(self):
+        pool = EndpointPool(['http://a', 'http://b/', 'http://c/'],
+            backoff=10, max_backoff=25)
+        a, b, c = pool.endpoints
+        self.assertEqual(a.host, 'http://a/')
+        self.assertEqual(pool.ranked(), [a, b, c])
+        pool.success(a, 0.5)
+        pool.success(b, 0.1)
+        # unmeasured endpoints are tried first
+        self.assertEqual(pool.ranked(), [c, b, a])
+        pool.success(c, 0.3)
+        self.assertEqual(pool.ranked(), [b, c, a])
+        pool.failure(b, now=100)
+        self.assertEqual(pool.ranked(now=105), [c, a, b])
+        self.assertEqual(pool.ranked(now=111), [b, c, a])
+        pool.failure(c, now=100)
+        pool.failure(c, now=100)
+        self.assertEqual(c.down_until, 120)
+        self.assertEqual(pool.ranked(now=105), [a, b, c])
+        pool.failure(c, now=100)
+        self.assertEqual(c.down_until, 125)
+        pool.success(c, 0.3)
+        self.assertEqual(c.failures, 0)
+        self.assertEqual(pool.endpoint_for('http://b/details?x=1'), b)
+        self.assertEqual(pool.endpoint_for('http://d/details'), None)
+        self.assertRaises(ValueError, EndpointPool, [])
+
+    def test_hedge_delay(self):
+        pool = EndpointPool(['http://a/'], hedge_percentile=0.9,
+            hedge_min=0.05, min_samples=10)
+        endpoint = pool.endpoints[0]
+        for i in range(9):
+            pool.success(endpoint, (i + 1) / 10.0)
+        self.assertEqual(pool.hedge_delay(endpoint), None)
+        pool.success(endpoint, 1.0)
+        self.assertEqual(pool.hedge_delay(endpoint), 1.0)
+        self.assertEqual(endpoint.percentile(0.5), 0.6)
+        pool.hedge_percentile = None
+        self.assertEqual(pool.hedge_delay(endpoint), None)
+
+
+class TestMirrors(unittest.TestCase):
+    """ Test case for managers using several mirrors """
+
+    def setUp(self):
+        self.servers = [OnionooServer(SyntheticNetwork(relays=20, seed=1,
+            published=PUBLISHED)).start() for i in range(2)]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def manager(self, pool):
+        return Manager(OnionSimpleCache(), onionoo_host=pool,
+            publication_interval=0, min_fresh=0, reuse_supersets=False)
+
+    def test_failover(self):
+        a, b = self.servers
+        manager = self.manager([a.url, b.url])
+        a.fail_next(503)
+        self.assertEqual(len(manager.query('summary').relays), 20)
+        self.assertEqual((a.statuses, b.statuses), ({503: 1}, {200: 1}))
+        self.assertEqual(manager.endpoints.stats()['failovers'], 1)
+        # a is demoted
+        manager.query('details')
+        self.assertEqual(b.statuses, {200: 2})
+
+        manager = self.manager([unused_url(), a.url])
+        self.assertEqual(len(manager.query('summary').relays), 20)
+        self.assertEqual(manager.endpoints.ranked()[0].host, a.url)
+
+        manager = self.manager([a.url, b.url])
+        a.fail_next(503)
+        b.fail_next(500)
+        self.assertRaises(ServiceUnavailableError, manager.query, 'summary')
+        manager = self.manager([unused_url()])
+        self.assertRaises(requests.ConnectionError, manager.query, 'summary')
+
+    def test_bad_request_not_retried(self):
+        a, b = self.servers
+        manager = self.manager([a.url, b.url])
+        self.assertRaises(BadRequestError, manager.query, 'details',
+            first_seen_days='x')
+        self.assertEqual(b.statuses, {})
+
+    def test_hedging(self):
+        pool = EndpointPool([server.url for server in self.servers],
+            hedge_percentile=0.9, hedge_min=0.01, min_samples=2)
+        manager = self.manager(pool)
+        for i in range(8):
+            manager.query('summary', limit=i + 1)
+        slow, fast = [self.servers[pool.endpoints.index(e)]
+            for e in pool.ranked()]
+        answered = fast.statuses.get(200, 0)
+        hedges = pool.stats()['hedges']
+        slow.latency = 1.0
+        start = time.time()
+        self.assertEqual(len(manager.query('summary').relays), 20)
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEqual(pool.stats()['hedges'], hedges + 1)
+        self.assertEqual(fast.statuses[200], answered + 1)
+        manager.close()
+
+    def test_outdated_mirror(self):
+        a, b = self.servers
+        b.publish(SyntheticNetwork(relays=5, seed=1, published=PUBLISHED - 3600))
+        manager = self.manager([a.url, b.url])
+        document = manager.query('details')
+        a.fail_next(503)
+        document = manager.query('details')
+        self.assertEqual(b.statuses, {200: 1})
+        self.assertEqual(len(document.relays), 20)
+        cached = manager.cache_client.get('details', {})
+        self.assertEqual(len(cached['record']['relays']), 20)
+        self.assertGreater(manager.endpoints.endpoints[1].error_rate, 0)
+
+    def test_iter_query(self):
+        a, b = self.servers
+        b.publish(SyntheticNetwork(relays=5, seed=1, published=PUBLISHED - 3600))
+        manager = self.manager([a.url, b.url])
+        self.assertEqual(len(list(manager.iter_query('summary'))), 25)
+        b.fail_next(503)
+        manager.query('summary')
+        error_rate = manager.endpoints.endpoints[1].error_rate
+        a.fail_next(503)
+        # fails over to b, whose older publication is replaced by the cached one
+        self.assertEqual(len(list(manager.iter_query('summary'))), 25)
+        self.assertEqual((a.statuses, b.statuses),
+            ({200: 2, 503: 1}, {200: 1, 503: 1}))
+        stats = manager.endpoints.stats()
+        self.assertEqual(stats['failovers'], 2)
+        self.assertEqual(stats['endpoints'][a.url]['requests'], 3)
+        self.assertEqual(stats['endpoints'][b.url]['requests'], 2)
+        self.assertGreater(manager.endpoints.endpoints[1].error_rate,
+            error_rate)
@@ -0,0 +1,87 @@
+import unittest
+from onion_py.objects import *
+from onion_py.exitpolicy import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RELAYS = [
+    {'fingerprint': 'A' * 40, 'running': True, 'exit_probability': 0.5,
+        'exit_policy_summary': {'accept': ['80', '443', '8000-8080']},
+        'exit_policy_v6_summary': {'accept': ['443']}},
+    {'fingerprint': 'B' * 40, 'running': True, 'exit_probability': 0.25,
+        'exit_policy_summary': {'reject': ['25', '80-81']}},
+    {'fingerprint': 'C' * 40, 'running': True, 'exit_probability': 0.0,
+        'exit_policy_summary': {'reject': ['1-65535']}},
+    {'fingerprint': 'D' * 40, 'running': False, 'exit_probability': 0.25,
+        'exit_policy_summary': {'accept': ['80']}},
+    ]
+
+
+class TestPortPolicy(unittest.TestCase):
+    """ Test case for compiled exit policy summaries """
+
+    def test_accept(self):
+        policy = PortPolicy.from_summary({'accept': ['443', '80', '81-90',
+            '8000-8080']})
+        self.assertEqual(policy.intervals(), [(80, 90), (443, 443),
+            (8000, 8080)])
+        self.assertTrue(policy.allows(8080))
+        self.assertTrue(policy.allows(90))
+        self.assertFalse(policy.allows(91))
+        self.assertFalse(policy.allows(1))
+
+    def test_reject(self):
+        policy = PortPolicy.from_summary({'reject': ['25', '80-81', '65535']})
+        self.assertEqual(policy.intervals(), [(1, 24), (26, 79),
+            (82, 65534)])
+        self.assertFalse(policy.allows(25))
+        self.assertTrue(policy.allows(443))
+        self.assertEqual(PortPolicy.from_summary(None).intervals(), [])
+        self.assertEqual(
+            PortPolicy.from_summary({'reject': ['1-65535']}).intervals(), [])
+
+    def test_shared(self):
+        self.assertIs(compile_policy({'accept': ['80']}),
+            compile_policy({'accept': ['80']}))
+
+    def test_relay(self):
+        relay = RelayDetails(RELAYS[0])
+        self.assertTrue(relay.check_exitport())
+        self.assertTrue(relay.check_exitport(8080))
+        self.assertFalse(relay.allows_port(80, ipv6=True))
+        self.assertTrue(relay.allows_port(443, ipv6=True))
+        self.assertFalse(RelayDetails(RELAYS[1]).check_exitport())
+        self.assertFalse(RelayDetails({}).check_exitport())
+
+
+@unittest.skipIf(numpy is None, 'numpy not installed')
+class TestExitPortIndex(unittest.TestCase):
+    """ Test case for the network-wide port index """
+
+    def setUp(self):
+        self.index = ExitPortIndex(Details({'version': '4.0',
+            'relays': RELAYS, 'bridges': []}))
+
+    def test_allowing(self):
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.allowing(80), ['A' * 40])
+        self.assertEqual(self.index.allowing(8001), ['A' * 40, 'B' * 40])
+        self.assertEqual(self.index.count(25), 0)
+
+    def test_many_ports(self):
+        self.assertEqual(self.index.total_exit_probability(443), 0.75)
+        self.assertEqual(list(self.index.count([25, 80, 443])), [0, 1, 2])
+        self.assertEqual(list(self.index.total_exit_probability([80, 22])),
+            [0.5, 0.25])
+
+    def test_options(self):
+        index = ExitPortIndex(RELAYS, running_only=False)
+        self.assertEqual(index.count(80), 2)
+        index = ExitPortIndex(RELAYS, ipv6=True)
+        self.assertEqual(index.allowing(443), ['A' * 40])
+
+if __name__ == '__main__':
+    unittest.main()
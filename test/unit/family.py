@@ -0,0 +1,53 @@
+import unittest
+from onion_py.objects import *
+from onion_py.family import *
+
+A, B, C, D, E = ['%040X' % i for i in range(1, 6)]
+
+RELAYS = [
+    {'nickname': 'alpha', 'fingerprint': A, 'exit_probability': 0.1,
+        'family': ['$' + B, 'gamma', '$' + D + '=delta', 'ghost']},
+    {'nickname': 'beta', 'fingerprint': B, 'exit_probability': 0.2,
+        'family': ['$' + A.lower()]},
+    {'nickname': 'gamma', 'fingerprint': C, 'exit_probability': 0.3,
+        'effective_family': ['$' + A, '$' + C], 'alleged_family': ['$' + E]},
+    {'nickname': 'delta', 'fingerprint': D, 'exit_probability': 0.4},
+    {'nickname': 'dup', 'fingerprint': E, 'family': ['dup']},
+    {'nickname': 'dup', 'fingerprint': 'F' * 40},
+    ]
+
+
+class TestFamilyGraph(unittest.TestCase):
+    """ Test case for the family graph """
+
+    def setUp(self):
+        self.graph = FamilyGraph(Details({'version': '4.0', 'relays': RELAYS,
+            'bridges': []}))
+
+    def test_resolve(self):
+        self.assertEqual(self.graph.resolve('$' + B + '~beta'), 1)
+        self.assertEqual(self.graph.resolve('GAMMA'), 2)
+        self.assertIsNone(self.graph.resolve('dup'))
+        self.assertIsNone(self.graph.resolve('$nothex'))
+
+    def test_mutual(self):
+        self.assertEqual(self.graph.mutual_members('alpha'), [B, C])
+        self.assertEqual(self.graph.mutual_members(B), [A])
+        self.assertEqual(self.graph.one_sided('alpha'), [D])
+        self.assertEqual(self.graph.declared_by_others('delta'), [A])
+        self.assertEqual(self.graph.one_sided('gamma'), [E])
+        self.assertEqual(self.graph.unresolved_members(A), ['ghost'])
+        self.assertEqual(self.graph.unresolved_members(E), ['dup'])
+        with self.assertRaises(KeyError):
+            self.graph.mutual_members('nobody')
+
+    def test_families(self):
+        family = self.graph.family(B)
+        self.assertEqual(family.fingerprints, [A, B, C])
+        self.assertAlmostEqual(family.aggregates['exit_probability'], 0.6)
+        self.assertEqual([f.fingerprints for f in self.graph.families()],
+            [[A, B, C]])
+        self.assertEqual(len(self.graph.families(min_size=1)), 4)
+
+if __name__ == '__main__':
+    unittest.main()
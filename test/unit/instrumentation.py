@@ -0,0 +1,106 @@
+import unittest
+import json
+import mock
+from onion_py.manager import *
+from onion_py.caching import OnionSimpleCache
+from onion_py.instrumentation import *
+
+
+class FakeResponse:
+    def __init__(self, code):
+        self.status_code = code
+        self.headers = {'Last-Modified': 'Thu, 01 Jan 2015 12:00:00 GMT'}
+        self.reason = ''
+        self.url = ''
+        self.content = b''
+        if code == 200:
+            self.content = json.dumps({'version': '4.0',
+                'relays_published': '2015-01-01 12:00:00',
+                'relays': [{'nickname': 'a', 'fingerprint': 'AAAA'}],
+                'bridges_published': '2015-01-01 11:00:00',
+                'bridges': []}).encode('utf-8')
+
+
+class TestHistogram(unittest.TestCase):
+    """ Test case for the histogram """
+
+    def test_observe(self):
+        h = Histogram([0.1, 1, 10])
+        for value in [0.05, 0.1, 0.5, 5, 50]:
+            h.observe(value)
+        self.assertEqual(h.count, 5)
+        self.assertAlmostEqual(h.sum, 55.65)
+        self.assertEqual(h.cumulative(), [(0.1, 2), (1, 3), (10, 4),
+            (float('inf'), 5)])
+        self.assertEqual(h.quantile(0.5), 1)
+        self.assertEqual(h.quantile(1), float('inf'))
+        self.assertEqual(Histogram([1]).quantile(0.5), None)
+
+
+class TestInstrumentation(unittest.TestCase):
+    """ Test case for manager instrumentation """
+
+    def setUp(self):
+        self.metrics = MetricsAggregator()
+        self.manager = Manager(OnionSimpleCache(), reuse_supersets=False,
+            min_fresh=0, publication_interval=0, instrumentation=self.metrics)
+
+    def test_miss_hit_not_modified(self):
+        with mock.patch('onion_py.manager.requests.Session.get') as get:
+            get.return_value = FakeResponse(200)
+            self.manager.query('details')
+            get.return_value = FakeResponse(304)
+            self.manager.query('details')
+        summary = self.metrics.summary()
+        self.assertEqual(summary['outcomes'], {('details', 'miss'): 1,
+            ('details', 'not_modified'): 1})
+        self.assertEqual(summary['bytes'],
+            {'details': len(FakeResponse(200).content)})
+        self.assertEqual(summary['versions'], {('details', '4.0'): 2})
+        phases = summary['phases']
+        for phase in ['download', 'decode', 'cache_set', 'build', 'total']:
+            self.assertEqual(phases[('details', phase)]['count'], 2)
+        # looked up again under the cache lock before each request
+        self.assertEqual(phases[('details', 'cache_get')]['count'], 4)
+
+        self.manager.min_fresh = 60
+        with mock.patch('onion_py.manager.requests.Session.get') as get:
+            get.return_value = FakeResponse(304)
+            self.manager.query('details')
+            self.manager.query('details')
+        self.assertEqual(self.metrics.summary()['outcomes'][('details',
+            'hit')], 1)
+
+    def test_error(self):
+        with mock.patch('onion_py.manager.requests.Session.get') as get:
+            get.return_value = FakeResponse(503)
+            self.assertRaises(ServiceUnavailableError, self.manager.query,
+                'summary')
+        self.assertEqual(self.metrics.summary()['outcomes'],
+            {('summary', 'error'): 1})
+
+    def test_exposition(self):
+        with mock.patch('onion_py.manager.requests.Session.get') as get:
+            get.return_value = FakeResponse(200)
+            self.manager.query('details')
+        text = self.metrics.exposition()
+        self.assertIn('# TYPE onionpy_phase_seconds histogram\n', text)
+        self.assertIn('onionpy_phase_seconds_bucket{query="details",'
+            'phase="download",le="+Inf"} 1\n', text)
+        self.assertIn('onionpy_phase_seconds_count{query="details",'
+            'phase="build"} 1\n', text)
+        self.assertIn('onionpy_queries_total{query="details",'
+            'outcome="miss"} 1\n', text)
+        self.assertIn('onionpy_response_bytes_total{query="details"} %d\n'
+            % len(FakeResponse(200).content), text)
+        self.assertIn('onionpy_documents_total{query="details",'
+            'version="4.0"} 1\n', text)
+        self.metrics.reset()
+        self.assertNotIn('onionpy_queries_total{', self.metrics.exposition())
+
+    def test_disabled(self):
+        manager = Manager(OnionSimpleCache())
+        self.assertIs(manager._phase('details', 'download'), NULL_TIMER)
+        with mock.patch('onion_py.manager.requests.Session.get') as get:
+            get.return_value = FakeResponse(200)
+            self.assertEqual(manager.query('details').relays[0].nickname, 'a')
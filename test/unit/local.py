@@ -0,0 +1,293 @@
+import unittest
+import hashlib
+import binascii
+import mock
+from onion_py.objects import *
+from onion_py.manager import *
+from onion_py.local import *
+from onion_py.caching import OnionSimpleCache
+
+SNAPSHOT = {
+    'version': '4.0',
+    'relays_published': '2015-01-01 00:00:00',
+    'bridges_published': '2015-01-01 00:00:00',
+    'relays': [
+        {'nickname': 'moria1', 'fingerprint': '9695DFC35FFEB861329B9F1AB04C46397020CE31',
+            'or_addresses': ['128.31.0.34:9101'], 'running': True,
+            'flags': ['Authority', 'Running', 'Valid'], 'country': 'us',
+            'as_number': 'AS3', 'consensus_weight': 20, 'contact': '1024D/28988BF5 arma mit edu'},
+        {'nickname': 'tor26', 'fingerprint': '847B1F850344D7876491A54892F904934E4EB85D',
+            'or_addresses': ['86.59.21.38:443', '[2001:858:2:2:aabb:0:563b:1526]:443'],
+            'exit_addresses': ['86.59.21.39'], 'running': True,
+            'flags': ['Authority', 'Exit', 'Running'], 'country': 'at',
+            'as_number': 'AS3058', 'consensus_weight': 100},
+        {'nickname': 'Unnamed', 'fingerprint': 'A' * 40,
+            'or_addresses': ['10.0.0.1:9001'], 'running': False,
+            'flags': [], 'country': 'us', 'as_number': 'AS3',
+            'consensus_weight': 50},
+    ],
+    'bridges': [
+        {'nickname': 'bridgey', 'hashed_fingerprint': 'B' * 40,
+            'running': True, 'flags': ['Running', 'Valid']},
+        {'nickname': 'Unnamed', 'hashed_fingerprint': 'C' * 40,
+            'running': False, 'flags': []},
+    ]
+}
+
+
+def keys(document):
+    return [r.get('fingerprint') or r.get('hashed_fingerprint') or
+        r.get('f') or r.get('h')
+        for r in document['relays'] + document['bridges']]
+
+
+class TestSnapshotIndex(unittest.TestCase):
+    """ Test case for the local query engine """
+
+    def setUp(self):
+        self.index = SnapshotIndex(SNAPSHOT)
+        self.moria = SNAPSHOT['relays'][0]['fingerprint']
+        self.tor26 = SNAPSHOT['relays'][1]['fingerprint']
+
+    def evaluate(self, **params):
+        return keys(self.index.evaluate('details', params))
+
+    def test_unfiltered(self):
+        doc = self.index.evaluate('details', {})
+        self.assertEqual(doc['relays'], SNAPSHOT['relays'])
+        self.assertEqual(doc['relays_published'], '2015-01-01 00:00:00')
+
+    def test_filters(self):
+        self.assertEqual(self.evaluate(type='bridge'), ['B' * 40, 'C' * 40])
+        self.assertEqual(self.evaluate(running='false'), ['A' * 40, 'C' * 40])
+        self.assertEqual(self.evaluate(country='US'), [self.moria, 'A' * 40])
+        self.assertEqual(self.evaluate(**{'as': '3'}), [self.moria, 'A' * 40])
+        self.assertEqual(self.evaluate(**{'as': 'AS3058'}), [self.tor26])
+        self.assertEqual(self.evaluate(flag='valid'), [self.moria, 'B' * 40])
+        self.assertEqual(self.evaluate(contact='ARMA'), [self.moria])
+
+    def test_lookup(self):
+        hashed = Manager._hash_fingerprint(self.tor26)
+        self.assertEqual(self.evaluate(lookup=hashed), [self.tor26])
+        self.assertEqual(self.evaluate(lookup=self.moria.lower() + ',' +
+            'B' * 40), [self.moria, 'B' * 40])
+
+    def test_search(self):
+        self.assertEqual(self.evaluate(search='ori'), [self.moria])
+        self.assertEqual(self.evaluate(search='$847b'), [self.tor26])
+        self.assertEqual(self.evaluate(search='86.59'), [self.tor26])
+        self.assertEqual(self.evaluate(search='[2001:858'), [self.tor26])
+        self.assertEqual(self.evaluate(search='unnamed'), ['A' * 40, 'C' * 40])
+        self.assertEqual(self.evaluate(search='unnamed running'), [])
+        with self.assertRaises(UnsupportedQueryError):
+            self.evaluate(search='country:us')
+
+    def test_search_fingerprints(self):
+        hashed = hashlib.sha1(binascii.unhexlify(self.moria)).hexdigest()
+        self.assertEqual(self.evaluate(search=hashed.upper()), [self.moria])
+        self.assertEqual(self.evaluate(search=hashed[:10]), [self.moria])
+        self.assertEqual(self.evaluate(search='$' + hashed[:10]), [self.moria])
+        # blocks of '9695 DFC3 5FFE B861 ...'
+        self.assertEqual(self.evaluate(search='DFC3'), [self.moria])
+        self.assertEqual(self.evaluate(search='dfc3 b861'), [self.moria])
+        self.assertEqual(self.evaluate(search='FC35'), [])
+        self.assertEqual(self.evaluate(search='AAAA'), ['A' * 40])
+        # bridges are found by their hashed fingerprint hashed once more
+        twice = hashlib.sha1(binascii.unhexlify('B' * 40)).hexdigest()
+        self.assertEqual(self.evaluate(search=twice[:8]), ['B' * 40])
+        self.assertEqual(self.evaluate(search='BBBB'), ['B' * 40])
+
+    def test_search_indexes(self):
+        self.evaluate(country='us', lookup=self.moria)
+        self.assertIsNone(self.index._search)
+        # base64 fingerprint prefix and the end of a nickname
+        self.assertEqual(self.evaluate(search='lpXfw1/+'), [self.moria])
+        self.assertEqual(self.evaluate(search='IDGEY'), ['B' * 40])
+        self.assertEqual(self.evaluate(search='26'), [self.tor26])
+        self.assertIsNotNone(self.index._search)
+
+    def test_order_offset_limit(self):
+        self.assertEqual(self.evaluate(order='-consensus_weight', limit=2),
+            [self.tor26, 'A' * 40])
+        self.assertEqual(self.evaluate(offset=2, limit=2), ['A' * 40, 'B' * 40])
+        self.assertEqual(self.evaluate(offset=4), ['C' * 40])
+        with self.assertRaises(ValueError):
+            self.evaluate(order='nickname')
+
+    def test_fields(self):
+        doc = self.index.evaluate('details', {'fields': 'Nickname,running',
+            'type': 'relay', 'limit': 1})
+        self.assertEqual(doc['relays'], [{'nickname': 'moria1',
+            'running': True}])
+
+    def test_summary(self):
+        doc = self.index.evaluate('summary', {'search': 'tor26'})
+        self.assertEqual(doc['relays'], [{'n': 'tor26', 'f': self.tor26,
+            'a': ['86.59.21.38', '2001:858:2:2:aabb:0:563b:1526', '86.59.21.39'],
+            'r': True}])
+        doc = self.index.evaluate('summary', {'type': 'bridge'})
+        self.assertEqual(doc['bridges'][1], {'h': 'C' * 40, 'r': False})
+
+    def test_validate(self):
+        recorded = {
+            (('type', 'relay'),): {'version': '4.0',
+                'relays_published': '2015-01-01 00:00:00',
+                'bridges_published': '2015-01-01 00:00:00',
+                'relays': SNAPSHOT['relays'], 'bridges': []},
+            (('limit', 1),): {'version': '4.0',
+                'relays_published': '2015-01-01 00:00:00',
+                'bridges_published': '2015-01-01 00:00:00',
+                'relays': SNAPSHOT['relays'][1:2], 'bridges': []},
+        }
+        fetch = lambda query, params: recorded[tuple(sorted(params.items()))]
+        failures = validate(self.index, fetch,
+            [('details', {'type': 'relay'}), ('details', {'limit': 1})])
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0][1], {'limit': 1})
+        self.assertIn('relays: missing', failures[0][2][0])
+
+
+class FakeResponse:
+    def __init__(self, document):
+        import json
+        self.status_code = 200
+        self.headers = {}
+        self.reason = ''
+        self.url = ''
+        self.content = json.dumps(document).encode('utf-8')
+
+
+class TestSnapshotManager(unittest.TestCase):
+    """ Test case for the Manager's snapshot mode """
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_local_answers(self, mock_get):
+        mock_get.return_value = FakeResponse(SNAPSHOT)
+        m = Manager(snapshot=True)
+        self.assertEqual(len(m.query('details', country='us').relays), 2)
+        self.assertEqual(m.query('summary', type='bridge').bridges[0].hash,
+            'B' * 40)
+        self.assertEqual(len(m.query('details', lookup='A' * 40).relays), 1)
+        self.assertEqual(mock_get.call_count, 1)
+        mock_get.assert_called_with(m.OOO_URL + 'details', params={},
+            headers=None, timeout=m.timeout)
+        with self.assertRaises(BadRequestError):
+            m.query('details', type='node')
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_fallback(self, mock_get):
+        mock_get.return_value = FakeResponse(SNAPSHOT)
+        m = Manager(snapshot=True)
+        m.query('bandwidth', limit=1)
+        m.query('details', search='country:us')
+        self.assertEqual(mock_get.call_args_list[0][0][0], m.OOO_URL + 'bandwidth')
+        self.assertEqual(mock_get.call_args_list[-1][1]['params'],
+            {'search': 'country:us'})
+
+
+class TestDerivation(unittest.TestCase):
+    """ Test case for answering queries from superset responses """
+
+    def test_window(self):
+        base = {'limit': '4', 'offset': '1'}
+        self.assertEqual(derivation('details', {'offset': '2', 'limit': '2'},
+            'details', base), ('window', 1, 3, None))
+        doc = derive('details', {'offset': '2', 'limit': '2'}, 'details', base,
+            SnapshotIndex(SNAPSHOT).evaluate('details', base))
+        self.assertEqual(keys(doc), ['A' * 40, 'B' * 40])
+        self.assertEqual(doc['relays_published'], '2015-01-01 00:00:00')
+        for params in [{'offset': '0'}, {'offset': '2'}, {'limit': '5', 'offset': '1'}]:
+            with self.assertRaises(UnsupportedQueryError):
+                derivation('details', params, 'details', base)
+
+    def test_fields(self):
+        base = {'fields': 'country,fingerprint,nickname'}
+        doc = derive('details', {'fields': 'fingerprint'}, 'details', base,
+            SnapshotIndex(SNAPSHOT).evaluate('details', base))
+        self.assertEqual(doc['relays'][0], {'fingerprint': SNAPSHOT['relays'][0]['fingerprint']})
+        doc = derive('details', {'country': 'us', 'fields': 'nickname'},
+            'details', base, SnapshotIndex(SNAPSHOT).evaluate('details', base))
+        self.assertEqual([r['nickname'] for r in doc['relays']], ['moria1', 'Unnamed'])
+        for params in [{}, {'fields': 'running'}, {'running': 'true', 'fields': 'nickname'}]:
+            with self.assertRaises(UnsupportedQueryError):
+                derivation('details', params, 'details', base)
+
+    def test_filters(self):
+        base = {'type': 'relay', 'search': 'unnamed'}
+        record = SnapshotIndex(SNAPSHOT).evaluate('details', base)
+        self.assertEqual(derivation('details', {'type': 'relay',
+            'search': 'a unnamed', 'limit': '1'}, 'details', base),
+            ('filter', {'search': 'a', 'limit': '1'}))
+        self.assertEqual(keys(derive('details', {'type': 'relay',
+            'search': 'unnamed', 'running': 'false'}, 'details', base,
+            record)), ['A' * 40])
+        self.assertEqual(keys(derive('summary', {'type': 'relay',
+            'search': 'unnamed'}, 'details', base, record)), ['A' * 40])
+        for params in [{'search': 'unnamed'}, {'type': 'bridge', 'search': 'unnamed'},
+            {'type': 'relay', 'search': 'moria'}]:
+            with self.assertRaises(UnsupportedQueryError):
+                derivation('details', params, 'details', base)
+        with self.assertRaises(UnsupportedQueryError):
+            derivation('details', {}, 'summary', {})
+        with self.assertRaises(UnsupportedQueryError):
+            derivation('details', {'running': 'true'}, 'details', {'limit': '10'})
+
+    def test_lookup(self):
+        moria = SNAPSHOT['relays'][0]['fingerprint']
+        base = {'lookup': ','.join(sorted([moria, 'A' * 40]))}
+        record = SnapshotIndex(SNAPSHOT).evaluate('details', base)
+        self.assertEqual(keys(derive('details', {'lookup': moria}, 'details',
+            base, record)), [moria])
+        with self.assertRaises(UnsupportedQueryError):
+            derivation('details', {'lookup': 'B' * 40}, 'details', base)
+
+
+class TestSupersetReuse(unittest.TestCase):
+    """ Test case for the Manager's superset cache reuse """
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_reuse(self, mock_get):
+        mock_get.return_value = FakeResponse(SNAPSHOT)
+        m = Manager(OnionSimpleCache(), reuse_supersets=True)
+        m.query('details')
+        self.assertEqual(len(m.query('details', country='US').relays), 2)
+        self.assertEqual(m.query('summary', type='bridge').bridges[0].hash,
+            'B' * 40)
+        self.assertEqual(m.query('details', fields=['nickname'],
+            limit=1).relays[0].nickname, 'moria1')
+        self.assertEqual(mock_get.call_count, 1)
+        # not derivable from an unfiltered response
+        m.query('details', first_seen_days='0-2')
+        self.assertEqual(mock_get.call_count, 2)
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_index_reused(self, mock_get):
+        mock_get.return_value = FakeResponse(SNAPSHOT)
+        m = Manager(OnionSimpleCache(), reuse_supersets=True)
+        m.query('details')
+        build = SnapshotIndex.__init__
+        with mock.patch.object(SnapshotIndex, '__init__', autospec=True,
+                side_effect=build) as init:
+            m.query('details', country='us')
+            m.query('details', flag='Running')
+            m.query('summary', type='bridge')
+            # window derivations need no index
+            m.query('details', limit=1)
+        self.assertEqual(init.call_count, 1)
+        self.assertEqual(mock_get.call_count, 1)
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_stale_base(self, mock_get):
+        mock_get.return_value = FakeResponse(SNAPSHOT)
+        m = Manager(OnionSimpleCache(), reuse_supersets=True)
+        m.query('details')
+        m.cache_client.get('details', {})['expires'] = 0
+        m.query('details', country='us')
+        self.assertEqual(mock_get.call_count, 2)
+        m = Manager(OnionSimpleCache())
+        m.query('details')
+        m.query('details', country='us')
+        self.assertEqual(mock_get.call_count, 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,18 +1,25 @@
 import unittest
+import json
 import mock
+import threading
 import onion_py
 from onion_py.objects import *
 from onion_py.manager import *
+from onion_py.caching import OnionSimpleCache, key_serializer
 
 class FakeResponse:
-    def __init__(self, code):
+    def __init__(self, code, relays=None, bridges=None):
         self.status_code = code
-        self.headers = None
+        self.headers = {'Last-Modified': 'Thu, 01 Jan 2015 00:00:00 GMT'}
         self.reason = ""
         self.url = ""
+        self.relays = relays or []
+        self.bridges = bridges or []
+        self.content = json.dumps(self.json()).encode('utf-8')
 
     def json(self):
-        return {'relays': [], 'bridges': []}
+        return {'version': '4.0', 'relays': self.relays,
+            'bridges': self.bridges}
 
 
 class TestExceptions(unittest.TestCase):
@@ -29,10 +36,10 @@ class TestExceptions(unittest.TestCase):
         with self.assertRaises(InvalidParameterError):
             self.req.query('details', params={'typo': 'relay'})
 
-    @mock.patch('onion_py.manager.requests')
+    @mock.patch('onion_py.manager.requests.Session.get')
     def test_onionoo_error(self, mock_requests):
         with self.assertRaises(OnionPyError):
-            mock_requests.get.return_value = FakeResponse(400)
+            mock_requests.return_value = FakeResponse(400)
             self.req.query('details', type='node')
 
 
@@ -42,21 +49,34 @@ class TestRequest(unittest.TestCase):
     def setUp(self):
         self.req = Manager()
 
-    @mock.patch('onion_py.manager.requests')
+    @mock.patch('onion_py.manager.requests.Session.get')
     def test_without_parameters(self, mock_requests):
-        mock_requests.get.return_value = FakeResponse(200)
+        mock_requests.return_value = FakeResponse(200)
         self.req.query('details')
-        mock_requests.get.assert_called_with(
-            self.req.OOO_URL + 'details', params={})
+        mock_requests.assert_called_with(
+            self.req.OOO_URL + 'details', params={}, headers=None,
+            timeout=self.req.timeout)
 
-    @mock.patch('onion_py.manager.requests')
+    @mock.patch('onion_py.manager.requests.Session.get')
     def test_with_parameters(self, mock_requests):
-        mock_requests.get.return_value = FakeResponse(200)
+        mock_requests.return_value = FakeResponse(200)
         self.req.query(
             'details', type='relay', running='true')
-        mock_requests.get.assert_called_with(
+        mock_requests.assert_called_with(
             self.req.OOO_URL + 'details',
-            params={'type': 'relay', 'running': 'true'})
+            params={'type': 'relay', 'running': 'true'}, headers=None,
+            timeout=self.req.timeout)
+
+    def test_canonical_parameters(self):
+        self.assertEqual(self.req.canonical_params({'fields': ['b', 'A', 'b'],
+            'order': '-consensus_weight, first_seen', 'search': 'b  a',
+            'lookup': '$abc,ABC', 'as': 'AS3,3320', 'running': True,
+            'country': 'DE', 'limit': 10, 'offset': None}),
+            {'fields': 'a,b', 'order': '-consensus_weight,first_seen',
+            'search': 'a b', 'lookup': 'ABC', 'as': '3,3320',
+            'running': 'true', 'country': 'de', 'limit': '10'})
+        self.assertEqual(key_serializer('details', {'fields': 'a,b'}),
+            key_serializer('details', {'fields': ['b', 'a']}))
 
 
 class TestResponseType(unittest.TestCase):
@@ -65,41 +85,431 @@ class TestResponseType(unittest.TestCase):
     def setUp(self):
         self.req = Manager()
 
-    @mock.patch('onion_py.manager.requests')
+    @mock.patch('onion_py.manager.requests.Session.get')
     def test_summary_doc(self, mock_requests):
-        mock_requests.get.return_value = FakeResponse(200)
+        mock_requests.return_value = FakeResponse(200)
         resp = self.req.query('summary')
         self.assertEqual(type(resp), Summary)
 
-    @mock.patch('onion_py.manager.requests')
+    @mock.patch('onion_py.manager.requests.Session.get')
     def test_details_doc(self, mock_requests):
-        mock_requests.get.return_value = FakeResponse(200)
+        mock_requests.return_value = FakeResponse(200)
         resp = self.req.query('details')
         self.assertEqual(type(resp), Details)
 
-    @mock.patch('onion_py.manager.requests')
+    @mock.patch('onion_py.manager.requests.Session.get')
     def test_bandwidth_doc(self, mock_requests):
-        mock_requests.get.return_value = FakeResponse(200)
+        mock_requests.return_value = FakeResponse(200)
         resp = self.req.query('bandwidth')
         self.assertEqual(type(resp), Bandwidth)
 
-    @mock.patch('onion_py.manager.requests')
+    @mock.patch('onion_py.manager.requests.Session.get')
     def test_weights_doc(self, mock_requests):
-        mock_requests.get.return_value = FakeResponse(200)
+        mock_requests.return_value = FakeResponse(200)
         resp = self.req.query('weights')
         self.assertEqual(type(resp), Weights)
 
-    @mock.patch('onion_py.manager.requests')
+    @mock.patch('onion_py.manager.requests.Session.get')
     def test_clients_doc(self, mock_requests):
-        mock_requests.get.return_value = FakeResponse(200)
+        mock_requests.return_value = FakeResponse(200)
         resp = self.req.query('clients')
         self.assertEqual(type(resp), Clients)
 
-    @mock.patch('onion_py.manager.requests')
+    @mock.patch('onion_py.manager.requests.Session.get')
     def test_uptime_doc(self, mock_requests):
-        mock_requests.get.return_value = FakeResponse(200)
+        mock_requests.return_value = FakeResponse(200)
         resp = self.req.query('uptime')
         self.assertEqual(type(resp), Uptime)
 
+class TestRevalidation(unittest.TestCase):
+    """ Test case for conditional requests and the freshness window """
+
+    def setUp(self):
+        self.req = Manager(OnionSimpleCache())
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_fresh_entry_served_from_cache(self, mock_get):
+        mock_get.return_value = FakeResponse(200)
+        self.req.query('details')
+        self.req.query('details')
+        self.assertEqual(mock_get.call_count, 1)
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_single_conditional_get(self, mock_get):
+        response = FakeResponse(200)
+        response.headers['ETag'] = '"abc"'
+        mock_get.return_value = response
+        self.req.query('details')
+        entry = self.req.cache_client.get('details', {})
+        entry['expires'] = 0
+        mock_get.return_value = FakeResponse(304)
+        resp = self.req.query('details')
+        self.assertEqual(type(resp), Details)
+        self.assertEqual(mock_get.call_count, 2)
+        mock_get.assert_called_with(self.req.OOO_URL + 'details', params={},
+            headers={'If-Modified-Since': 'Thu, 01 Jan 2015 00:00:00 GMT',
+              'If-None-Match': '"abc"'},
+            timeout=self.req.timeout)
+        self.assertGreater(entry['expires'], 0)
+
+    def test_expiry_follows_publication(self):
+        published = {'relays_published': '2015-01-01 12:00:00'}
+        now = parse_timestamp('2015-01-01 12:20:00')
+        self.assertEqual(self.req._expires(published, now),
+            parse_timestamp('2015-01-01 13:00:00'))
+        # overdue publication falls back to the minimum freshness
+        now = parse_timestamp('2015-01-01 14:00:00')
+        self.assertEqual(self.req._expires(published, now),
+            now + self.req.min_fresh)
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_cache_without_lock(self, mock_get):
+        class DictCache(object):
+            def __init__(self):
+                self.entries = {}
+            def get(self, query, params):
+                return self.entries.get(key_serializer(query, params))
+            def set(self, query, params, document):
+                self.entries[key_serializer(query, params)] = document
+        req = Manager(DictCache())
+        mock_get.return_value = FakeResponse(200)
+        self.assertEqual(type(req.query('details')), Details)
+        self.assertEqual(type(req.query('details')), Details)
+        self.assertEqual(mock_get.call_count, 1)
+
+
+class TestLookupMany(unittest.TestCase):
+    """ Test case for batched fingerprint lookups """
+
+    def setUp(self):
+        self.req = Manager()
+        self.known = ['%040X' % i for i in range(100)]
+
+    def fake_get(self, url, params, headers, timeout):
+        lookup = params['lookup'].split(',')
+        return FakeResponse(200, relays=[{'fingerprint': fp,
+            'nickname': 'relay' + fp[-2:]} for fp in lookup if fp in self.known])
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_chunks_and_missing(self, mock_get):
+        mock_get.side_effect = self.fake_get
+        wanted = self.known + ['$' + 'F' * 40]
+        result = self.req.lookup_many(wanted, fields='nickname')
+        self.assertEqual(len(result), 101)
+        self.assertIsNone(result['F' * 40])
+        self.assertEqual(result[self.known[7]].nickname, 'relay07')
+        self.assertGreater(mock_get.call_count, 1)
+        self.assertLess(mock_get.call_count, 10)
+        for call in mock_get.call_args_list:
+            self.assertIn('fingerprint', call[1]['params']['fields'])
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_hashed_fingerprint(self, mock_get):
+        fp = self.known[3]
+        hashed = Manager._hash_fingerprint(fp)
+        mock_get.return_value = FakeResponse(200, relays=[{'fingerprint': fp}])
+        result = self.req.lookup_many([hashed.lower()])
+        self.assertEqual(result[hashed].fingerprint, fp)
+
+    def test_invalid_parameter(self):
+        with self.assertRaises(InvalidParameterError):
+            self.req.lookup_many(self.known, lookup='x')
+
+
+class TestSingleFlight(unittest.TestCase):
+    """ Test case for coalescing concurrent identical queries """
+
+    def setUp(self):
+        self.req = Manager(OnionSimpleCache())
+        self.release = threading.Event()
+
+    def blocking_get(self, code):
+        def get(url, params, headers, timeout):
+            self.release.wait(5)
+            return FakeResponse(code)
+        return get
+
+    def run_threads(self, query, count=8):
+        results = []
+        def run():
+            try:
+                results.append(query())
+            except Exception as e:
+                results.append(e)
+        threads = [threading.Thread(target=run) for i in range(count)]
+        for t in threads:
+            t.start()
+        # let every thread reach the in-flight request
+        while len(self.req._inflight) == 0:
+            pass
+        threading.Timer(0.1, self.release.set).start()
+        for t in threads:
+            t.join()
+        return results
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_coalescing(self, mock_get):
+        mock_get.side_effect = self.blocking_get(200)
+        results = self.run_threads(lambda: self.req.query('details',
+            fields=['nickname', 'fingerprint']))
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual([type(r) for r in results], [Details] * 8)
+        self.assertEqual(self.req._inflight, {})
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_shared_error(self, mock_get):
+        mock_get.side_effect = self.blocking_get(503)
+        results = self.run_threads(lambda: self.req.query('summary'))
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual([type(r) for r in results],
+            [ServiceUnavailableError] * 8)
+
+
+class TestShardedQuery(unittest.TestCase):
+    """ Test case for fetching documents as offset/limit shards """
+
+    def setUp(self):
+        self.req = Manager(OnionSimpleCache())
+        self.relays = [{'fingerprint': '%040X' % i} for i in range(10)]
+        self.bridges = [{'hashed_fingerprint': '%040X' % i} for i in range(3)]
+        self.published = '2015-01-01 00:00:00'
+        self.lock = threading.Lock()
+
+    def fake_get(self, url, params, headers, timeout):
+        records = [('relays', r) for r in self.relays] + \
+            [('bridges', b) for b in self.bridges]
+        offset = int(params.get('offset') or 0)
+        end = offset + int(params['limit']) if 'limit' in params else None
+        records = records[offset:end]
+        with self.lock:
+            published = self.published
+        response = FakeResponse(200,
+            relays=[r for kind, r in records if kind == 'relays'],
+            bridges=[b for kind, b in records if kind == 'bridges'])
+        document = response.json()
+        document['relays_published'] = published
+        document['bridges_published'] = published
+        response.content = json.dumps(document).encode('utf-8')
+        return response
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_identical_to_single_fetch(self, mock_get):
+        mock_get.side_effect = self.fake_get
+        sharded = self.req.query_sharded('details', shards=4)
+        self.assertEqual(mock_get.call_count, 5)
+        single = Manager().query('details')
+        self.assertEqual(sharded.relays.raw, single.relays.raw)
+        self.assertEqual(sharded.bridges.raw, single.bridges.raw)
+        self.assertEqual(sharded.relays_published, single.relays_published)
+        offsets = sorted(int(c[1]['params'].get('offset', 0))
+            for c in mock_get.call_args_list[1:5])
+        self.assertEqual(offsets, [0, 4, 8, 12])
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_window(self, mock_get):
+        mock_get.side_effect = self.fake_get
+        sharded = self.req.query_sharded('details', shards=3, offset=2, limit=9)
+        self.assertEqual([r.fingerprint for r in sharded.relays],
+            ['%040X' % i for i in range(2, 10)])
+        self.assertEqual(len(sharded.bridges), 1)
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_straddling_publication(self, mock_get):
+        mock_get.side_effect = self.fake_get
+        # an old shard is still cached from the previous publication
+        self.req.query('details', offset=4, limit=4)
+        with self.lock:
+            self.published = '2015-01-01 01:00:00'
+        self.relays.append({'fingerprint': 'F' * 40})
+        sharded = self.req.query_sharded('details', shards=4)
+        self.assertEqual(len(sharded.relays), 11)
+        self.assertEqual(sharded.relays_published, '2015-01-01 01:00:00')
+        # preload, count, three uncached shards and the stale one again
+        self.assertEqual(mock_get.call_count, 6)
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_no_convergence(self, mock_get):
+        mock_get.side_effect = self.fake_get
+        self.req.query('details', offset=4, limit=4)
+        self.published = '2015-01-01 01:00:00'
+        with mock.patch.object(self.req, '_request',
+                return_value=self.fake_get('', {}, None, None).json()):
+            with self.assertRaises(DataError):
+                self.req.query_sharded('details', shards=4, max_attempts=2)
+
+
+class TestRecordList(unittest.TestCase):
+    """ Test case for lazily built document records """
+
+    def setUp(self):
+        self.raw = [{'fingerprint': '%040X' % i, 'nickname': 'relay%d' % i}
+            for i in range(10)]
+        self.doc = Details({'version': '4.0', 'relays': self.raw,
+            'bridges': []})
+
+    def test_lazy_construction(self):
+        with mock.patch('onion_py.objects.RelayDetails') as record_class:
+            doc = Details({'version': '4.0', 'relays': self.raw, 'bridges': []})
+            self.assertEqual(len(doc.relays), 10)
+            self.assertEqual(record_class.call_count, 0)
+            doc.relays[3]
+            doc.relays[3]
+            self.assertEqual(record_class.call_count, 1)
+
+    def test_access(self):
+        relays = self.doc.relays
+        self.assertEqual(relays[-1].nickname, 'relay9')
+        self.assertEqual([r.nickname for r in relays[2:4]],
+            ['relay2', 'relay3'])
+        self.assertEqual(len(list(relays)), 10)
+        self.assertEqual(relays.raw, self.raw)
+        with self.assertRaises(IndexError):
+            relays[10]
+
+    def test_cache_size(self):
+        relays = RecordList(self.raw, RelayDetails, cache_size=2)
+        first = relays[0]
+        relays[1]
+        self.assertIs(relays[0], first)
+        relays[2]
+        relays[3]
+        self.assertIsNot(relays[0], first)
+
+    def test_list_operations(self):
+        relays = self.doc.relays
+        records = relays[:]
+        self.assertEqual(relays, records)
+        self.assertEqual(relays, tuple(records))
+        self.assertNotEqual(relays, records[:-1])
+        self.assertEqual(relays, RecordList(list(self.raw), RelayDetails))
+        self.assertNotEqual(relays, RecordList(self.raw, RelaySummary))
+        self.assertEqual(relays + records[:1], records + records[:1])
+        self.assertEqual(records[:1] + relays, records[:1] + records)
+        self.assertEqual(json.loads(json.dumps(relays.to_list())), self.raw)
+        with self.assertRaises(TypeError):
+            relays + 1
+        with self.assertRaises(TypeError):
+            hash(relays)
+
+    def test_cache_eviction_order(self):
+        relays = RecordList(self.raw, RelayDetails, cache_size=2)
+        first = relays[0]
+        relays[1]
+        # accessing 0 again makes 1 the least recently used record
+        relays[0]
+        relays[2]
+        self.assertIs(relays[0], first)
+        self.assertEqual(list(relays._cache), [2, 0])
+
+    def test_missing_records(self):
+        doc = Uptime({'version': '4.0'})
+        self.assertIsNone(doc.relays)
+        self.assertEqual(str(doc).split()[0], 'Uptime')
+
+
+class TestRecordClasses(unittest.TestCase):
+    """ Test case for the slotted record classes """
+
+    def test_no_instance_dict(self):
+        for record_class in [RelaySummary, BridgeSummary, RelayDetails,
+                BridgeDetails, GraphHistory, BandwidthDetail, RelayWeight,
+                BridgeClient, RelayUptime, BridgeUptime]:
+            record = record_class({})
+            self.assertFalse(hasattr(record, '__dict__'), record_class)
+
+    def test_tuples(self):
+        relay = RelayDetails({'country': 'de', 'latitude': 1.0,
+            'bandwidth_rate': 1, 'advertised_bandwidth': 4})
+        self.assertEqual(relay.geo, ('de', None, None, None, 1.0, None))
+        self.assertEqual(relay.bandwidth, (1, None, None, 4))
+
+    def test_bandwidth_fingerprint_alias(self):
+        detail = BandwidthDetail({'fingerprint': 'A' * 40})
+        self.assertEqual(detail.finger_print, 'A' * 40)
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'numpy not installed')
+class TestGraphHistory(unittest.TestCase):
+    """ Test case for decoded history arrays """
+
+    def setUp(self):
+        self.history = GraphHistory({'first': '2015-01-01 00:00:00',
+            'last': '2015-01-01 01:15:00', 'interval': 900, 'factor': 2.0,
+            'count': 6, 'values': [1, None, 3, 5, None, 7]})
+
+    def test_decoded(self):
+        values = self.history.decoded()
+        self.assertEqual(list(values[[0, 2, 3, 5]]), [2.0, 6.0, 10.0, 14.0])
+        self.assertTrue(numpy.isnan(values[1]))
+        start = parse_timestamp('2015-01-01 00:00:00')
+        self.assertEqual(list(self.history.timestamps()),
+            [start + 900 * i for i in range(6)])
+
+    def test_statistics(self):
+        self.assertEqual(self.history.sum(), 32.0)
+        self.assertEqual(self.history.mean(), 8.0)
+        self.assertEqual(self.history.percentile(50), 8.0)
+        self.assertTrue(numpy.isnan(GraphHistory({'values': [None]}).mean()))
+
+    def test_resample(self):
+        timestamps, values = self.history.resample(3600)
+        self.assertEqual(list(timestamps - timestamps[0]), [0, 3600])
+        self.assertEqual(list(values), [6.0, 14.0])
+        timestamps, values = self.history.resample(3600, 'sum')
+        self.assertEqual(list(values), [18.0, 14.0])
+
+    def test_stack(self):
+        later = GraphHistory({'first': '2015-01-01 00:30:00', 'interval': 900,
+            'factor': 1, 'values': [1, 1]})
+        timestamps, matrix = stack_histories([self.history, None, later])
+        self.assertEqual(matrix.shape, (3, 6))
+        self.assertEqual(list(numpy.nanmean(matrix[[0, 2]], axis=1)),
+            [8.0, 1.0])
+        self.assertTrue(numpy.isnan(matrix[1]).all())
+        self.assertEqual(list(matrix[2, 2:4]), [1.0, 1.0])
+
+    def test_missing_timing(self):
+        history = GraphHistory({'factor': 1, 'values': [1, 2]})
+        self.assertEqual(len(history.timestamps()), 0)
+        self.assertEqual(len(GraphHistory({}).timestamps()), 0)
+        timestamps, values = history.resample(3600)
+        self.assertEqual((len(timestamps), len(values)), (0, 0))
+        timestamps, matrix = stack_histories([history, self.history])
+        self.assertTrue(numpy.isnan(matrix[0]).all())
+
+
+class TestSession(unittest.TestCase):
+    """ Test case for the pooled HTTP session """
+
+    def test_compression_header(self):
+        self.assertEqual(Manager().session.headers['Accept-Encoding'],
+            'gzip, deflate')
+        self.assertEqual(
+            Manager(compression=False).session.headers['Accept-Encoding'],
+            'identity')
+
+    def test_keep_alive(self):
+        self.assertEqual(Manager().session.headers['Connection'], 'keep-alive')
+        self.assertEqual(Manager(keep_alive=False).session.headers['Connection'],
+            'close')
+
+    def test_pool_size(self):
+        m = Manager(pool_maxsize=3)
+        self.assertEqual(m.session.get_adapter(m.OOO_URL)._pool_maxsize, 3)
+
+    def test_pool_stats(self):
+        m = Manager()
+        m.session.get_adapter(m.OOO_URL).poolmanager.connection_from_url(m.OOO_URL)
+        stats = m.pool_stats()
+        self.assertEqual(stats['https://onionoo.torproject.org:443'],
+            {'connections': 0, 'requests': 0, 'reused': 0, 'idle': 0})
+
+
 if __name__ == '__main__':
     unittest.main()
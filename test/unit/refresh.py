@@ -0,0 +1,117 @@
+import unittest
+import json
+import time
+import threading
+import mock
+from onion_py.objects import *
+from onion_py.manager import *
+from onion_py.caching import OnionSimpleCache
+from onion_py.refresh import *
+
+
+class FakeResponse:
+    def __init__(self, code, published='2015-01-01 12:00:00'):
+        self.status_code = code
+        self.headers = {'Last-Modified': 'Thu, 01 Jan 2015 12:00:00 GMT'}
+        self.reason = ''
+        self.url = ''
+        self.content = json.dumps({'version': '4.0',
+            'relays_published': published, 'relays': [],
+            'bridges_published': '2015-01-01 11:00:00',
+            'bridges': []}).encode('utf-8')
+
+
+class TestRefresher(unittest.TestCase):
+    """ Test case for the background refresher """
+
+    def setUp(self):
+        self.manager = Manager(OnionSimpleCache())
+        self.refresher = Refresher(self.manager, delay=300, retry_interval=60)
+
+    def test_next_refresh(self):
+        document = Details({'relays_published': '2015-01-01 12:00:00',
+            'bridges_published': '2015-01-01 11:00:00'})
+        now = parse_timestamp('2015-01-01 12:10:00')
+        self.assertEqual(self.refresher.next_refresh(document, now),
+            parse_timestamp('2015-01-01 13:05:00'))
+        # overdue publication
+        now = parse_timestamp('2015-01-01 13:30:00')
+        self.assertEqual(self.refresher.next_refresh(document, now), now + 60)
+        self.assertEqual(self.refresher.next_refresh(None, now), now + 60)
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_run_pending(self, mock_get):
+        mock_get.return_value = FakeResponse(200)
+        self.refresher.register('details', running=True)
+        self.refresher.register('details', running='true')
+        self.assertEqual(len(self.refresher.queries()), 1)
+        self.refresher.run_pending()
+        self.assertEqual(mock_get.call_count, 1)
+        # the 2015 publication is overdue, so it is retried
+        self.assertAlmostEqual(self.refresher.run_pending(), 60, delta=1)
+        self.assertEqual(mock_get.call_count, 1)
+        later = time.time() + 61
+        with mock.patch('onion_py.refresh.time.time') as mock_time:
+            mock_time.return_value = later
+            mock_get.return_value = FakeResponse(304)
+            self.refresher.run_pending()
+        # a refresh revalidates even a fresh entry
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertIn('If-Modified-Since', mock_get.call_args[1]['headers'])
+        self.assertEqual(self.refresher.refreshes, 2)
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_errors(self, mock_get):
+        mock_get.return_value = FakeResponse(503)
+        self.refresher.register('summary')
+        self.refresher.run_pending()
+        self.assertEqual(self.refresher.errors, 1)
+        self.assertIsInstance(self.refresher.last_error,
+            ServiceUnavailableError)
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_thread(self, mock_get):
+        refreshed = threading.Event()
+        def get(*args, **kwargs):
+            refreshed.set()
+            return FakeResponse(200)
+        mock_get.side_effect = get
+        self.refresher.register('summary')
+        with self.refresher:
+            self.assertTrue(refreshed.wait(5))
+        self.assertIsNone(self.refresher._thread)
+        self.assertEqual(mock_get.call_count, 1)
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+    """ Test case for serving stale entries during revalidation """
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_stale_served(self, mock_get):
+        release = threading.Event()
+        def get(*args, **kwargs):
+            release.wait(5)
+            return FakeResponse(200, '2015-01-01 13:00:00')
+        mock_get.return_value = FakeResponse(200)
+        manager = Manager(OnionSimpleCache(), max_stale=600)
+        manager.query('details')
+        entry = manager.cache_client.get('details', {})
+        mock_get.side_effect = get
+
+        entry['expires'] = time.time() - 10
+        document = manager.query('details')
+        self.assertEqual(document.relays_published, '2015-01-01 12:00:00')
+        release.set()
+        while manager._inflight:
+            time.sleep(0.01)
+        self.assertEqual(manager.query('details').relays_published,
+            '2015-01-01 13:00:00')
+        self.assertEqual(mock_get.call_count, 2)
+
+        # too stale to be served
+        manager.cache_client.get('details', {})['expires'] = time.time() - 601
+        manager.query('details')
+        self.assertEqual(mock_get.call_count, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import unittest
+import time
+import hashlib
+import binascii
+import requests
+from onion_py.manager import *
+from onion_py.caching import OnionSimpleCache
+from onion_py.synthetic import SyntheticNetwork
+from onion_py.server import *
+
+PUBLISHED = int(time.time()) // 3600 * 3600
+
+
+class TestOnionooServer(unittest.TestCase):
+    """ Test case for the local OnionOO server """
+
+    def setUp(self):
+        self.network = SyntheticNetwork(relays=50, bridges=10, seed=2,
+            published=PUBLISHED)
+        self.server = OnionooServer(self.network).start()
+        self.manager = Manager(OnionSimpleCache(), onionoo_host=self.server.url,
+            publication_interval=0, min_fresh=0, reuse_supersets=False)
+
+    def tearDown(self):
+        self.server.stop()
+        self.manager.close()
+
+    def test_parse_days(self):
+        self.assertEqual(parse_days('2-5'), (2, 5))
+        self.assertEqual(parse_days('3-'), (3, None))
+        self.assertEqual(parse_days('-4'), (0, 4))
+        self.assertEqual(parse_days('7'), (7, 7))
+        self.assertRaises(ValueError, parse_days, '5-2')
+        self.assertRaises(ValueError, parse_days, 'x')
+
+    def test_documents(self):
+        relays, bridges = self.network.details()
+        for query in Manager.OOO_QUERIES:
+            document = self.manager.query(query)
+            self.assertEqual(len(document.relays or []),
+                0 if query == 'clients' else 50)
+            self.assertEqual(len(document.bridges or []),
+                0 if query == 'weights' else 10)
+
+        document = self.manager.query('bandwidth', type='relay',
+            order='-consensus_weight', limit=3)
+        heaviest = sorted(relays, key=lambda r: -r['consensus_weight'])[:3]
+        self.assertEqual([r.fingerprint for r in document.relays],
+            [r['fingerprint'] for r in heaviest])
+        self.assertEqual(len(document.bridges), 0)
+
+        document = self.manager.query('details', lookup=relays[7]['fingerprint'],
+            fields=['nickname'])
+        self.assertEqual(document.relays.raw, [{'nickname': 'relay7'}])
+        document = self.manager.query('summary', first_seen_days='0-')
+        self.assertEqual(len(document.relays), 50)
+        self.assertRaises(BadRequestError, self.manager.query, 'details',
+            last_seen_days='x')
+
+    def test_local_search(self):
+        relays, bridges = self.network.details()
+        fingerprint = relays[3]['fingerprint']
+        hashed = hashlib.sha1(binascii.unhexlify(fingerprint)).hexdigest()
+        manager = Manager(OnionSimpleCache(), onionoo_host=self.server.url,
+            reuse_supersets=True)
+        manager.query('details')
+        for term in [hashed.upper(), hashed[:12], fingerprint[4:8]]:
+            local = manager.query('details', search=term)
+            remote = requests.get(self.server.url + 'details',
+                params={'search': term}).json()
+            self.assertEqual(local.relays.raw, remote['relays'])
+            self.assertEqual(local.bridges.raw, remote['bridges'])
+            self.assertIn(fingerprint,
+                [r['fingerprint'] for r in remote['relays']])
+        # answered from the cached details document
+        self.assertEqual(self.server.statuses, {200: 4})
+        manager.close()
+
+    def test_conditional(self):
+        self.manager.query('details', type='bridge')
+        self.manager.query('details', type='bridge')
+        self.assertEqual(self.server.statuses, {200: 1, 304: 1})
+        self.server.publish(SyntheticNetwork(relays=5, bridges=1, seed=2,
+            published=PUBLISHED + 3600))
+        document = self.manager.query('details', type='bridge')
+        self.assertEqual(len(document.bridges), 1)
+        self.assertEqual(self.server.statuses, {200: 2, 304: 1})
+
+    def test_compression(self):
+        r = requests.get(self.server.url + 'summary',
+            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(r.json()['relays']), 50)
+        r = requests.get(self.server.url + 'summary',
+            headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.assertEqual(int(r.headers['Content-Length']), len(r.content))
+        self.assertEqual(requests.get(self.server.url + 'foo').status_code,
+            404)
+        self.assertEqual(requests.get(self.server.url + 'summary?bar=1')
+            .status_code, 400)
+        self.assertEqual(requests.get(self.server.url + 'summary?limit=x')
+            .status_code, 400)
+        # valid, but not implemented by the local engine
+        self.assertEqual(requests.get(self.server.url +
+            'details?search=country:us').status_code, 501)
+
+    def test_unsupported_query(self):
+        with self.assertRaises(OnionooError) as context:
+            self.manager.query('details', search='country:us')
+        self.assertEqual(context.exception.code, 501)
+        with self.assertRaises(OnionooError):
+            self.manager.iter_query('details', search='country:us')
+        self.assertIsNone(self.manager.cache_client.get('details',
+            {'search': 'country:us'}))
+
+    def test_injection(self):
+        self.server.fail_next(503)
+        self.server.fail_next(500)
+        self.assertRaises(ServiceUnavailableError, self.manager.query,
+            'summary')
+        self.assertRaises(ServiceUnavailableError, self.manager.query,
+            'summary')
+        self.assertEqual(len(self.manager.query('summary').relays), 50)
+
+        self.server.errors = {400: 1.0}
+        self.assertRaises(BadRequestError, self.manager.query, 'summary')
+        self.server.errors = {}
+
+        self.server.latency = 0.2
+        start = time.time()
+        self.manager.query('summary', limit=1)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.server.latency = 0
+        self.server.bandwidth = 20000
+        start = time.time()
+        requests.get(self.server.url + 'summary',
+            headers={'Accept-Encoding': 'identity'})
+        self.assertGreaterEqual(time.time() - start,
+            len(self.network.body('summary')) / 20000.0 * 0.5)
@@ -0,0 +1,114 @@
+import unittest
+import json
+import mock
+from onion_py.objects import *
+from onion_py.manager import *
+from onion_py.streaming import *
+
+DOCUMENT = {
+    'version': '4.0',
+    'relays_published': '2015-01-01 00:00:00',
+    'relays': [{'fingerprint': '%040X' % i, 'nickname': 'relay%d' % i,
+        'consensus_weight': i, 'exit_probability': 1e-5 * i,
+        'running': i % 2 == 0} for i in range(50)],
+    'bridges_published': '2015-01-01 00:30:00',
+    'bridges': [{'hashed_fingerprint': '%040X' % i, 'nickname': u'br\xfccke'}
+        for i in range(5)]
+}
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class StreamResponse:
+    def __init__(self, document):
+        self.status_code = 200
+        self.headers = {}
+        self.body = json.dumps(document).encode('utf-8')
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        return chunked(self.body, 7)
+
+    def close(self):
+        self.closed = True
+
+
+class TestDocumentParser(unittest.TestCase):
+    """ Test case for the incremental parser """
+
+    def parse(self, chunks):
+        relays, bridges, members = [], [], {}
+        for event, key, value in DocumentParser(chunks).events():
+            if event == 'item':
+                (relays if key == 'relays' else bridges).append(value)
+            else:
+                members[key] = value
+        return relays, bridges, members
+
+    def test_matches_json(self):
+        text = json.dumps(DOCUMENT, indent=1)
+        for size in [1, 3, 64, len(text)]:
+            relays, bridges, members = self.parse(chunked(text, size))
+            self.assertEqual(relays, DOCUMENT['relays'])
+            self.assertEqual(bridges, DOCUMENT['bridges'])
+            self.assertEqual(members['bridges_published'], '2015-01-01 00:30:00')
+
+    def test_empty_arrays(self):
+        relays, bridges, members = self.parse(
+            ['{"version": "4.0", "relays": [], "bridges":[ ], "n": 12', '3}'])
+        self.assertEqual((relays, bridges), ([], []))
+        self.assertEqual(members['n'], 123)
+
+    def test_bounded_buffer(self):
+        parser = DocumentParser(chunked(json.dumps(DOCUMENT), 100))
+        longest = 0
+        for event in parser.events():
+            longest = max(longest, len(parser.buf))
+        self.assertLess(longest, 400)
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            self.parse(chunked(json.dumps(DOCUMENT)[:-20], 10))
+
+    def test_multibyte_chunks(self):
+        data = json.dumps(DOCUMENT, ensure_ascii=False).encode('utf-8')
+        relays, bridges, members = self.parse(
+            decode_chunks(chunked(data, 5)))
+        self.assertEqual(bridges[0]['nickname'], u'br\xfccke')
+
+
+class TestIterQuery(unittest.TestCase):
+    """ Test case for Manager.iter_query """
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_stream(self, mock_get):
+        response = StreamResponse(DOCUMENT)
+        mock_get.return_value = response
+        stream = Manager().iter_query('details')
+        self.assertEqual(stream.version, '4.0')
+        self.assertEqual(stream.relays_published, '2015-01-01 00:00:00')
+        self.assertIsNone(stream.bridges_published)
+        records = list(stream)
+        self.assertEqual(len(records), 55)
+        self.assertEqual(type(records[0]), RelayDetails)
+        self.assertEqual(type(records[-1]), BridgeDetails)
+        self.assertEqual(stream.bridges_published, '2015-01-01 00:30:00')
+        self.assertTrue(response.closed)
+        self.assertTrue(mock_get.call_args[1]['stream'])
+
+    @mock.patch('onion_py.manager.requests.Session.get')
+    def test_version_mismatch(self, mock_get):
+        mock_get.return_value = StreamResponse({'version': '5.0', 'relays': []})
+        with self.assertRaises(MajorVersionMismatchError):
+            Manager().iter_query('summary')
+
+    def test_record_events(self):
+        # clients documents only carry bridges
+        stream = DocumentStream(Clients, record_events(DOCUMENT))
+        self.assertEqual([type(r) for r in stream], [BridgeClient] * 5)
+        self.assertEqual(stream.bridges_published, '2015-01-01 00:30:00')
+
+if __name__ == '__main__':
+    unittest.main()
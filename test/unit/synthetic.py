@@ -0,0 +1,63 @@
+import unittest
+import json
+from onion_py.manager import Manager
+from onion_py.objects import parse_timestamp
+from onion_py.synthetic import *
+
+
+class TestSyntheticNetwork(unittest.TestCase):
+    """ Test case for the synthetic document generator """
+
+    def setUp(self):
+        self.network = SyntheticNetwork(relays=40, bridges=10, seed=3,
+            published=1420113600)
+
+    def test_deterministic(self):
+        other = SyntheticNetwork(relays=40, bridges=10, seed=3,
+            published=1420113600)
+        for query in Manager.OOO_QUERIES:
+            self.assertEqual(self.network.body(query), other.body(query))
+        other = SyntheticNetwork(relays=40, bridges=10, seed=4,
+            published=1420113600)
+        self.assertNotEqual(self.network.body('details'),
+            other.body('details'))
+
+    def test_documents(self):
+        relays, bridges = self.network.details()
+        fingerprints = [r['fingerprint'] for r in relays]
+        self.assertEqual(len(set(fingerprints)), 40)
+        self.assertAlmostEqual(sum(r['consensus_weight_fraction']
+            for r in relays), 1.0)
+        for query, document_class in Manager.OOO_QUERIES.items():
+            raw = json.loads(self.network.body(query).decode('utf-8'))
+            document = document_class(raw)
+            self.assertEqual(document.version, '4.0')
+            self.assertEqual(parse_timestamp(document.relays_published),
+                1420113600)
+            if query != 'clients':
+                self.assertEqual(len(document.relays), 40)
+                self.assertEqual(document.relays[0].fingerprint,
+                    fingerprints[0])
+            if query != 'weights':
+                self.assertEqual(len(document.bridges), 10)
+
+    def test_histories(self):
+        record = self.network.document('bandwidth')['relays'][0]
+        history = record['write_history']['1_month']
+        self.assertEqual(sorted(record['write_history']),
+            ['1_month', '1_year', '5_years', '6_months'])
+        self.assertEqual(len(history['values']), history['count'])
+        self.assertEqual(parse_timestamp(history['last']) -
+            parse_timestamp(history['first']),
+            (history['count'] - 1) * history['interval'])
+        self.assertTrue(all(v is None or 0 <= v <= 999
+            for v in history['values']))
+
+        network = SyntheticNetwork(relays=5, histories=['1_week'])
+        record = network.document('uptime')['relays'][0]
+        self.assertEqual(list(record['uptime']), ['1_week'])
+        self.assertEqual(network.document('clients')['bridges'][0]
+            ['average_clients'], {})
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, self.network.document, 'foo')
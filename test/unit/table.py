@@ -0,0 +1,66 @@
+import unittest
+from onion_py.objects import *
+
+try:
+    import numpy
+    from onion_py.table import RelayTable
+except ImportError:
+    numpy = None
+
+RELAYS = [
+    {'nickname': 'guard1', 'fingerprint': 'A' * 40, 'running': True,
+        'flags': ['Fast', 'Guard', 'Running'], 'as_number': 'AS3320',
+        'country': 'de', 'advertised_bandwidth': 20e6,
+        'consensus_weight': 300, 'exit_probability': 0.0},
+    {'nickname': 'exit1', 'fingerprint': 'B' * 40, 'running': True,
+        'flags': ['Exit', 'Guard', 'Running', 'Unknown'], 'as_number': 'AS3320',
+        'country': 'de', 'advertised_bandwidth': 5e6,
+        'consensus_weight': 200, 'exit_probability': 0.2},
+    {'nickname': 'exit2', 'fingerprint': 'C' * 40, 'running': False,
+        'flags': ['Exit'], 'as_number': 'AS1', 'country': 'us',
+        'advertised_bandwidth': 50e6, 'consensus_weight': 100,
+        'exit_probability': 0.1},
+    {'nickname': 'new', 'fingerprint': 'D' * 40},
+    ]
+
+
+@unittest.skipIf(numpy is None, 'numpy not installed')
+class TestRelayTable(unittest.TestCase):
+    """ Test case for the columnar relay table """
+
+    def setUp(self):
+        self.table = RelayTable.from_document(Details({'version': '4.0',
+            'relays': RELAYS, 'bridges': []}))
+
+    def test_columns(self):
+        t = self.table
+        self.assertEqual(len(t), 4)
+        self.assertEqual(list(t.as_number), [3320, 3320, 1, -1])
+        self.assertEqual(list(t.running), [True, True, False, False])
+        self.assertEqual(list(t['country']), ['de', 'de', 'us', ''])
+        self.assertTrue(numpy.isnan(t.consensus_weight[3]))
+        self.assertIn('Unknown', t.flag_names)
+
+    def test_filter(self):
+        t = self.table
+        selected = t.filter(t.has_flag('Running', 'Guard') &
+            (t.as_number == 3320) & (t.advertised_bandwidth > 10e6))
+        self.assertEqual([r.nickname for r in selected.relays()], ['guard1'])
+        self.assertEqual(type(selected.relays()[0]), RelayDetails)
+        self.assertEqual(len(t.filter(t.has_flag('NotAFlag'))), 0)
+
+    def test_sort(self):
+        t = self.table.sort('consensus_weight', descending=True)
+        self.assertEqual(list(t.nickname), ['guard1', 'exit1', 'exit2', 'new'])
+        exits = t.filter(t.has_flag('Exit')).sort('exit_probability')
+        self.assertEqual(list(exits.fingerprint), ['C' * 40, 'B' * 40])
+        self.assertEqual(exits.relays()[1].nickname, 'exit1')
+
+    def test_summary(self):
+        t = RelayTable.from_document(Summary({'version': '4.0', 'relays':
+            [{'n': 'a', 'f': 'A' * 40, 'r': True}], 'bridges': []}))
+        self.assertEqual(list(t.fingerprint), ['A' * 40])
+        self.assertEqual(type(t.relays()[0]), RelaySummary)
+
+if __name__ == '__main__':
+    unittest.main()